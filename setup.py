@@ -40,6 +40,7 @@ setup(name='ClueReleaseManager',
           'console_scripts': [
               'cluerelmgr-server = clue.relmgr.main:main',
               'cluerelmgr-admin = clue.relmgr.cmdtool:main',
+              'cluerelmgr-bench = clue.relmgr.bench:main',
               ],
           },
       )
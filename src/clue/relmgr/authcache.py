@@ -0,0 +1,96 @@
+import hashlib
+import hmac
+import os
+
+from clue.relmgr import cache
+
+
+class AuthCache(object):
+    """Remembers successful credential checks for *ttl* seconds.
+    Credentials are only kept as an HMAC under a secret generated per
+    process, so the cache never holds a password.
+
+      >>> auth = AuthCache(ttl=60)
+      >>> auth.get('foo', 'secret') is None
+      True
+      >>> auth.set('foo', 'secret', 'foo')
+      >>> auth.get('foo', 'secret'), auth.get('foo', 'wrong')
+      ('foo', None)
+
+    Changing a user's password forgets everything cached for that user,
+    None forgets everyone.
+
+      >>> auth.invalidate('foo')
+      >>> auth.get('foo', 'secret') is None
+      True
+    """
+
+    def __init__(self, maxsize=10000, ttl=60, secret=None):
+        if secret is None:
+            secret = os.urandom(32)
+        self.secret = secret
+        self.ttl = ttl
+        self.results = cache.TTLCache(maxsize, ttl)
+
+    def key(self, login, password):
+        digest = hmac.new(self.secret, '%s\0%s' % (login, password),
+                          hashlib.sha256).hexdigest()
+        return (login, digest)
+
+    def get(self, login, password):
+        return self.results.get(self.key(login, password))
+
+    def set(self, login, password, userid):
+        self.results.set(self.key(login, password), userid)
+
+    def invalidate(self, login=None):
+        if login is None:
+            self.results.clear()
+        else:
+            self.results.discard_matching(lambda key: key[0] == login)
+
+    def stats(self):
+        return self.results.stats()
+
+
+class CachingAuthenticator(object):
+    """A repoze.who authenticator plugin answering from *auth_cache*
+    (an AuthCache) before asking *authenticator*.  Only successful
+    checks are cached.
+
+      >>> class Counting(object):
+      ...     calls = 0
+      ...     def authenticate(self, environ, identity):
+      ...         self.calls += 1
+      ...         if identity['password'] == 'secret':
+      ...             return identity['login']
+      >>> plugin = Counting()
+      >>> authenticator = CachingAuthenticator(plugin, AuthCache())
+      >>> identity = {'login': 'foo', 'password': 'secret'}
+      >>> authenticator.authenticate({}, identity)
+      'foo'
+      >>> authenticator.authenticate({}, identity)
+      'foo'
+      >>> authenticator.authenticate({}, {'login': 'foo', 'password': 'x'})
+      >>> plugin.calls
+      2
+    """
+
+    def __init__(self, authenticator, auth_cache):
+        self.authenticator = authenticator
+        self.auth_cache = auth_cache
+
+    def authenticate(self, environ, identity):
+        try:
+            login = identity['login']
+            password = identity['password']
+        except KeyError:
+            return self.authenticator.authenticate(environ, identity)
+
+        userid = self.auth_cache.get(login, password)
+        if userid is not None:
+            return userid
+        userid = self.authenticator.authenticate(environ, identity)
+        if userid is not None:
+            self.auth_cache.set(login, password, userid)
+        return userid
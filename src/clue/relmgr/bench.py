@@ -0,0 +1,769 @@
+"""Load benchmark driving the complete PyPiApp WSGI stack in-process
+against a synthetic repository, reporting throughput, latency and SQL
+queries per request as JSON, micro-benchmarks of the core helpers
+(see the ``benchmark`` cluerelmgr-admin command) and timings of starting
+up fresh processes.
+"""
+
+from __future__ import with_statement
+import base64
+import gc
+import logging
+import math
+import optparse
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import simplejson
+from werkzeug import Client, BaseResponse
+
+from clue.relmgr import model, pypi, sqlstats, utils
+
+PASSWORD = 'secret'
+
+DESCRIPTION = '''\
+%(name)s
+%(underline)s
+
+A synthetic distro used for benchmarking.
+
+Usage
+-----
+
+::
+
+  >>> import %(name)s
+
+* one
+* two
+'''
+
+
+class SyntheticRepo(object):
+    """A repository of generated distros, users, groups, role mappings and
+    pinned indexes stored in *basedir*.
+
+      >>> tmpdir = tempfile.mkdtemp()
+      >>> repo = SyntheticRepo(tmpdir, distros=3, files=2, users=2, groups=1,
+      ...                      indexes=1)
+      >>> repo.build()
+      >>> repo.distro_ids
+      ['package0000', 'package0001', 'package0002']
+      >>> repo.files['package0001']
+      ['Package0001-1.0.tar.gz', 'Package0001-1.1.tar.gz']
+      >>> repo.usernames
+      ['user000', 'user001']
+
+    An existing repository can be loaded again.
+
+      >>> repo = SyntheticRepo(tmpdir)
+      >>> repo.load()
+      >>> repo.distro_ids, repo.usernames
+      (['package0000', 'package0001', 'package0002'], ['user000', 'user001'])
+      >>> repo.files['package0002']
+      ['Package0002-1.0.tar.gz', 'Package0002-1.1.tar.gz']
+      >>> shutil.rmtree(tmpdir)
+    """
+
+    def __init__(self, basedir, distros=100, files=3, users=20, groups=5,
+                 roles=2, indexes=10, index_size=5, file_size=1024, seed=0):
+        self.basedir = basedir
+        self.basefiledir = os.path.join(basedir, 'files')
+        self.sqluri = 'sqlite:///' + os.path.join(basedir, 'bench.db')
+        self.num_distros = distros
+        self.num_files = files
+        self.num_users = users
+        self.num_groups = groups
+        self.num_roles = roles
+        self.num_indexes = indexes
+        self.index_size = index_size
+        self.file_size = file_size
+        self.seed = seed
+
+        self.distro_ids = []
+        self.files = {}
+        self.usernames = []
+
+    def config(self):
+        return {'distros': self.num_distros,
+                'files_per_distro': self.num_files,
+                'users': self.num_users,
+                'groups': self.num_groups,
+                'roles_per_distro': self.num_roles,
+                'indexes': self.num_indexes,
+                'index_size': self.index_size,
+                'file_size': self.file_size}
+
+    def load(self):
+        """Read the distros, files and users of a previously built
+        repository.
+        """
+
+        from clue.relmgr.cmdtool import InsecurePyPi
+
+        target = InsecurePyPi(self.basefiledir, self.sqluri)
+        self.distro_ids = [str(x.distro_id)
+                           for x in target.get_distros(order_by='distro_id')]
+        self.files = dict([(x, sorted([os.path.basename(y)
+                                       for y in target.storage.list(x)]))
+                           for x in self.distro_ids])
+        ses = target.sessionmaker()
+        self.usernames = sorted([str(x.username)
+                                 for x in ses.query(model.SQLUser)])
+
+    def build(self):
+        from clue.relmgr.cmdtool import InsecurePyPi
+
+        rnd = random.Random(self.seed)
+        target = InsecurePyPi(self.basefiledir, self.sqluri)
+        security = target.security_manager
+
+        groupnames = ['group%02i' % x for x in range(self.num_groups)]
+        for groupname in groupnames:
+            security.update_group(groupname, [pypi.READER_ROLE])
+
+        self.usernames = ['user%03i' % x for x in range(self.num_users)]
+        for x, username in enumerate(self.usernames):
+            security.update_user(username, PASSWORD,
+                                 username + '@example.com')
+            roles = [pypi.READER_ROLE]
+            if x == 0:
+                roles.append(pypi.MANAGER_ROLE)
+            security.update_roles(username=username, roles=roles)
+            if groupnames:
+                security.update_users_groups(username,
+                                             [rnd.choice(groupnames)])
+
+        for x in range(self.num_distros):
+            name = 'Package%04i' % x
+            target.update_metadata(
+                name=name, summary='Synthetic distro number %i' % x,
+                author='Bench', author_email='bench@example.com',
+                description=DESCRIPTION % {'name': name,
+                                           'underline': '=' * len(name)})
+            distro_id = utils.make_distro_id(name)
+            self.distro_ids.append(distro_id)
+
+            content = []
+            for y in range(self.num_files):
+                filename = '%s-1.%i.tar.gz' % (name, y)
+                data = ''.join([chr(rnd.randint(0, 255))
+                                for z in range(self.file_size)])
+                content.append(utils.StringContent(filename, data))
+            target.upload_files(name, content)
+            self.files[distro_id] = [c.filename for c in content]
+
+            for username in rnd.sample(self.usernames,
+                                       min(self.num_roles,
+                                           len(self.usernames))):
+                security.update_roles(distro_id=distro_id,
+                                      username=username,
+                                      roles=[model.OWNER_ROLE])
+
+        for distro_id in self.distro_ids[:self.num_indexes]:
+            for target_id in rnd.sample(self.distro_ids,
+                                        min(self.index_size,
+                                            len(self.distro_ids))):
+                version = '1.%i' % rnd.randrange(max(self.num_files, 1))
+                target.index_manager.add_index_item(distro_id, 'prod',
+                                                    target_id, version)
+
+
+HTML = [('Accept', 'text/html')]
+JSON = [('Accept', 'application/json')]
+
+
+def _simple_root(repo, rnd):
+    return '/simple/', []
+
+
+def _simple_distro(repo, rnd):
+    return '/simple/%s/' % rnd.choice(repo.distro_ids), []
+
+
+def _distro_page(repo, rnd):
+    return '/d/%s/' % rnd.choice(repo.distro_ids), HTML
+
+
+def _search(repo, rnd):
+    return '/search?s=%04i' % rnd.randrange(repo.num_distros), HTML
+
+
+def _file_download(repo, rnd):
+    distro_id = rnd.choice(repo.distro_ids)
+    return '/d/%s/f/%s' % (distro_id, rnd.choice(repo.files[distro_id])), []
+
+
+def _json_distros(repo, rnd):
+    return '/d/', JSON
+
+
+def _json_distro(repo, rnd):
+    return '/d/%s/' % rnd.choice(repo.distro_ids), JSON
+
+
+def _json_files(repo, rnd):
+    return '/d/%s/f/?info=1' % rnd.choice(repo.distro_ids), JSON
+
+
+ENDPOINTS = [('simple_root', _simple_root),
+             ('simple_distro', _simple_distro),
+             ('distro_page', _distro_page),
+             ('search', _search),
+             ('file_download', _file_download),
+             ('json_distros', _json_distros),
+             ('json_distro', _json_distro),
+             ('json_files', _json_files)]
+
+
+def percentile(values, pct):
+    """The *pct* percentile of the sorted *values* (nearest rank).
+
+      >>> percentile(range(1, 101), 50), percentile(range(1, 101), 99)
+      (50, 99)
+      >>> percentile([], 50) is None
+      True
+    """
+
+    if not values:
+        return None
+    index = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(index, 0)]
+
+
+def summarize(durations, sql_counts, errors, size, elapsed):
+    durations = sorted(durations)
+    count = len(durations)
+    res = {'requests': count,
+           'errors': errors,
+           'bytes': size,
+           'requests_per_sec': elapsed and count / elapsed or None,
+           'latency_ms': {}}
+    for pct in (50, 90, 95, 99):
+        value = percentile(durations, pct)
+        if value is not None:
+            value = round(value * 1000, 3)
+        res['latency_ms']['p%i' % pct] = value
+    if durations:
+        res['latency_ms']['max'] = round(durations[-1] * 1000, 3)
+        res['latency_ms']['mean'] = round(sum(durations) / count * 1000, 3)
+        res['sql_per_request'] = float(sum(sql_counts)) / count
+    return res
+
+
+class LoadBenchmark(object):
+    """Runs *requests* requests against each endpoint from *concurrency*
+    threads, each request authenticated as *username*.
+    """
+
+    logger = utils.logger
+
+    def __init__(self, repo, requests=200, concurrency=1, warmup=10,
+                 username='user000', endpoints=None, seed=0):
+        self.repo = repo
+        self.requests = requests
+        self.concurrency = concurrency
+        self.warmup = warmup
+        self.username = username
+        self.endpoints = endpoints or [x[0] for x in ENDPOINTS]
+        self.seed = seed
+        self.sql_stats = sqlstats.QueryStats()
+
+    def make_app(self):
+        from clue.relmgr import wsgiapp
+
+        return wsgiapp.PyPiApp(self.repo.basefiledir,
+                               sqluri=self.repo.sqluri,
+                               sql_stats=self.sql_stats)
+
+    def run(self):
+        app = self.make_app()
+        funcs = dict(ENDPOINTS)
+        results = {}
+        for name in self.endpoints:
+            self.logger.info('Benchmarking %s' % name)
+            results[name] = self.run_endpoint(app, funcs[name])
+
+        all_requests = sum([x['requests'] for x in results.values()])
+        return {'config': dict(self.repo.config(),
+                               requests=self.requests,
+                               concurrency=self.concurrency,
+                               warmup=self.warmup),
+                'python': platform.python_version(),
+                'requests': all_requests,
+                'endpoints': results}
+
+    def run_endpoint(self, app, make_request):
+        auth = 'Basic ' + base64.b64encode('%s:%s' % (self.username,
+                                                      PASSWORD))
+        rnd = random.Random(self.seed)
+        planned = [make_request(self.repo, rnd)
+                   for x in range(self.warmup + self.requests)]
+        warmup, planned = planned[:self.warmup], planned[self.warmup:]
+
+        client = Client(app, BaseResponse)
+        for path, headers in warmup:
+            client.get(path, headers=headers + [('Authorization', auth)])
+
+        lock = threading.Lock()
+        durations = []
+        sql_counts = []
+        totals = {'errors': 0, 'bytes': 0}
+
+        def work():
+            client = Client(app, BaseResponse)
+            while True:
+                with lock:
+                    if not planned:
+                        return
+                    path, headers = planned.pop()
+                self.sql_stats.reset_local()
+                started = time.time()
+                res = client.get(path,
+                                 headers=headers + [('Authorization', auth),
+                                                    ('Accept-Encoding',
+                                                     'gzip')])
+                size = len(res.data)
+                duration = time.time() - started
+                with lock:
+                    durations.append(duration)
+                    sql_counts.append(self.sql_stats.local_count())
+                    totals['bytes'] += size
+                    if res.status_code >= 400:
+                        totals['errors'] += 1
+
+        started = time.time()
+        threads = [threading.Thread(target=work)
+                   for x in range(self.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - started
+
+        return summarize(durations, sql_counts, totals['errors'],
+                         totals['bytes'], elapsed)
+
+
+class _FixturePyPi(pypi.PyPi):
+
+    username = 'user001'
+
+    def get_active_user(self):
+        return self.username
+
+
+class MicroFixture(object):
+    """A synthetic repository of *size* distros (and proportionally many
+    users, groups and indexes) for the micro-benchmarks.
+    """
+
+    def __init__(self, basedir, size):
+        self.size = size
+        self.repo = SyntheticRepo(basedir, distros=size, files=5,
+                                  users=max(size // 10, 2),
+                                  groups=max(size // 50, 1),
+                                  indexes=max(size // 10, 1),
+                                  file_size=16)
+        self.repo.build()
+        self.pypi = _FixturePyPi(self.repo.basefiledir, self.repo.sqluri)
+        self.filenames = []
+        for distro_id in self.repo.distro_ids:
+            self.filenames.extend(self.repo.files[distro_id])
+        self.names = ['Package%04i' % x for x in range(size)]
+
+
+def _cycle(items):
+    items = list(items)
+    state = [0]
+
+    def next():
+        state[0] = (state[0] + 1) % len(items)
+        return items[state[0]]
+    return next
+
+
+def _micro_get_roles(fixture):
+    distro_ids = _cycle(fixture.repo.distro_ids)
+    security = fixture.pypi.security_manager
+    return lambda: security.get_roles('user001', distro_ids(), True)
+
+
+def _micro_has_role(fixture):
+    distro_ids = _cycle(fixture.repo.distro_ids)
+    target = fixture.pypi
+    return lambda: target.has_role(distro_ids(), pypi.READER_ROLE,
+                                   pypi.MANAGER_ROLE, model.OWNER_ROLE)
+
+
+def _micro_get_files(fixture):
+    distro_ids = _cycle(fixture.repo.distro_ids)
+    target = fixture.pypi
+    return lambda: target.get_files(distro_ids())
+
+
+def _micro_make_distro_id(fixture):
+    names = _cycle(fixture.names)
+    return lambda: utils.make_distro_id(names())
+
+
+def _micro_parse_version(fixture):
+    filenames = _cycle(fixture.filenames)
+    return lambda: utils.parse_version(filenames())
+
+
+def _micro_get_archive_split(fixture):
+    filenames = _cycle(fixture.filenames)
+    return lambda: utils.get_archive_split(filenames())
+
+
+def _micro_get_indexes(fixture):
+    distro_ids = _cycle(fixture.repo.distro_ids[:fixture.repo.num_indexes])
+    indexes = fixture.pypi.index_manager
+    return lambda: indexes.get_indexes(distro_ids())
+
+
+MICRO_BENCHMARKS = [('get_roles', _micro_get_roles),
+                    ('has_role', _micro_has_role),
+                    ('get_files', _micro_get_files),
+                    ('make_distro_id', _micro_make_distro_id),
+                    ('parse_version', _micro_parse_version),
+                    ('get_archive_split', _micro_get_archive_split),
+                    ('get_indexes', _micro_get_indexes)]
+
+
+def time_call(func, min_time=0.2, repeat=3):
+    """Seconds per call of *func*, the best of *repeat* runs each lasting
+    at least *min_time* seconds.
+
+      >>> time_call(lambda: None, min_time=0.001) < 0.001
+      True
+    """
+
+    loops = 1
+    while True:
+        started = time.time()
+        for x in xrange(loops):
+            func()
+        elapsed = time.time() - started
+        if elapsed >= min_time:
+            break
+        loops *= 2
+
+    best = elapsed
+    for x in range(repeat - 1):
+        started = time.time()
+        for x in xrange(loops):
+            func()
+        best = min(best, time.time() - started)
+    return best / loops
+
+
+def count_allocations(func, loops=100):
+    """Objects tracked by the garbage collector that *func* leaves
+    behind per call, i.e. allocations minus deallocations of containers.
+
+      >>> class Obj(object):
+      ...     pass
+      >>> keep = []
+      >>> round(count_allocations(lambda: keep.append(Obj()), loops=1000))
+      1.0
+      >>> round(count_allocations(lambda: Obj(), loops=1000))
+      0.0
+    """
+
+    func()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        gc.collect()
+        before = gc.get_count()[0]
+        for x in xrange(loops):
+            func()
+        after = gc.get_count()[0]
+    finally:
+        if enabled:
+            gc.enable()
+    return float(after - before) / loops
+
+
+def run_micro(sizes=(10, 100, 1000), names=None, min_time=0.2):
+    """Run the micro-benchmarks against fixtures of each of the *sizes*,
+    returning ``{name: {size: {'time': ..., 'allocations': ...}}}`` with
+    sizes as strings so the results survive a JSON round trip.
+    """
+
+    names = names or [x[0] for x in MICRO_BENCHMARKS]
+    funcs = dict(MICRO_BENCHMARKS)
+    results = dict([(x, {}) for x in names])
+    for size in sizes:
+        basedir = tempfile.mkdtemp(prefix='cluerelmgr-microbench-')
+        try:
+            utils.logger.info('Building fixture of %i distros' % size)
+            level = utils.logger.level
+            utils.logger.setLevel(logging.WARNING)
+            try:
+                fixture = MicroFixture(basedir, size)
+            finally:
+                utils.logger.setLevel(level)
+            for name in names:
+                func = funcs[name](fixture)
+                results[name][str(size)] = {
+                    'time': time_call(func, min_time),
+                    'allocations': count_allocations(func)}
+        finally:
+            shutil.rmtree(basedir)
+    return results
+
+
+def compare_micro(results, baseline, threshold=0.2):
+    """Regressions of *results* against *baseline*, as
+    ``(name, size, baseline time, time)`` tuples for every benchmark
+    which got more than *threshold* slower.
+
+      >>> baseline = {'a': {'10': {'time': 1.0}, '100': {'time': 2.0}}}
+      >>> results = {'a': {'10': {'time': 1.1}, '100': {'time': 3.0}},
+      ...            'b': {'10': {'time': 5.0}}}
+      >>> compare_micro(results, baseline)
+      [('a', '100', 2.0, 3.0)]
+    """
+
+    regressions = []
+    for name in sorted(results):
+        for size in sorted(results[name], key=int):
+            old = baseline.get(name, {}).get(size)
+            if old is None:
+                continue
+            new = results[name][size]['time']
+            if new > old['time'] * (1 + threshold):
+                regressions.append((name, size, old['time'], new))
+    return regressions
+
+
+def format_micro(results, baseline=None):
+    lines = ['%-20s %8s %12s %12s %10s' % ('benchmark', 'distros',
+                                           'usec/call', 'baseline',
+                                           'allocs')]
+    for name in sorted(results):
+        for size in sorted(results[name], key=int):
+            res = results[name][size]
+            old = (baseline or {}).get(name, {}).get(size)
+            if old is None:
+                old = '-'
+            else:
+                old = '%.2f' % (old['time'] * 1e6)
+            lines.append('%-20s %8s %12.2f %12s %10.1f'
+                         % (name, size, res['time'] * 1e6, old,
+                            res['allocations']))
+    return '\n'.join(lines)
+
+
+def micro_main(args=None):
+    """Entry point of the ``benchmark`` cluerelmgr-admin command, returns
+    1 if a regression against the baseline was found.
+    """
+
+    parser = optparse.OptionParser(
+        usage='%prog benchmark [options]',
+        description='Time the core helpers against synthetic repositories')
+    parser.add_option('--sizes', default='10,100,1000',
+                      help='Comma separated numbers of distros, defaults '
+                           'to 10,100,1000')
+    parser.add_option('-b', '--benchmark', dest='names', action='append',
+                      help='Only run the given benchmark, one of: %s'
+                           % ', '.join([x[0] for x in MICRO_BENCHMARKS]))
+    parser.add_option('--min-time', type='float', default=0.2,
+                      help='Seconds to run each benchmark for')
+    parser.add_option('--save', help='Save the results as a baseline')
+    parser.add_option('--compare', help='Compare against a saved baseline')
+    parser.add_option('--threshold', type='float', default=0.2,
+                      help='Slowdown reported as a regression, defaults '
+                           'to 0.2 (20%)')
+
+    options, args = parser.parse_args(args or [])
+    sizes = [int(x) for x in options.sizes.split(',') if x.strip()]
+    results = run_micro(sizes, options.names, options.min_time)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = simplejson.load(f)
+    print format_micro(results, baseline)
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            f.write(simplejson.dumps(results, sort_keys=True, indent=2))
+            f.write('\n')
+
+    if baseline is not None:
+        regressions = compare_micro(results, baseline, options.threshold)
+        if regressions:
+            print
+            print 'Regressions:'
+            for name, size, old, new in regressions:
+                print '  %s (%s distros): %.2f -> %.2f usec/call' % (
+                    name, size, old * 1e6, new * 1e6)
+            return 1
+    return 0
+
+
+# each scenario runs in a fresh interpreter, in a scratch directory
+# holding an initialized cluerelmgr.db
+STARTUP_SCENARIOS = [
+    ('cmdtool_usage',
+     'from clue.relmgr import cmdtool\n'
+     'cmdtool.Runner().main([], [])\n'),
+    ('cmdtool_db',
+     'from clue.relmgr import cmdtool\n'
+     'cmdtool.Runner().main(["flush-mirror-misses"], [])\n'),
+    ('server_import',
+     'from clue.relmgr import main\n'),
+    ('first_request',
+     'from werkzeug import Client, BaseResponse\n'
+     'from clue.relmgr import wsgiapp\n'
+     'app = wsgiapp.PyPiApp("files", sqluri="sqlite:///cluerelmgr.db")\n'
+     'Client(app, BaseResponse).get("/simple/")\n'),
+    ]
+
+
+def time_process(code, cwd, repeat=5):
+    """Wall clock seconds of running *code* in *repeat* new Python
+    processes.
+    """
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([x for x in sys.path if x])
+    durations = []
+    devnull = open(os.devnull, 'w')
+    try:
+        for x in range(repeat):
+            started = time.time()
+            proc = subprocess.Popen([sys.executable, '-c', code], cwd=cwd,
+                                    env=env, stdout=devnull, stderr=devnull)
+            if proc.wait() != 0:
+                raise RuntimeError('Startup scenario failed: %r' % code)
+            durations.append(time.time() - started)
+    finally:
+        devnull.close()
+    return durations
+
+
+def run_startup(repeat=5, names=None):
+    """Times the startup scenarios, the fastest and median runs of each
+    are reported.
+    """
+
+    tmpdir = tempfile.mkdtemp(prefix='cluerelmgr-startup-')
+    try:
+        # create the database and warm the OS file cache
+        time_process(STARTUP_SCENARIOS[1][1], tmpdir, 1)
+        results = {}
+        for name, code in STARTUP_SCENARIOS:
+            if names and name not in names:
+                continue
+            try:
+                durations = sorted(time_process(code, tmpdir, repeat))
+            except RuntimeError, err:
+                results[name] = {'error': str(err)}
+                continue
+            results[name] = {'runs': repeat,
+                             'min': durations[0],
+                             'median': percentile(durations, 50)}
+    finally:
+        shutil.rmtree(tmpdir)
+    return {'python': platform.python_version(),
+            'startup': results}
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Benchmark ClueReleaseManager against a synthetic '
+                    'repository, the results are written as JSON')
+    parser.add_option('--distros', type='int', default=100)
+    parser.add_option('--files', type='int', default=3,
+                      help='Files per distro')
+    parser.add_option('--file-size', type='int', default=1024)
+    parser.add_option('--users', type='int', default=20)
+    parser.add_option('--groups', type='int', default=5)
+    parser.add_option('--roles', type='int', default=2,
+                      help='Users with the owner role per distro')
+    parser.add_option('--indexes', type='int', default=10,
+                      help='Distros with a pinned index')
+    parser.add_option('-n', '--requests', type='int', default=200,
+                      help='Requests per endpoint')
+    parser.add_option('-c', '--concurrency', type='int', default=1)
+    parser.add_option('--warmup', type='int', default=10)
+    parser.add_option('-e', '--endpoint', dest='endpoints', action='append',
+                      help='Only benchmark the given endpoint, one of: %s'
+                           % ', '.join([x[0] for x in ENDPOINTS]))
+    parser.add_option('--basedir',
+                      help='Directory for the synthetic repository, it is '
+                           'reused if it exists, defaults to a temporary '
+                           'directory which is removed afterwards')
+    parser.add_option('-o', '--output', help='Write the results to a file')
+    parser.add_option('--startup', action='store_true', default=False,
+                      help='Time starting up new processes instead, -e '
+                           'then selects among: %s'
+                           % ', '.join([x[0] for x in STARTUP_SCENARIOS]))
+    parser.add_option('--repeat', type='int', default=5,
+                      help='Processes started per startup scenario')
+
+    if args is None:
+        args = sys.argv[1:]
+    options, args = parser.parse_args(args)
+    logging.basicConfig()
+
+    if options.startup:
+        results = simplejson.dumps(run_startup(options.repeat,
+                                               options.endpoints),
+                                   sort_keys=True, indent=2)
+        if options.output:
+            with open(options.output, 'w') as f:
+                f.write(results + '\n')
+        else:
+            print results
+        return
+
+    basedir = options.basedir
+    remove = basedir is None
+    if remove:
+        basedir = tempfile.mkdtemp(prefix='cluerelmgr-bench-')
+    repo = SyntheticRepo(basedir, distros=options.distros,
+                         files=options.files, users=options.users,
+                         groups=options.groups, roles=options.roles,
+                         indexes=options.indexes,
+                         file_size=options.file_size)
+    try:
+        if os.path.exists(os.path.join(basedir, 'bench.db')):
+            repo.load()
+        else:
+            utils.logger.info('Building synthetic repository in %s'
+                              % basedir)
+            repo.build()
+
+        bench = LoadBenchmark(repo, requests=options.requests,
+                              concurrency=options.concurrency,
+                              warmup=options.warmup,
+                              endpoints=options.endpoints)
+        results = simplejson.dumps(bench.run(), sort_keys=True, indent=2)
+    finally:
+        if remove:
+            shutil.rmtree(basedir)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(results + '\n')
+    else:
+        print results
+
+
+if __name__ == '__main__':
+    main()
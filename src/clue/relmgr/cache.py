@@ -0,0 +1,174 @@
+from __future__ import with_statement
+import threading
+import time
+
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """A thread-safe mapping that holds at most ``maxsize`` entries,
+    discarding the least recently used entry when full.
+
+      >>> c = LRUCache(2)
+      >>> c.set('a', 1)
+      >>> c.set('b', 2)
+      >>> c.get('a')
+      1
+      >>> c.set('c', 3)
+      >>> c.get('b') is None
+      True
+      >>> sorted(c.keys())
+      ['a', 'c']
+
+    Hits and misses are tracked for monitoring.
+
+      >>> sorted(c.stats().items())
+      [('hits', 1), ('maxsize', 2), ('misses', 1), ('size', 2)]
+
+    Entries can be dropped individually or by matching their keys.
+
+      >>> c.pop('a')
+      1
+      >>> c.discard_matching(lambda key: key == 'c')
+      1
+      >>> len(c)
+      0
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._map = {}
+        # circular doubly linked list, most recently used entries are
+        # kept right before the root
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def keys(self):
+        with self._lock:
+            return self._map.keys()
+
+    def _unlink(self, link):
+        link_prev, link_next = link[PREV], link[NEXT]
+        link_prev[NEXT] = link_next
+        link_next[PREV] = link_prev
+
+    def _append(self, link):
+        root = self._root
+        last = root[PREV]
+        link[PREV] = last
+        link[NEXT] = root
+        last[NEXT] = root[PREV] = link
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._map.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            return link[VALUE]
+
+    def set(self, key, value):
+        with self._lock:
+            link = self._map.get(key)
+            if link is not None:
+                link[VALUE] = value
+                self._unlink(link)
+                self._append(link)
+                return
+
+            if len(self._map) >= self.maxsize:
+                oldest = self._root[NEXT]
+                self._unlink(oldest)
+                del self._map[oldest[KEY]]
+
+            link = [None, None, key, value]
+            self._append(link)
+            self._map[key] = link
+
+    def pop(self, key, default=None):
+        with self._lock:
+            link = self._map.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            return link[VALUE]
+
+    def discard_matching(self, func):
+        """Remove all entries whose key satisfies *func*, returning
+        the number of entries removed.
+        """
+
+        with self._lock:
+            removed = 0
+            for key in self._map.keys():
+                if func(key):
+                    self._unlink(self._map.pop(key))
+                    removed += 1
+            return removed
+
+    def clear(self):
+        with self._lock:
+            self._map.clear()
+            root = self._root
+            root[:] = [root, root, None, None]
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._map),
+                'maxsize': self.maxsize}
+
+
+class TTLCache(LRUCache):
+    """An ``LRUCache`` whose entries expire *ttl* seconds after being set.
+
+      >>> now = [100]
+      >>> c = TTLCache(10, ttl=5, clock=lambda: now[0])
+      >>> c.set('a', 1)
+      >>> c.get('a')
+      1
+      >>> now[0] = 106
+      >>> c.get('a') is None
+      True
+      >>> len(c)
+      0
+      >>> c.stats()['misses']
+      1
+    """
+
+    def __init__(self, maxsize=1000, ttl=300, clock=time.time):
+        super(TTLCache, self).__init__(maxsize)
+        self.ttl = ttl
+        self.clock = clock
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._map.get(key)
+            if link is not None:
+                expires, value = link[VALUE]
+                if expires > self.clock():
+                    self.hits += 1
+                    self._unlink(link)
+                    self._append(link)
+                    return value
+                del self._map[key]
+                self._unlink(link)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        super(TTLCache, self).set(key, (self.clock() + ttl, value))
@@ -1,13 +1,20 @@
+import base64
 import logging
 import optparse
 import os
 import subprocess
 import sys
+import urllib2
 
-import pkg_resources
+import simplejson
 
-from clue.relmgr import utils, ve
+from clue.relmgr import model, profiling, storage, utils
 from clue.relmgr.pypi import PyPi
+from clue.relmgr.mirror import MissCache
+
+pkg_resources = utils.LazyModule('pkg_resources')
+ve = utils.LazyModule('clue.relmgr.ve')
+bench = utils.LazyModule('clue.relmgr.bench')
 
 
 class InsecurePyPi(PyPi):
@@ -46,6 +53,13 @@ class Runner(object):
               addfile <distro_id> <filename_or_url>
               addindexentry <distro_id> <indexname> <target_distro_id> <target_distro_version>
               delindexentry <distro_id> <indexname> <target_distro_id>
+              rerender-descriptions
+              flush-mirror-misses
+              migrate-storage
+              benchmark [--sizes 10,100] [--save <file>] [--compare <file>]
+              profiles <profile_dir> [<limit>]
+              memory [--snapshot] [-u <user>:<password>] <server_url>
+              migrate
       <BLANKLINE>
 
       >>> runner.main(['updateuser', 'foo', 'bar', 'abc', 'role1'])
@@ -85,7 +99,14 @@ class Runner(object):
         adddistro [-u <user>:<role>] <filename_or_url>
         addfile <distro_id> <filename_or_url>
         addindexentry <distro_id> <indexname> <target_distro_id> <target_distro_version>
-        delindexentry <distro_id> <indexname> <target_distro_id>"""
+        delindexentry <distro_id> <indexname> <target_distro_id>
+        rerender-descriptions
+        flush-mirror-misses
+        migrate-storage
+        benchmark [--sizes 10,100] [--save <file>] [--compare <file>]
+        profiles <profile_dir> [<limit>]
+        memory [--snapshot] [-u <user>:<password>] <server_url>
+        migrate"""
 
         parser = optparse.OptionParser(usage=usage)
 
@@ -168,6 +189,40 @@ class Runner(object):
 
             pypi.index_manager.del_index_item(distro_id, indexname,
                                               target_distro_id)
+        elif cmd == 'rerender-descriptions':
+            count = pypi.render_all_descriptions()
+            print 'Rendered descriptions for %i distro(s)' % count
+        elif cmd == 'flush-mirror-misses':
+            count = MissCache(sessionmaker=pypi.sessionmaker).flush()
+            print 'Removed %i stored backup index miss(es)' % count
+        elif cmd == 'migrate-storage':
+            layout = storage.HashedLayout(pypi.basefiledir)
+            count = layout.migrate()
+            print 'Moved %i file(s) to the hashed storage layout' % count
+        elif cmd == 'benchmark':
+            return bench.micro_main(params)
+        elif cmd == 'profiles':
+            limit = 20
+            if len(params) > 1:
+                limit = int(params[1])
+            for x in profiling.list_profiles(params[0], limit):
+                print '%8.3fs  %-6s %s  %s' % (x['duration'], x['method'],
+                                              x['path'], x['name'])
+        elif cmd == 'memory':
+            parser = optparse.OptionParser()
+            parser.add_option('-s', '--snapshot', action='store_true',
+                              help='Take a new snapshot first',
+                              default=False)
+            parser.add_option('-u', '--user',
+                              help='<user>:<password> of a manager')
+            parser.add_option('-l', '--limit', type='int', default=20)
+            options, args = parser.parse_args(params)
+            self.memory(args[0], options.user, options.snapshot,
+                        options.limit)
+        elif cmd == 'migrate':
+            for version, description in model.migrate(pypi.create_engine()):
+                print 'Migrated to version %i: %s' % (version, description)
+            print 'Database schema is at version %i' % model.SCHEMA_VERSION
         elif cmd == 'setupindex':
             parser = optparse.OptionParser()
             parser.add_option('-f', '--overwrite', dest='overwrite',
@@ -180,6 +235,38 @@ class Runner(object):
         else:
             print "No such command: %s" % cmd
 
+    def memory(self, server_url, user=None, snapshot=False, limit=20):
+        url = server_url.rstrip('/') + '/memory?limit=%i' % limit
+        data = None
+        if snapshot:
+            data = ''
+        req = urllib2.Request(url, data)
+        if user:
+            req.add_header('Authorization',
+                           'Basic ' + base64.b64encode(user))
+        report = simplejson.load(urllib2.urlopen(req))
+
+        print 'Objects by category:'
+        for name, count in sorted(report['categories'].items()):
+            print '  %-20s %10i' % (name, count)
+        print
+        print 'Objects by type:'
+        for x in report['types']:
+            print '  %-50s %10i' % (x['type'], x['count'])
+        if 'growth' in report:
+            print
+            print 'Growth since the last of %i snapshot(s):' \
+                  % report['snapshots']
+            for x in report['growth']:
+                print '  %-50s %10i %+10i' % (x['type'], x['count'],
+                                             x['growth'])
+        if 'allocations' in report:
+            print
+            print 'Top allocation sites:'
+            for x in report['allocations']:
+                print '  %-50s %10i %+10i' % (x['site'], x['size'],
+                                             x.get('size_diff', 0))
+
     def addfile(self, pypi, distro_id, filenames):
         files = [utils.get_content(x) for x in filenames]
         pypi.upload_files(distro_id, files)
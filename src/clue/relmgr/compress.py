@@ -0,0 +1,240 @@
+import hashlib
+import re
+import struct
+import time
+import zlib
+
+from clue.relmgr import cache
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                      'application/xml', 'application/x-javascript')
+
+
+def accepts_gzip(environ):
+    """Whether the client accepts gzip encoded responses.
+
+      >>> accepts_gzip({'HTTP_ACCEPT_ENCODING': 'gzip, deflate'})
+      True
+      >>> accepts_gzip({'HTTP_ACCEPT_ENCODING': 'gzip;q=0, deflate'})
+      False
+      >>> accepts_gzip({})
+      False
+    """
+
+    for part in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = [x.strip() for x in part.split(';')]
+        if params[0] not in ('gzip', 'x-gzip', '*'):
+            continue
+        for param in params[1:]:
+            if re.match(r'q=0(\.0*)?$', param):
+                return False
+        return True
+    return False
+
+
+def _header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _gzip_header():
+    return ('\037\213\010\000' + struct.pack('<L', long(time.time()))
+            + '\002\377')
+
+
+class GzipStream(object):
+    """Incrementally gzips the chunks passed to ``compress``.
+
+      >>> import gzip, StringIO
+      >>> stream = GzipStream()
+      >>> data = stream.compress('abc') + stream.compress('def')
+      >>> data += stream.flush()
+      >>> gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+      'abcdef'
+    """
+
+    def __init__(self, level=6):
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                     zlib.DEF_MEM_LEVEL, 0)
+        self._crc = zlib.crc32('') & 0xffffffffL
+        self._size = 0
+        self._started = False
+
+    def compress(self, data):
+        self._crc = zlib.crc32(data, self._crc) & 0xffffffffL
+        self._size += len(data)
+        res = self._obj.compress(data)
+        if not self._started:
+            self._started = True
+            res = _gzip_header() + res
+        return res
+
+    def flush(self):
+        res = self._obj.flush()
+        if not self._started:
+            self._started = True
+            res = _gzip_header() + res
+        return res + struct.pack('<LL', self._crc,
+                                 self._size & 0xffffffffL)
+
+
+def gzip_string(data, level=6):
+    stream = GzipStream(level)
+    return stream.compress(data) + stream.flush()
+
+
+class GzipMiddleware(object):
+    """Gzips text responses for clients accepting it.  Compressed bodies
+    are kept in *compressed_cache* keyed by the sha1 of the uncompressed
+    body, so unchanged pages are only compressed once.  Bodies larger
+    than *max_buffer* are compressed while they are streamed instead.
+
+      >>> import gzip, StringIO
+      >>> def app(environ, start_response):
+      ...     start_response('200 OK', [('Content-Type', 'text/html'),
+      ...                               ('Content-Length', '1000')])
+      ...     return ['a' * 500, 'b' * 500]
+      >>> mw = GzipMiddleware(app)
+      >>> def start(status, headers, exc_info=None):
+      ...     started[:] = [status, dict(headers)]
+      >>> started = []
+
+      >>> body = ''.join(mw({'HTTP_ACCEPT_ENCODING': 'gzip'}, start))
+      >>> started[1]['Content-Encoding'], started[1]['Vary']
+      ('gzip', 'Accept-Encoding')
+      >>> int(started[1]['Content-Length']) == len(body)
+      True
+      >>> gzip.GzipFile(fileobj=StringIO.StringIO(body)).read() == \\
+      ...     'a' * 500 + 'b' * 500
+      True
+
+    The next request for the same content is served from the cache.
+
+      >>> body2 = ''.join(mw({'HTTP_ACCEPT_ENCODING': 'gzip'}, start))
+      >>> body2 == body
+      True
+      >>> mw.compressed_cache.stats()['hits']
+      1
+
+    Clients not accepting gzip get the plain response.
+
+      >>> len(''.join(mw({}, start))), started[1]['Vary']
+      (1000, 'Accept-Encoding')
+      >>> 'Content-Encoding' in started[1]
+      False
+
+    Large bodies are streamed.
+
+      >>> mw.max_buffer = 600
+      >>> body = ''.join(mw({'HTTP_ACCEPT_ENCODING': 'gzip'}, start))
+      >>> 'Content-Length' in started[1]
+      False
+      >>> len(gzip.GzipFile(fileobj=StringIO.StringIO(body)).read())
+      1000
+    """
+
+    min_size = 200
+    max_buffer = 4 * 1024 * 1024
+
+    def __init__(self, app, compress_level=6, compressed_cache=None):
+        self.app = app
+        self.compress_level = compress_level
+        if compressed_cache is None:
+            compressed_cache = cache.LRUCache(200)
+        self.compressed_cache = compressed_cache
+
+    def compressible(self, environ, status, headers):
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return False
+        if not status.startswith('200'):
+            return False
+        if _header(headers, 'content-encoding') is not None:
+            return False
+        if 'no-transform' in (_header(headers, 'cache-control') or ''):
+            return False
+        content_type = _header(headers, 'content-type') or ''
+        for x in COMPRESSIBLE_TYPES:
+            if content_type.startswith(x):
+                return True
+        return False
+
+    def __call__(self, environ, start_response):
+        state = {}
+
+        def start(status, headers, exc_info=None):
+            if not self.compressible(environ, status, headers):
+                return start_response(status, headers, exc_info)
+
+            headers = [x for x in headers if x[0].lower() != 'vary'] + \
+                      [('Vary', _vary(headers))]
+            if not accepts_gzip(environ):
+                return start_response(status, headers, exc_info)
+
+            state['response'] = (status, headers, exc_info)
+            state['written'] = written = []
+            return written.append
+
+        app_iter = self.app(environ, start)
+        if 'response' not in state:
+            return app_iter
+        return self._compress(app_iter, state, start_response)
+
+    def _compress(self, app_iter, state, start_response):
+        status, headers, exc_info = state['response']
+        headers = [x for x in headers if x[0].lower() != 'content-length']
+        chunks = state['written']
+        size = sum([len(x) for x in chunks])
+        it = iter(app_iter)
+        try:
+            for data in it:
+                chunks.append(data)
+                size += len(data)
+                if size > self.max_buffer:
+                    break
+            else:
+                body = ''.join(chunks)
+                if size < self.min_size:
+                    start_response(status, headers +
+                                   [('Content-Length', str(size))], exc_info)
+                    yield body
+                    return
+                compressed = self.gzip_body(body)
+                start_response(status, headers +
+                               [('Content-Encoding', 'gzip'),
+                                ('Content-Length', str(len(compressed)))],
+                               exc_info)
+                yield compressed
+                return
+
+            start_response(status, headers + [('Content-Encoding', 'gzip')],
+                           exc_info)
+            stream = GzipStream(self.compress_level)
+            yield stream.compress(''.join(chunks))
+            del chunks[:]
+            for data in it:
+                compressed = stream.compress(data)
+                if compressed:
+                    yield compressed
+            yield stream.flush()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def gzip_body(self, body):
+        key = hashlib.sha1(body).digest()
+        compressed = self.compressed_cache.get(key)
+        if compressed is None:
+            compressed = gzip_string(body, self.compress_level)
+            self.compressed_cache.set(key, compressed)
+        return compressed
+
+
+def _vary(headers):
+    vary = [x.strip() for x in (_header(headers, 'vary') or '').split(',')
+            if x.strip()]
+    if 'accept-encoding' not in [x.lower() for x in vary]:
+        vary.append('Accept-Encoding')
+    return ', '.join(vary)
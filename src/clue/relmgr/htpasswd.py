@@ -2,9 +2,12 @@
 """Replacement for htpasswd"""
 # Original author: Eli Carter
 
+from __future__ import with_statement
 import os
 import sys
 import random
+import tempfile
+import threading
 from optparse import OptionParser
 
 # We need a crypt module, but Windows doesn't have one by default.  Try to find
@@ -29,45 +32,242 @@ def salt():
 
 
 class HtpasswdFile:
-    """A class for manipulating htpasswd files."""
+    """A class for manipulating htpasswd files.
+
+    The entries are kept in a dictionary and reloaded whenever the file
+    changes on disk, so one instance can be shared by everything reading
+    or updating the file.  Updates and deletions are saved right away,
+    saving writes a temporary file which then replaces the original.
+
+      >>> import tempfile, shutil
+      >>> tmpdir = tempfile.mkdtemp()
+      >>> filename = os.path.join(tmpdir, 'users.htpasswd')
+      >>> pfile = HtpasswdFile(filename, create=True)
+      >>> pfile.update('foo', 'secret')
+      >>> pfile.update('bar', 'other')
+      >>> pfile.usernames()
+      ['bar', 'foo']
+      >>> pfile.check('foo', 'secret'), pfile.check('foo', 'wrong')
+      (True, False)
+
+    Changes made by others show up on next use and are kept when
+    updating.
+
+      >>> other = HtpasswdFile(filename)
+      >>> other.delete('bar')
+      >>> pfile.usernames()
+      ['foo']
+      >>> other.update('baz', 'third')
+      >>> pfile.update('foo', 'changed')
+      >>> HtpasswdFile(filename).usernames()
+      ['baz', 'foo']
+
+    The names handed out are the caller's to change.
+
+      >>> pfile.usernames().append('qux')
+      >>> pfile.usernames()
+      ['baz', 'foo']
+
+      >>> shutil.rmtree(tmpdir)
+    """
 
     def __init__(self, filename, create=False):
-        self.entries = []
+        self.entries = {}
+        self.order = []
         self.filename = filename
-        if not create:
-            if os.path.exists(self.filename):
-                self.load()
-            else:
-                raise Exception("%s does not exist" % self.filename)
+        self.stamp = None
+        self.lock = threading.RLock()
+        self._usernames = None
+        self.listeners = []
+        if create:
+            # the file starts out empty, whatever is there now is replaced
+            # on the first save
+            self.stamp = self._stat()
+        elif os.path.exists(self.filename):
+            self.load()
+        else:
+            raise Exception("%s does not exist" % self.filename)
+
+    def _stat(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
 
     def load(self):
         """Read the htpasswd file into memory."""
-        lines = open(self.filename, 'r').readlines()
-        self.entries = []
-        for line in lines:
-            username, pwhash = line.split(':')
-            entry = [username, pwhash.rstrip()]
-            self.entries.append(entry)
+        with self.lock:
+            stamp = self._stat()
+            entries = {}
+            order = []
+            with open(self.filename, 'r') as f:
+                for line in f:
+                    try:
+                        username, pwhash = line.rstrip().split(':', 1)
+                    except ValueError:
+                        continue
+                    if username not in entries:
+                        order.append(username)
+                    entries[username] = pwhash
+            reloaded = self.stamp is not None
+            self.entries = entries
+            self.order = order
+            self.stamp = stamp
+            self._usernames = None
+        if reloaded:
+            self.notify(None)
+
+    def add_listener(self, listener):
+        """Register *listener* to be called with the username whose
+        password changed, or None when the whole file was reloaded.
+        """
+        self.listeners.append(listener)
+
+    def notify(self, username):
+        for listener in self.listeners:
+            listener(username)
+
+    def refresh(self):
+        """Reload the file if it changed since it was last read."""
+        stamp = self._stat()
+        if stamp is not None and stamp != self.stamp:
+            self.load()
 
     def save(self):
         """Write the htpasswd file to disk"""
-        open(self.filename, 'w').writelines(["%s:%s\n" % (entry[0], entry[1])
-                                             for entry in self.entries])
+        with self.lock:
+            dirname = os.path.dirname(os.path.abspath(self.filename))
+            fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.htpasswd')
+            try:
+                f = os.fdopen(fd, 'w')
+                try:
+                    f.writelines(["%s:%s\n" % (username,
+                                               self.entries[username])
+                                  for username in self.order])
+                finally:
+                    f.close()
+                if os.path.exists(self.filename):
+                    os.chmod(tmpname, os.stat(self.filename).st_mode)
+                    if os.name == 'nt':
+                        os.remove(self.filename)
+                os.rename(tmpname, self.filename)
+            except:
+                if os.path.exists(tmpname):
+                    os.remove(tmpname)
+                raise
+            self.stamp = self._stat()
 
     def update(self, username, password):
-        """Replace the entry for the given user, or add it if new."""
+        """Replace the entry for the given user, or add it if new, and
+        save the file.
+        """
         pwhash = crypt.crypt(password, salt())
-        matching_entries = [entry for entry in self.entries
-                            if entry[0] == username]
-        if matching_entries:
-            matching_entries[0][1] = pwhash
-        else:
-            self.entries.append([username, pwhash])
+        with self.lock:
+            self.refresh()
+            if username not in self.entries:
+                self.order.append(username)
+                self._usernames = None
+            self.entries[username] = pwhash
+            self.save()
+        self.notify(username)
 
     def delete(self, username):
-        """Remove the entry for the given user."""
-        self.entries = [entry for entry in self.entries
-                        if entry[0] != username]
+        """Remove the entry for the given user and save the file."""
+        with self.lock:
+            self.refresh()
+            if username in self.entries:
+                del self.entries[username]
+                self.order.remove(username)
+                self._usernames = None
+            self.save()
+        self.notify(username)
+
+    def usernames(self):
+        """The sorted names of all users."""
+        with self.lock:
+            self.refresh()
+            if self._usernames is None:
+                self._usernames = sorted(self.entries)
+            return list(self._usernames)
+
+    def get_hash(self, username):
+        with self.lock:
+            self.refresh()
+            return self.entries.get(username)
+
+    def check(self, username, password, check=None):
+        """Whether *password* is the one of *username*, *check* compares a
+        password and its hash and defaults to a crypt check.
+        """
+        pwhash = self.get_hash(username)
+        if pwhash is None:
+            return False
+        if check is None:
+            return crypt.crypt(password, pwhash) == pwhash
+        return bool(check(password, pwhash))
+
+
+class HtpasswdAuthenticator(object):
+    """A repoze.who authenticator plugin checking credentials against a
+    shared HtpasswdFile, *check* compares a password and its hash the way
+    repoze.who's htpasswd plugin does.
+    """
+
+    def __init__(self, pfile, check=None):
+        self.pfile = pfile
+        self.check = check
+
+    def authenticate(self, environ, identity):
+        try:
+            login = identity['login']
+            password = identity['password']
+        except KeyError:
+            return None
+        if self.pfile.check(login, password, self.check):
+            return login
+        return None
+
+
+class HtpasswdUserManager(object):
+    """Web-based user management on a shared HtpasswdFile, so the user
+    pages see and make the same changes as authentication does.
+
+      >>> import tempfile, shutil
+      >>> tmpdir = tempfile.mkdtemp()
+      >>> pfile = HtpasswdFile(os.path.join(tmpdir, 'users.htpasswd'),
+      ...                      create=True)
+      >>> manager = HtpasswdUserManager(pfile)
+      >>> manager.update_user('foo', 'secret')
+      >>> manager.get_users(), manager.has_user('foo')
+      (['foo'], True)
+      >>> pfile.check('foo', 'secret')
+      True
+      >>> manager.delete_user('foo')
+      >>> pfile.usernames(), manager.has_user('foo')
+      ([], False)
+
+      >>> shutil.rmtree(tmpdir)
+    """
+
+    def __init__(self, pfile, check=None):
+        self.pfile = pfile
+        self.check = check
+
+    def get_users(self):
+        return self.pfile.usernames()
+
+    def has_user(self, username):
+        return self.pfile.get_hash(username) is not None
+
+    def update_user(self, username, password):
+        self.pfile.update(username, password)
+
+    def delete_user(self, username):
+        self.pfile.delete(username)
+
+    def check_password(self, username, password):
+        return self.pfile.check(username, password, self.check)
 
 
 def main():
@@ -116,8 +316,6 @@ def main():
     else:
         passwdfile.update(username, password)
 
-    passwdfile.save()
-
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,278 @@
+from __future__ import with_statement
+import os
+import socket
+import threading
+import time
+import uuid
+
+import simplejson
+import sqlalchemy as sa
+
+from clue.relmgr import metrics, model, utils
+from clue.relmgr.workers import WorkerPool
+
+
+def render_description(pypi, distro_id):
+    ses = pypi.sessionmaker()
+    distro = ses.query(model.SQLDistro).filter_by(distro_id=distro_id).first()
+    if distro is not None:
+        pypi.render_description(distro)
+
+
+def file_info(pypi, distro_id, files):
+    """Record the digests taken while uploading *files*, dicts with the
+    filename, size, md5 and sha256.  A file which changed size since is
+    left to be hashed when its info is first asked for.
+
+      >>> import shutil, tempfile
+      >>> from clue.relmgr import pypi as pypimod
+      >>> tmpdir = tempfile.mkdtemp()
+      >>> pypi = pypimod.PyPi(tmpdir, 'sqlite:///%s/pypi.db' % tmpdir,
+      ...                     storage_url='memory:')
+      >>> pypi.storage.store('foo', utils.StringContent('foo-1.0.zip', 'abc'))
+      >>> file_info(pypi, 'foo', [{'filename': 'foo-1.0.zip', 'size': 3,
+      ...                          'md5': 'md5', 'sha256': 'sha256'}])
+      >>> print pypi.load_file_info('foo', 'foo-1.0.zip')['md5']
+      md5
+      >>> shutil.rmtree(tmpdir)
+    """
+
+    for info in files:
+        stat = pypi.storage.stat(distro_id, info['filename'])
+        if stat is not None and stat.size == info['size']:
+            pypi.save_file_info(distro_id, info['filename'],
+                                info['md5'], info['sha256'])
+
+
+# the post-processing tasks by name, each gets called with the PyPi
+# instance, the distro_id and the job's keyword arguments
+TASKS = {
+    'render_description': render_description,
+    'file_info': file_info,
+    }
+
+
+def run_task(pypi, task, distro_id, tasks=TASKS, **kwargs):
+    tasks[task](pypi, distro_id, **kwargs)
+
+
+class JobQueue(object):
+    """Runs post-processing tasks on a pool of *workers* threads.  Jobs
+    are stored in the database until they completed, so jobs which were
+    pending when the server stopped are run by ``resume`` on the next
+    start.  A queue claims each job before running it, so processes
+    sharing the database never run the same job; a claim older than
+    *claim_timeout* seconds is taken to be left by a dead process.  A
+    failed job is retried after *retry_delay* seconds, doubled with every
+    attempt, and dropped after *max_attempts*.
+
+      >>> class StandInPyPi(object):
+      ...     pass
+      >>> pypi = StandInPyPi()
+      >>> pypi.sessionmaker = sessionmaker
+      >>> done = []
+      >>> tries = []
+      >>> def record(pypi, distro_id, value):
+      ...     done.append((distro_id, value))
+      >>> def fail(pypi, distro_id):
+      ...     tries.append(time.time())
+      ...     raise ValueError('bad')
+      >>> jobs = JobQueue(pypi, tasks={'record': record, 'fail': fail},
+      ...                 retry_delay=0.05)
+
+      >>> job_id = jobs.enqueue('record', 'foo', value=1)
+      >>> job_id = jobs.enqueue('fail', 'foo')
+      >>> jobs.join()
+      >>> done
+      [(u'foo', 1)]
+      >>> stats = jobs.stats()
+      >>> stats['pending'], stats['tasks']['record']['completed']
+      (0, 1)
+      >>> len(tries), stats['tasks']['fail']['failed']
+      (3, 1)
+      >>> tries[2] - tries[1] >= 0.1
+      True
+      >>> sessionmaker().query(model.SQLJob).count()
+      0
+
+    Jobs still in the database are picked up again, unless another
+    process claimed them.
+
+      >>> ses = sessionmaker()
+      >>> ses.add(model.SQLJob('record', 'bar', '{"value": 2}', time.time()))
+      >>> elsewhere = model.SQLJob('record', 'baz', '{"value": 3}',
+      ...                          time.time())
+      >>> elsewhere.owner, elsewhere.claimed = 'elsewhere', time.time()
+      >>> ses.add(elsewhere)
+      >>> ses.commit()
+      >>> jobs.resume()
+      1
+      >>> jobs.join()
+      >>> done[-1]
+      (u'bar', 2)
+      >>> [x.owner for x in sessionmaker().query(model.SQLJob)]
+      [u'elsewhere']
+    """
+
+    logger = utils.logger
+
+    def __init__(self, pypi, workers=2, max_attempts=3, tasks=TASKS,
+                 retry_delay=10, claim_timeout=600):
+        self.pypi = pypi
+        self.max_attempts = max_attempts
+        self.tasks = tasks
+        self.retry_delay = retry_delay
+        self.claim_timeout = claim_timeout
+        self.owner = '%s:%i:%s' % (socket.gethostname(), os.getpid(),
+                                   uuid.uuid4().hex)
+        self.pool = WorkerPool(workers, 'clue.relmgr-jobs')
+        self._lock = threading.Condition()
+        self._queued = set()
+        self.pending = 0
+        self.counts = {}
+        self.latency = {}
+
+    def enqueue(self, task, distro_id, **kwargs):
+        """Store a job running *task* for *distro_id* and queue it,
+        returns the id of the job.
+        """
+
+        if task not in self.tasks:
+            raise ValueError('No such task "%s"' % task)
+        ses = self.pypi.sessionmaker()
+        job = model.SQLJob(task, distro_id, simplejson.dumps(kwargs),
+                           time.time())
+        ses.add(job)
+        ses.commit()
+        self._submit(job.job_id)
+        return job.job_id
+
+    def resume(self):
+        """Queue the jobs left in the database which no running process
+        has claimed, returns their number.
+        """
+
+        now = time.time()
+        job = model.SQLJob
+        ses = self.pypi.sessionmaker()
+        q = ses.query(job.job_id, job.not_before)
+        q = q.filter(sa.or_(job.owner == None,
+                            job.claimed < now - self.claim_timeout))
+        rows = q.order_by(job.job_id).all()
+        for job_id, not_before in rows:
+            self._submit(job_id, (not_before or now) - now)
+        if rows:
+            self.logger.info('Resuming %i pending job(s)' % len(rows))
+        return len(rows)
+
+    def _submit(self, job_id, delay=0):
+        with self._lock:
+            if job_id in self._queued:
+                return
+            self._queued.add(job_id)
+            self.pending += 1
+        self._schedule(job_id, delay)
+
+    def _schedule(self, job_id, delay):
+        if delay > 0:
+            timer = threading.Timer(delay, self.pool.submit,
+                                    [self._run, job_id])
+            timer.setDaemon(True)
+            timer.start()
+        else:
+            self.pool.submit(self._run, job_id)
+
+    def _claim(self, ses, job_id):
+        # a single conditional update, so only one queue gets the job
+        now = time.time()
+        table = model.SQLJob.__table__
+        res = ses.execute(table.update(
+            sa.and_(table.c.job_id == job_id,
+                    sa.or_(table.c.owner == None,
+                           table.c.owner == self.owner,
+                           table.c.claimed < now - self.claim_timeout)),
+            values={'owner': self.owner, 'claimed': now}))
+        ses.commit()
+        return res.rowcount == 1
+
+    def _run(self, job_id):
+        retrying = False
+        try:
+            ses = self.pypi.sessionmaker()
+            if not self._claim(ses, job_id):
+                self.logger.debug('Job %i is gone or claimed elsewhere'
+                                  % job_id)
+                return
+            job = ses.query(model.SQLJob).filter_by(job_id=job_id).first()
+            if job.task not in self.tasks:
+                self.logger.error('Dropping job %i of unknown task "%s"'
+                                  % (job_id, job.task))
+                self._record(job, 'failed')
+                ses.delete(job)
+                ses.commit()
+                return
+            kwargs = dict([(str(k), v) for k, v in
+                           simplejson.loads(job.payload or '{}').items()])
+            try:
+                run_task(self.pypi, job.task, job.distro_id, self.tasks,
+                         **kwargs)
+            except Exception:
+                # whatever the task left in the session must not keep
+                # the failure from being recorded
+                ses.rollback()
+                job.attempts = (job.attempts or 0) + 1
+                self.logger.exception('Job %i (%s for "%s") failed, attempt '
+                                      '%i of %i' % (job_id, job.task,
+                                                    job.distro_id,
+                                                    job.attempts,
+                                                    self.max_attempts))
+                if job.attempts >= self.max_attempts:
+                    self._record(job, 'failed')
+                    ses.delete(job)
+                    ses.commit()
+                    return
+                delay = self.retry_delay * 2 ** (job.attempts - 1)
+                job.not_before = time.time() + delay
+                job.owner = None
+                ses.commit()
+                self._schedule(job_id, delay)
+                retrying = True
+                return
+            self._record(job, 'completed')
+            ses.delete(job)
+            ses.commit()
+        finally:
+            if not retrying:
+                with self._lock:
+                    self._queued.discard(job_id)
+                    self.pending -= 1
+                    self._lock.notifyAll()
+
+    def _record(self, job, status):
+        with self._lock:
+            key = (job.task, status)
+            self.counts[key] = self.counts.get(key, 0) + 1
+            histogram = self.latency.get(job.task)
+            if histogram is None:
+                histogram = self.latency[job.task] = metrics.Histogram()
+            histogram.observe(time.time() - job.created)
+
+    def join(self):
+        """Block until all queued jobs have been run, including their
+        retries.
+        """
+
+        with self._lock:
+            while self.pending:
+                self._lock.wait()
+
+    def stats(self):
+        with self._lock:
+            tasks = {}
+            for (task, status), count in self.counts.items():
+                tasks.setdefault(task, {'completed': 0, 'failed': 0})
+                tasks[task][status] = count
+            for task, histogram in self.latency.items():
+                tasks[task]['latency_count'] = histogram.count
+                tasks[task]['latency_sum'] = histogram.sum
+            return {'pending': self.pending, 'tasks': tasks}
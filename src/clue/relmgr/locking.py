@@ -0,0 +1,181 @@
+from __future__ import with_statement
+import hashlib
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class FileLock(object):
+    """An exclusive lock on *path* shared between threads and processes.
+
+      >>> import tempfile, shutil
+      >>> tmpdir = tempfile.mkdtemp()
+      >>> lock1 = FileLock(os.path.join(tmpdir, 'foo.lock'))
+      >>> lock2 = FileLock(os.path.join(tmpdir, 'foo.lock'))
+      >>> lock1.acquire()
+      True
+      >>> lock2.acquire(blocking=False)
+      False
+      >>> lock1.release()
+      >>> with lock2:
+      ...     lock1.acquire(blocking=False)
+      False
+      >>> shutil.rmtree(tmpdir)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._f = None
+        # only used where fcntl isn't available, locking is then limited
+        # to the current process
+        self._lock = _process_lock(path)
+
+    def acquire(self, blocking=True):
+        if fcntl is None:
+            return self._lock.acquire(blocking)
+
+        lockdir = os.path.dirname(self.path)
+        if lockdir and not os.path.exists(lockdir):
+            try:
+                os.makedirs(lockdir)
+            except OSError:
+                # somebody else just created it
+                pass
+        f = open(self.path, 'a')
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(f.fileno(), flags)
+        except IOError:
+            f.close()
+            return False
+        self._f = f
+        return True
+
+    def release(self):
+        if fcntl is None:
+            self._lock.release()
+            return
+
+        f, self._f = self._f, None
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+_process_locks = {}
+_process_locks_lock = threading.Lock()
+
+
+def _process_lock(path):
+    with _process_locks_lock:
+        lock = _process_locks.get(path)
+        if lock is None:
+            lock = _process_locks[path] = threading.Lock()
+        return lock
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """Makes sure only one call per key runs at a time.  Callers arriving
+    while a call for their key is running wait for it and share its
+    result.
+
+      >>> flight = SingleFlight()
+      >>> started = threading.Event()
+      >>> proceed = threading.Event()
+      >>> calls = []
+      >>> def fetch(x):
+      ...     calls.append(x)
+      ...     started.set()
+      ...     proceed.wait()
+      ...     return x * 2
+
+      >>> results = []
+      >>> leader = threading.Thread(
+      ...     target=lambda: results.append(flight.do('a', fetch, 21)))
+      >>> leader.start()
+      >>> ignored = started.wait()
+      >>> follower = threading.Thread(
+      ...     target=lambda: results.append(flight.do('a', fetch, 21)))
+      >>> follower.start()
+      >>> import time
+      >>> while flight.waiters('a') < 1:
+      ...     time.sleep(0.01)
+      >>> proceed.set()
+      >>> leader.join(); follower.join()
+      >>> results, calls
+      ([42, 42], [21])
+
+    When a *lockdir* is given the calls are also serialized between
+    processes using lock files, callers should then check whether the
+    work has already been done by another process.
+    """
+
+    def __init__(self, lockdir=None):
+        self.lockdir = lockdir
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def lock_path(self, key):
+        return os.path.join(self.lockdir,
+                            hashlib.sha1(repr(key)).hexdigest() + '.lock')
+
+    def waiters(self, key):
+        """The number of callers waiting for the call for *key*."""
+
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                return 0
+            return call.waiters
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            try:
+                if self.lockdir is None:
+                    call.result = func(*args, **kwargs)
+                else:
+                    with FileLock(self.lock_path(key)):
+                        call.result = func(*args, **kwargs)
+            except Exception, err:
+                call.error = err
+                raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
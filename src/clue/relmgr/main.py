@@ -3,12 +3,13 @@ import optparse
 import os
 import sys
 
-import pkg_resources
 import werkzeug
 from werkzeug import _internal
 
 from clue.relmgr import utils, wsgiapp
 
+pkg_resources = utils.LazyModule('pkg_resources')
+
 
 class Runner(object):
     DEFAULT_HOST = '0.0.0.0'
@@ -56,6 +57,92 @@ class Runner(object):
                                 'queried if the user browsing this server has '
                                 'the adddistro role and the this server will '
                                 'be updated with all metadata and files.'))
+        parser.add_option('--template-cache-dir', dest='template_cache_dir',
+                          help=('Directory to store compiled templates in, '
+                                'defaults to the system temp directory'),
+                          default=None)
+        parser.add_option('--mirror-workers', dest='mirror_workers',
+                          type='int',
+                          help=('Number of threads downloading files from '
+                                'backup indexes, defaults to 4'),
+                          default=4)
+        parser.add_option('--mirror-miss-ttl', dest='mirror_miss_ttl',
+                          type='int',
+                          help=('Seconds to remember that a backup index '
+                                'does not have a distro, defaults to 3600'),
+                          default=3600)
+        parser.add_option('--persist-mirror-misses',
+                          dest='persist_mirror_misses',
+                          action='store_true',
+                          help=('Store backup index misses in the database '
+                                'so they are shared between processes'),
+                          default=False)
+        parser.add_option('--mirror-max-releases',
+                          dest='mirror_max_releases',
+                          type='int',
+                          help=('Only mirror files of the latest N releases '
+                                'of a distro, defaults to all releases'),
+                          default=None)
+        parser.add_option('--mirror-pull-through',
+                          dest='mirror_pull_through',
+                          action='store_true',
+                          help=('Only fetch files from backup indexes when '
+                                'they are first requested'),
+                          default=False)
+        parser.add_option('--storage-layout', dest='storage_layout',
+                          choices=['directory', 'hashed'],
+                          help=('How files are stored in a new basefiledir, '
+                                'either "directory" (the default) or '
+                                '"hashed" to store identical files once in '
+                                'a sharded tree'),
+                          default=None)
+        parser.add_option('--no-gzip', dest='gzip_responses',
+                          action='store_false',
+                          help=('Do not gzip responses, e.g. when a front '
+                                'end server already does'),
+                          default=True)
+        parser.add_option('--storage', dest='storage_url',
+                          help=('Store files elsewhere than in the '
+                                'basefiledir, either "memory:" or an S3 '
+                                'bucket as "s3://bucket/prefix" or '
+                                '"s3+http://host:port/bucket/prefix"'),
+                          default=None)
+        parser.add_option('--no-metrics', dest='collect_metrics',
+                          action='store_false',
+                          help=('Do not collect the request, SQL and cache '
+                                'metrics served at /metrics'),
+                          default=True)
+        parser.add_option('--profile-dir', dest='profile_dir',
+                          help=('Store profiles of requests in this '
+                                'directory, managers can have a request '
+                                'profiled by sending an X-Clue-Profile '
+                                'header'),
+                          default=None)
+        parser.add_option('--profile-sample-rate', dest='profile_sample_rate',
+                          type='float',
+                          help=('Fraction of all requests to profile when '
+                                'a --profile-dir is given, defaults to 0'),
+                          default=0.0)
+        parser.add_option('--trace-malloc', dest='trace_malloc',
+                          type='int',
+                          help=('Trace memory allocations with tracemalloc '
+                                'keeping this many frames, the allocation '
+                                'sites are then reported at /memory; needs '
+                                'a Python providing tracemalloc (e.g. a '
+                                'pytracemalloc build), otherwise only a '
+                                'warning is logged'),
+                          default=0)
+        parser.add_option('--auth-cache-ttl', dest='auth_cache_ttl',
+                          type='int',
+                          help=('Seconds to remember successful logins, '
+                                'defaults to 60, 0 checks every request'),
+                          default=60)
+        parser.add_option('--job-workers', dest='job_workers',
+                          type='int',
+                          help=('Threads post-processing uploads, e.g. '
+                                'rendering descriptions, defaults to 2, '
+                                '0 does it while handling the upload'),
+                          default=2)
 
         if args is None:
             args = []
@@ -84,7 +171,22 @@ class Runner(object):
             self_register=options.self_register,
             backup_pypis=options.backup_pypis,
             logger=utils.logger,
-            debug=options.debug or False)
+            debug=options.debug or False,
+            template_cache_dir=options.template_cache_dir,
+            mirror_workers=options.mirror_workers,
+            mirror_miss_ttl=options.mirror_miss_ttl,
+            persist_mirror_misses=options.persist_mirror_misses,
+            mirror_max_releases=options.mirror_max_releases,
+            mirror_pull_through=options.mirror_pull_through,
+            storage_layout=options.storage_layout,
+            storage_url=options.storage_url,
+            gzip_responses=options.gzip_responses,
+            collect_metrics=options.collect_metrics,
+            profile_dir=options.profile_dir,
+            profile_sample_rate=options.profile_sample_rate,
+            trace_malloc=options.trace_malloc,
+            auth_cache_ttl=options.auth_cache_ttl,
+            job_workers=options.job_workers)
 
         if options.debug:
             app = werkzeug.DebuggedApplication(app, evalex=True)
@@ -92,6 +194,9 @@ class Runner(object):
         _internal._logger = utils.werklogger
 
         pypiapp.pypi.setup_model()
+        # fail right away, not on the first upload, if the storage can't
+        # be used as configured
+        pypiapp.pypi.storage
         if os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
             if options.debug:
                 utils.logger.info('Database initialized')
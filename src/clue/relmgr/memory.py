@@ -0,0 +1,175 @@
+from __future__ import with_statement
+import gc
+import sys
+import threading
+import time
+
+from sqlalchemy.orm import attributes, session as ormsession
+
+from clue.relmgr import utils
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def _type_name(ob):
+    t = type(ob)
+    module = getattr(t, '__module__', None)
+    if module in (None, '__builtin__', 'builtins'):
+        return t.__name__
+    return '%s.%s' % (module, t.__name__)
+
+
+def type_counts():
+    """The number of objects tracked by the garbage collector, by type.
+
+      >>> class Leaky(object):
+      ...     pass
+      >>> keep = [Leaky() for x in range(3)]
+      >>> type_counts()['clue.relmgr.memory.Leaky']
+      3
+    """
+
+    counts = {}
+    for ob in gc.get_objects():
+        name = _type_name(ob)
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def category_counts():
+    """The number of live ORM instances, sessions and templates.
+
+      >>> from clue.relmgr import model
+      >>> before = category_counts()
+      >>> distros = [model.SQLDistro() for x in range(2)]
+      >>> after = category_counts()
+      >>> after['orm_instances'] - before['orm_instances']
+      2
+      >>> sorted(after)
+      ['orm_instances', 'sessions', 'templates']
+    """
+
+    counts = {'orm_instances': 0, 'sessions': 0, 'templates': 0}
+    # no templates can exist before jinja2 got imported
+    jinja2 = sys.modules.get('jinja2')
+    mapped = {}
+    for ob in gc.get_objects():
+        t = type(ob)
+        if t not in mapped:
+            try:
+                mapped[t] = attributes.manager_of_class(t) is not None
+            except Exception:
+                mapped[t] = False
+        if mapped[t]:
+            counts['orm_instances'] += 1
+        elif isinstance(ob, ormsession.Session):
+            counts['sessions'] += 1
+        elif jinja2 is not None and isinstance(ob, jinja2.Template):
+            counts['templates'] += 1
+    return counts
+
+
+def _top_growth(old, new, limit):
+    growth = [(name, count - old.get(name, 0))
+              for name, count in new.items()
+              if count > old.get(name, 0)]
+    growth.sort(key=lambda x: (-x[1], x[0]))
+    return [{'type': name, 'count': new[name], 'growth': diff}
+            for name, diff in growth[:limit]]
+
+
+class MemoryTracker(object):
+    """Takes snapshots of the objects alive in the process and reports
+    how they changed since the previous one.  With tracemalloc available
+    and *frames* greater than 0 the top allocation sites are reported as
+    well.  tracemalloc comes with Python 3.4 and later, on Python 2 only
+    with a pytracemalloc build, asking for *frames* without it logs a
+    warning.
+
+      >>> tracker = MemoryTracker()
+      >>> tracker.snapshot()
+      >>> class Leaky(object):
+      ...     pass
+      >>> keep = [Leaky() for x in range(5)]
+      >>> report = tracker.report()
+      >>> [x for x in report['growth']
+      ...  if x['type'] == 'clue.relmgr.memory.Leaky']
+      [{'count': 5, 'growth': 5, 'type': 'clue.relmgr.memory.Leaky'}]
+      >>> sorted(report['categories'])
+      ['orm_instances', 'sessions', 'templates']
+    """
+
+    logger = utils.logger
+
+    def __init__(self, frames=0, keep=10):
+        if frames and tracemalloc is None:
+            self.logger.warn('Not tracing allocations, this Python has no '
+                             'tracemalloc module; only object counts are '
+                             'reported')
+        elif frames and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.keep = keep
+        self.snapshots = []
+        self._lock = threading.Lock()
+
+    @property
+    def tracing(self):
+        return tracemalloc is not None and tracemalloc.is_tracing()
+
+    def _take(self):
+        traced = None
+        if self.tracing:
+            traced = tracemalloc.take_snapshot()
+        gc.collect()
+        return {'time': time.time(),
+                'types': type_counts(),
+                'traced': traced}
+
+    def snapshot(self):
+        snap = self._take()
+        with self._lock:
+            self.snapshots.append(snap)
+            del self.snapshots[:-self.keep]
+
+    def report(self, limit=20):
+        """The current object counts and, compared to the latest
+        snapshot, the types which grew the most.
+        """
+
+        current = self._take()
+        with self._lock:
+            previous = self.snapshots and self.snapshots[-1] or None
+
+        types = sorted(current['types'].items(),
+                       key=lambda x: (-x[1], x[0]))[:limit]
+        res = {'time': current['time'],
+               'tracing': self.tracing,
+               'snapshots': len(self.snapshots),
+               'categories': category_counts(),
+               'types': [{'type': name, 'count': count}
+                         for name, count in types]}
+        if previous is not None:
+            res['since'] = previous['time']
+            res['growth'] = _top_growth(previous['types'],
+                                        current['types'], limit)
+            if previous['traced'] is not None and \
+                   current['traced'] is not None:
+                stats = current['traced'].compare_to(previous['traced'],
+                                                     'lineno')
+                res['allocations'] = [
+                    {'site': str(x.traceback),
+                     'size': x.size,
+                     'size_diff': x.size_diff,
+                     'count': x.count,
+                     'count_diff': x.count_diff}
+                    for x in stats[:limit]]
+        elif current['traced'] is not None:
+            stats = current['traced'].statistics('lineno')
+            res['allocations'] = [{'site': str(x.traceback),
+                                   'size': x.size,
+                                   'count': x.count}
+                                  for x in stats[:limit]]
+        return res
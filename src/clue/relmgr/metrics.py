@@ -0,0 +1,304 @@
+from __future__ import with_statement
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n') \
+           .replace('"', '\\"')
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, _escape(v))
+                              for k, v in sorted(labels.items())])
+
+
+def _number(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+class Histogram(object):
+    """Counts observations in cumulative buckets.
+
+      >>> h = Histogram((0.1, 1.0))
+      >>> h.observe(0.05)
+      >>> h.observe(0.5)
+      >>> h.observe(3)
+      >>> h.cumulative()
+      [(0.1, 1), (1.0, 2), (inf, 3)]
+      >>> h.count, h.sum
+      (3, 3.55)
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for x, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[x] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        res = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            res.append((bound, total))
+        return res
+
+
+class Metrics(object):
+    """Per-endpoint request metrics, rendered in the Prometheus text
+    exposition format.
+
+      >>> m = Metrics(buckets=(0.1,))
+      >>> m.record('simple', '200', 0.05, 1024, 2, 0.001)
+      >>> m.record('simple', '404', 0.2, 10, 1, 0.001)
+      >>> print m.render({'distro_pages': {'hits': 3, 'misses': 1}}).strip()
+      # HELP cluerelmgr_requests_total Requests handled.
+      # TYPE cluerelmgr_requests_total counter
+      cluerelmgr_requests_total{endpoint="simple",status="200"} 1
+      cluerelmgr_requests_total{endpoint="simple",status="404"} 1
+      # HELP cluerelmgr_request_duration_seconds Time spent handling requests.
+      # TYPE cluerelmgr_request_duration_seconds histogram
+      cluerelmgr_request_duration_seconds_bucket{endpoint="simple",le="0.1"} 1
+      cluerelmgr_request_duration_seconds_bucket{endpoint="simple",le="+Inf"} 2
+      cluerelmgr_request_duration_seconds_sum{endpoint="simple"} 0.25
+      cluerelmgr_request_duration_seconds_count{endpoint="simple"} 2
+      # HELP cluerelmgr_response_bytes_total Response body bytes served, before compression.
+      # TYPE cluerelmgr_response_bytes_total counter
+      cluerelmgr_response_bytes_total{endpoint="simple"} 1034
+      # HELP cluerelmgr_sql_queries_total SQL statements executed.
+      # TYPE cluerelmgr_sql_queries_total counter
+      cluerelmgr_sql_queries_total{endpoint="simple"} 3
+      # HELP cluerelmgr_sql_query_seconds_total Time spent executing SQL statements.
+      # TYPE cluerelmgr_sql_query_seconds_total counter
+      cluerelmgr_sql_query_seconds_total{endpoint="simple"} 0.002
+      # HELP cluerelmgr_cache_hits_total Cache hits.
+      # TYPE cluerelmgr_cache_hits_total counter
+      cluerelmgr_cache_hits_total{cache="distro_pages"} 3
+      # HELP cluerelmgr_cache_misses_total Cache misses.
+      # TYPE cluerelmgr_cache_misses_total counter
+      cluerelmgr_cache_misses_total{cache="distro_pages"} 1
+      # HELP cluerelmgr_cache_hit_ratio Cache hits divided by lookups.
+      # TYPE cluerelmgr_cache_hit_ratio gauge
+      cluerelmgr_cache_hit_ratio{cache="distro_pages"} 0.75
+    """
+
+    prefix = 'cluerelmgr_'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.durations = {}
+        self.bytes = {}
+        self.sql_queries = {}
+        self.sql_time = {}
+
+    def record(self, endpoint, status, duration, size, sql_queries=0,
+               sql_time=0.0):
+        with self._lock:
+            key = (endpoint, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.durations.get(endpoint)
+            if histogram is None:
+                histogram = self.durations[endpoint] = \
+                            Histogram(self.buckets)
+            histogram.observe(duration)
+            self.bytes[endpoint] = self.bytes.get(endpoint, 0) + size
+            self.sql_queries[endpoint] = \
+                self.sql_queries.get(endpoint, 0) + sql_queries
+            self.sql_time[endpoint] = \
+                self.sql_time.get(endpoint, 0.0) + sql_time
+
+    def render(self, cache_stats=None, jobs=None):
+        """The metrics in the Prometheus text format, along with the hit
+        rates of *cache_stats* and the depth, outcomes and latency of the
+        jobs of *jobs* (a ``clue.relmgr.jobs.JobQueue``) if given.
+        """
+
+        lines = []
+
+        def header(name, kind, help):
+            lines.append('# HELP %s%s %s' % (self.prefix, name, help))
+            lines.append('# TYPE %s%s %s' % (self.prefix, name, kind))
+
+        def sample(name, value, **labels):
+            lines.append('%s%s%s %s' % (self.prefix, name, _labels(**labels),
+                                        _number(value)))
+
+        with self._lock:
+            header('requests_total', 'counter', 'Requests handled.')
+            for (endpoint, status), count in sorted(self.requests.items()):
+                sample('requests_total', count, endpoint=endpoint,
+                       status=status)
+
+            header('request_duration_seconds', 'histogram',
+                   'Time spent handling requests.')
+            for endpoint, histogram in sorted(self.durations.items()):
+                for bound, count in histogram.cumulative():
+                    sample('request_duration_seconds_bucket', count,
+                           endpoint=endpoint, le=_number(float(bound)))
+                sample('request_duration_seconds_sum', histogram.sum,
+                       endpoint=endpoint)
+                sample('request_duration_seconds_count', histogram.count,
+                       endpoint=endpoint)
+
+            for name, kind, help, values in [
+                ('response_bytes_total', 'counter',
+                 'Response body bytes served, before compression.',
+                 self.bytes),
+                ('sql_queries_total', 'counter', 'SQL statements executed.',
+                 self.sql_queries),
+                ('sql_query_seconds_total', 'counter',
+                 'Time spent executing SQL statements.', self.sql_time)]:
+                header(name, kind, help)
+                for endpoint, value in sorted(values.items()):
+                    sample(name, value, endpoint=endpoint)
+
+        if cache_stats:
+            caches = sorted(cache_stats.items())
+            header('cache_hits_total', 'counter', 'Cache hits.')
+            for name, stats in caches:
+                sample('cache_hits_total', stats['hits'], cache=name)
+            header('cache_misses_total', 'counter', 'Cache misses.')
+            for name, stats in caches:
+                sample('cache_misses_total', stats['misses'], cache=name)
+            header('cache_hit_ratio', 'gauge',
+                   'Cache hits divided by lookups.')
+            for name, stats in caches:
+                lookups = stats['hits'] + stats['misses']
+                ratio = lookups and float(stats['hits']) / lookups or 0.0
+                sample('cache_hit_ratio', ratio, cache=name)
+
+        if jobs is not None:
+            stats = jobs.stats()
+            header('jobs_pending', 'gauge',
+                   'Jobs queued, running or waiting to be retried.')
+            sample('jobs_pending', stats['pending'])
+            header('jobs_total', 'counter', 'Jobs run, by outcome.')
+            for task, counts in sorted(stats['tasks'].items()):
+                for status in ('completed', 'failed'):
+                    sample('jobs_total', counts[status], task=task,
+                           status=status)
+            header('job_latency_seconds', 'histogram',
+                   'Time from queueing a job until it finished.')
+            for task, histogram in sorted(jobs.latency.items()):
+                for bound, count in histogram.cumulative():
+                    sample('job_latency_seconds_bucket', count, task=task,
+                           le=_number(float(bound)))
+                sample('job_latency_seconds_sum', histogram.sum, task=task)
+                sample('job_latency_seconds_count', histogram.count,
+                       task=task)
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware(object):
+    """Records every request handled by *app* in *metrics*, under the
+    name *endpoint_for* returns for its environ.  The SQL statements of
+    a request are counted with the thread-local counters of *sql_stats*
+    (a ``clue.relmgr.sqlstats.QueryStats``).  A request is recorded once
+    its body has been sent or closed, so streamed bodies are accounted
+    for.
+
+      >>> def app(environ, start_response):
+      ...     start_response('200 OK', [('Content-Type', 'text/plain')])
+      ...     return ['abc', 'de']
+      >>> metrics = Metrics()
+      >>> mw = MetricsMiddleware(app, metrics,
+      ...                        lambda environ: environ['PATH_INFO'])
+      >>> def start(status, headers, exc_info=None):
+      ...     pass
+      >>> body = mw({'PATH_INFO': 'foo'}, start)
+      >>> list(body)
+      ['abc', 'de']
+      >>> body.close()
+      >>> metrics.requests, metrics.bytes
+      ({('foo', '200'): 1}, {'foo': 5})
+    """
+
+    def __init__(self, app, metrics, endpoint_for, sql_stats=None):
+        self.app = app
+        self.metrics = metrics
+        self.endpoint_for = endpoint_for
+        self.sql_stats = sql_stats
+
+    def __call__(self, environ, start_response):
+        started = time.time()
+        if self.sql_stats is not None:
+            self.sql_stats.reset_local()
+        state = {'status': '500', 'size': 0}
+
+        def start(status, headers, exc_info=None):
+            state['status'] = status.split(' ', 1)[0]
+            write = start_response(status, headers, exc_info)
+
+            def counting_write(data):
+                state['size'] += len(data)
+                return write(data)
+            return counting_write
+
+        try:
+            app_iter = self.app(environ, start)
+        except:
+            self.finish(environ, started, state)
+            raise
+        return _RecordingIterable(app_iter, self, environ, started, state)
+
+    def finish(self, environ, started, state):
+        sql_queries = 0
+        sql_time = 0.0
+        if self.sql_stats is not None:
+            sql_queries = self.sql_stats.local_count()
+            sql_time = self.sql_stats.local_time()
+        self.metrics.record(self.endpoint_for(environ), state['status'],
+                            time.time() - started, state['size'],
+                            sql_queries, sql_time)
+
+
+class _RecordingIterable(object):
+
+    def __init__(self, app_iter, middleware, environ, started, state):
+        self.app_iter = app_iter
+        self.middleware = middleware
+        self.environ = environ
+        self.started = started
+        self.state = state
+        self.finished = False
+
+    def __iter__(self):
+        for data in self.app_iter:
+            self.state['size'] += len(data)
+            yield data
+        self.finish()
+
+    def finish(self):
+        if not self.finished:
+            self.finished = True
+            self.middleware.finish(self.environ, self.started, self.state)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.finish()
@@ -0,0 +1,515 @@
+from __future__ import with_statement
+import datetime
+import os
+import tempfile
+import threading
+import urllib2
+import xmlrpclib
+
+from clue.relmgr import cache, model, utils
+from clue.relmgr.locking import FileLock, SingleFlight
+from clue.relmgr.pypi import active_info
+from clue.relmgr.workers import WorkerPool
+
+pkg_resources = utils.LazyModule('pkg_resources')
+
+MULTICALL_BATCH_SIZE = 50
+
+
+def _multicall(server, calls, batch_size=MULTICALL_BATCH_SIZE):
+    """Run *calls*, a list of (method name, args) tuples, using as few
+    round trips as possible.  Falls back to one call at a time if the
+    server has no ``system.multicall`` support.
+    """
+
+    results = []
+    for pos in range(0, len(calls), batch_size):
+        batch = calls[pos:pos+batch_size]
+        multicall = xmlrpclib.MultiCall(server)
+        for methodname, args in batch:
+            getattr(multicall, methodname)(*args)
+        try:
+            results += list(multicall())
+        except xmlrpclib.Fault:
+            utils.logger.debug('No multicall support, making %i separate '
+                               'calls' % len(calls))
+            return [getattr(server, methodname)(*args)
+                    for methodname, args in calls]
+    return results
+
+
+def _get_remote_info(pypi, distro_id, pypi_url, max_releases=None):
+    """Look up *distro_id* on the index at *pypi_url* returning its name,
+    the metadata of its latest release and the urls of the files of
+    (at most *max_releases* of) its releases.
+
+      >>> from clue.relmgr.tests import StandInIndex
+      >>> index = StandInIndex({'Foo': ['1.0', '1.2', '1.1']})
+      >>> name, data, urls = _get_remote_info(None, 'foo', index.url)
+      >>> name, data['version']
+      ('Foo', '1.2')
+      >>> [x[1]['filename'] for x in urls]
+      ['Foo-1.2.tar.gz', 'Foo-1.1.tar.gz', 'Foo-1.0.tar.gz']
+
+    The per release calls are batched so only three round trips are
+    needed no matter how many releases there are.
+
+      >>> index.round_trips
+      3
+
+      >>> index.round_trips = 0
+      >>> name, data, urls = _get_remote_info(None, 'foo', index.url,
+      ...                                     max_releases=1)
+      >>> [x[1]['filename'] for x in urls]
+      ['Foo-1.2.tar.gz']
+      >>> _get_remote_info(None, 'bar', index.url) is None
+      True
+      >>> index.shutdown()
+
+    Indexes without multicall support get one call per release.
+
+      >>> index = StandInIndex({'Foo': ['1.0', '1.1']}, multicall=False)
+      >>> name, data, urls = _get_remote_info(None, 'foo', index.url)
+      >>> len(urls), index.round_trips
+      (2, 6)
+      >>> index.shutdown()
+    """
+
+    server = xmlrpclib.Server(pypi_url)
+    res = server.search({'name': distro_id})
+    match = None
+    wanted = utils.normalize_name(distro_id)
+    for x in res:
+        if utils.normalize_name(x['name']) == wanted:
+            match = x
+            break
+
+    if not match:
+        return None
+
+    name = match['name']
+    releases = server.package_releases(name)
+    if not releases:
+        return None
+    # latest releases first
+    releases.sort(key=pkg_resources.parse_version, reverse=True)
+    if max_releases:
+        releases = releases[:max_releases]
+
+    calls = [('release_data', (name, releases[0]))]
+    calls += [('release_urls', (name, rel)) for rel in releases]
+    results = _multicall(server, calls)
+
+    data = results[0]
+    urls = []
+    for rel, relurls in zip(releases, results[1:]):
+        urls += [(rel, x) for x in relurls]
+
+    kwargs = dict(data)
+    if kwargs.get('classifiers'):
+        kwargs['classifiers'] = \
+            u'\n'.join(kwargs['classifiers'])
+
+    return (name, kwargs, urls)
+
+
+class MissCache(object):
+    """Remembers which distros a backup index does not have, for *ttl*
+    seconds.
+
+      >>> misses = MissCache(ttl=60)
+      >>> misses.is_missing('http://backup/pypi', 'foo')
+      False
+      >>> misses.add('http://backup/pypi', 'foo')
+      >>> misses.is_missing('http://backup/pypi', 'foo')
+      True
+      >>> misses.is_missing('http://other/pypi', 'foo')
+      False
+
+    With a *sessionmaker* the misses are also stored in the database so
+    they are shared between processes and survive restarts.  Entries are
+    then only kept in memory for up to *local_ttl* seconds, so flushing the
+    database takes effect in running servers soon after.
+
+      >>> misses = MissCache(ttl=60, sessionmaker=sessionmaker)
+      >>> misses.add('http://backup/pypi', 'foo')
+      >>> MissCache(sessionmaker=sessionmaker).is_missing(
+      ...     'http://backup/pypi', 'foo')
+      True
+      >>> misses.flush()
+      1
+      >>> MissCache(sessionmaker=sessionmaker).is_missing(
+      ...     'http://backup/pypi', 'foo')
+      False
+    """
+
+    def __init__(self, ttl=3600, sessionmaker=None, maxsize=10000,
+                 local_ttl=60):
+        self.ttl = ttl
+        self.sessionmaker = sessionmaker
+        if sessionmaker is not None:
+            local_ttl = min(ttl, local_ttl)
+        else:
+            local_ttl = ttl
+        self.local = cache.TTLCache(maxsize, local_ttl)
+
+    def is_missing(self, pypi_url, distro_id):
+        key = (pypi_url, distro_id)
+        if self.local.get(key):
+            return True
+        if self.sessionmaker is None:
+            return False
+
+        ses = self.sessionmaker()
+        q = ses.query(model.SQLMirrorMiss)
+        miss = q.filter_by(pypi_url=pypi_url, distro_id=distro_id).first()
+        if miss is None or miss.expires <= datetime.datetime.now():
+            return False
+        self.local.set(key, True)
+        return True
+
+    def add(self, pypi_url, distro_id):
+        self.local.set((pypi_url, distro_id), True)
+        if self.sessionmaker is None:
+            return
+
+        ses = self.sessionmaker()
+        q = ses.query(model.SQLMirrorMiss)
+        miss = q.filter_by(pypi_url=pypi_url, distro_id=distro_id).first()
+        if miss is None:
+            miss = model.SQLMirrorMiss(pypi_url, distro_id)
+            ses.add(miss)
+        miss.expires = datetime.datetime.now() + \
+                       datetime.timedelta(seconds=self.ttl)
+        ses.commit()
+
+    def flush(self):
+        """Forget all misses, returns the number of stored entries
+        removed.
+        """
+
+        count = len(self.local)
+        self.local.clear()
+        if self.sessionmaker is not None:
+            ses = self.sessionmaker()
+            count = ses.query(model.SQLMirrorMiss).delete()
+            ses.commit()
+        return count
+
+
+class PullThroughFile(object):
+    """Iterates over the content at *url* while also writing it to the
+    storage *writer*.  The file is only stored once it has been read
+    completely, *on_complete* is then called.
+
+      >>> from clue.relmgr import storage
+      >>> tmpdir = tempfile.mkdtemp()
+      >>> source = os.path.join(tmpdir, 'source')
+      >>> with open(source, 'w') as f:
+      ...     f.write('abcdef')
+      >>> files = storage.MemoryStorage()
+
+      >>> completed = []
+      >>> res = PullThroughFile('file://' + source,
+      ...                       files.write('foo', 'foo-1.0.zip'),
+      ...                       lambda: completed.append(True), chunk_size=4)
+      >>> [x for x in res]
+      ['abcd', 'ef']
+      >>> res.close()
+      >>> files.open('foo', 'foo-1.0.zip').read(), completed
+      ('abcdef', [True])
+
+    Nothing is stored when the client goes away before the end.
+
+      >>> res = PullThroughFile('file://' + source,
+      ...                       files.write('foo', 'foo-2.0.zip'),
+      ...                       chunk_size=4)
+      >>> iter(res).next()
+      'abcd'
+      >>> res.close()
+      >>> files.list('foo')
+      ['memory:foo/foo-1.0.zip']
+      >>> import shutil
+      >>> shutil.rmtree(tmpdir)
+    """
+
+    def __init__(self, url, writer, on_complete=None, chunk_size=65536,
+                 lock=None):
+        self.url = url
+        self.writer = writer
+        self.on_complete = on_complete
+        self.chunk_size = chunk_size
+        self.lock = lock
+        self._iter = None
+
+    def __iter__(self):
+        if self._iter is None:
+            self._iter = self._read()
+        return self._iter
+
+    def _read(self):
+        opened = urllib2.urlopen(self.url)
+        try:
+            while True:
+                data = opened.read(self.chunk_size)
+                if not data:
+                    break
+                self.writer.write(data)
+                yield data
+        finally:
+            opened.close()
+
+        self.writer.close()
+        self._release()
+        if self.on_complete is not None:
+            self.on_complete()
+
+    def _release(self):
+        lock, self.lock = self.lock, None
+        if lock is not None:
+            lock.release()
+
+    def close(self):
+        if self._iter is not None:
+            self._iter.close()
+        self.writer.abort()
+        self._release()
+
+
+class Mirror(object):
+    """Falls back to backup indexes for distros that are not known
+    locally.  Metadata is fetched right away while release files are
+    downloaded by a pool of *workers* threads (or inline when *workers*
+    is 0).
+
+      >>> import os, tempfile, shutil
+      >>> tmpdir = tempfile.mkdtemp()
+      >>> fname = os.path.join(tmpdir, 'Foo-1.0.tar.gz')
+      >>> with open(fname, 'w') as f:
+      ...     f.write('foo')
+
+      >>> from clue.relmgr.pypi import get_active_user
+      >>> class MockPyPi(object):
+      ...     def __init__(self):
+      ...         self.metadata = []
+      ...         self.uploads = []
+      ...         self.stored = set()
+      ...     def get_active_user(self):
+      ...         return 'bob'
+      ...     def has_distro(self, distro_id):
+      ...         return False
+      ...     def stat_file(self, distro_id, filename):
+      ...         if (distro_id, filename) in self.stored:
+      ...             return os.stat(fname)
+      ...     def update_metadata(self, **kwargs):
+      ...         self.metadata.append(kwargs)
+      ...     def upload_files(self, name, content):
+      ...         self.uploads.append((get_active_user(),
+      ...                              name, content.filename))
+
+      >>> pypi = MockPyPi()
+      >>> mirror = Mirror(pypi, ['http://backup/pypi'], workers=2)
+      >>> def get_remote_info(distro_id, pypi_url):
+      ...     if distro_id != 'foo':
+      ...         return None
+      ...     return ('Foo', {'name': 'Foo'},
+      ...             [('1.0', {'filename': 'Foo-1.0.tar.gz',
+      ...                       'url': 'file://' + fname})])
+      >>> mirror.get_remote_info = get_remote_info
+
+      >>> mirror.update('bar')
+      False
+      >>> mirror.update('foo')
+      True
+
+    Misses are remembered so the backup index isn't asked again.
+
+      >>> mirror.misses.is_missing('http://backup/pypi', 'bar')
+      True
+      >>> flight, mirror.flight = mirror.flight, None
+      >>> mirror.update('bar')
+      False
+      >>> mirror.flight = flight
+      >>> pypi.metadata
+      [{'name': 'Foo'}]
+
+    The files are downloaded in the background, as the user who triggered
+    the update, and are reported as pending until then.
+
+      >>> mirror.get_pending('foo') in ([], [('Foo-1.0.tar.gz',
+      ...                                     'file://' + fname)])
+      True
+      >>> mirror.join()
+      >>> pypi.uploads
+      [('bob', 'Foo', 'Foo-1.0.tar.gz')]
+      >>> mirror.get_pending('foo')
+      []
+
+    In pull-through mode only the urls of the files are recorded, the
+    files get fetched when they are first requested.
+
+      >>> mirror = Mirror(pypi, ['http://backup/pypi'], pull_through=True)
+      >>> mirror.get_remote_info = get_remote_info
+      >>> pypi.add_remote_files = lambda name, urldicts: pypi.uploads.append(
+      ...     (name, [x['filename'] for x in urldicts]))
+      >>> mirror.update('foo')
+      True
+      >>> pypi.uploads[-1]
+      ('Foo', ['Foo-1.0.tar.gz'])
+
+    Fetching a file which has been stored meanwhile yields nothing, it can
+    be served from disk instead.
+
+      >>> class Remote(object):
+      ...     filename = 'Foo-1.0.tar.gz'
+      ...     url = 'file://' + fname
+      >>> pypi.stored.add(('foo', 'Foo-1.0.tar.gz'))
+      >>> mirror.fetch('foo', Remote()) is None
+      True
+
+      >>> shutil.rmtree(tmpdir)
+    """
+
+    logger = utils.logger
+
+    def __init__(self, pypi, backup_pypis, workers=4, misses=None,
+                 max_releases=None, pull_through=False, lockdir=None):
+        self.pypi = pypi
+        self.backup_pypis = backup_pypis
+        self.max_releases = max_releases
+        self.pull_through = pull_through
+        if lockdir is None:
+            lockdir = os.path.join(tempfile.gettempdir(), 'clue.relmgr-locks')
+        # concurrent requests for the same distro or file share one fetch
+        self.flight = SingleFlight(lockdir)
+        if misses is None:
+            misses = MissCache()
+        self.misses = misses
+        self.pool = None
+        if workers:
+            self.pool = WorkerPool(workers, 'clue.relmgr-mirror')
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get_remote_info(self, distro_id, pypi_url):
+        return _get_remote_info(self.pypi, distro_id, pypi_url,
+                                self.max_releases)
+
+    def update(self, distro_id):
+        """Mirror *distro_id* from the first backup index that has it,
+        returns False if none of them do.
+        """
+
+        # a known miss is answered before taking any lock or looking the
+        # distro up, _update checks again for misses recorded while it
+        # waited for the lock
+        for pypi_url in self.backup_pypis:
+            if not self.misses.is_missing(pypi_url, distro_id):
+                break
+        else:
+            return False
+
+        return self.flight.do(('distro', distro_id), self._update, distro_id)
+
+    def _update(self, distro_id):
+        # another process may have mirrored it while we waited for the lock
+        if self.pypi.has_distro(distro_id):
+            return True
+
+        for pypi_url in self.backup_pypis:
+            if self.misses.is_missing(pypi_url, distro_id):
+                continue
+            info = self.get_remote_info(distro_id, pypi_url)
+            if not info:
+                self.misses.add(pypi_url, distro_id)
+            else:
+                name, kwargs, urls = info
+
+                self.pypi.update_metadata(**kwargs)
+
+                if self.pull_through:
+                    self.pypi.add_remote_files(name,
+                                               [x for rel, x in urls])
+                    return True
+
+                username = self.pypi.get_active_user()
+                for rel, urldict in urls:
+                    self.enqueue(name, distro_id, urldict, username)
+
+                return True
+
+        return False
+
+    def enqueue(self, name, distro_id, urldict, username):
+        filename = urldict['filename']
+        with self._lock:
+            pending = self._pending.setdefault(distro_id, {})
+            if filename in pending:
+                return
+            pending[filename] = urldict['url']
+
+        if self.pool is None:
+            self.download(name, distro_id, urldict, username)
+        else:
+            self.pool.submit(self.download, name, distro_id, urldict,
+                             username)
+
+    def download(self, name, distro_id, urldict, username):
+        previous = getattr(active_info, 'username', None)
+        active_info.username = username
+        try:
+            self.flight.do(('file', distro_id, urldict['filename']),
+                           self._download, name, distro_id, urldict)
+        finally:
+            active_info.username = previous
+            with self._lock:
+                pending = self._pending.get(distro_id, {})
+                pending.pop(urldict['filename'], None)
+                if not pending:
+                    self._pending.pop(distro_id, None)
+
+    def fetch(self, distro_id, remote):
+        """Returns an iterable over the content of the *remote* file
+        which also stores it.  If another request is already fetching it
+        this waits for that to finish instead and returns None, the file
+        can then be read from storage.
+        """
+
+        lock = FileLock(self.flight.lock_path(('file', distro_id,
+                                               remote.filename)))
+        if not lock.acquire(blocking=False):
+            self.logger.debug('Waiting for "%s" to be fetched'
+                              % remote.filename)
+            lock.acquire()
+        if self.pypi.stat_file(distro_id, remote.filename) is not None:
+            lock.release()
+            return None
+
+        def fetched(pypi=self.pypi):
+            self.logger.debug('Fetched "%s" for "%s"'
+                              % (remote.filename, distro_id))
+            pypi.update_updated(distro_id)
+
+        writer = self.pypi.storage.write(distro_id, remote.filename)
+        return PullThroughFile(remote.url, writer, fetched, lock=lock)
+
+    def _download(self, name, distro_id, urldict):
+        filename = urldict['filename']
+        if self.pypi.stat_file(distro_id, filename) is not None:
+            return
+
+        content = utils.UrlContent(urldict['url'], filename)
+        self.pypi.upload_files(name, content)
+        self.logger.debug('Mirrored "%s" for "%s"' % (filename, distro_id))
+
+    def get_pending(self, distro_id):
+        """The (filename, url) pairs of *distro_id* which are still being
+        downloaded.
+        """
+
+        with self._lock:
+            return sorted(self._pending.get(distro_id, {}).items())
+
+    def join(self):
+        if self.pool is not None:
+            self.pool.join()
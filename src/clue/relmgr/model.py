@@ -9,6 +9,11 @@ from clue.relmgr import utils
 Base = declarative.declarative_base()
 metadata = Base.metadata
 
+schema_version_table = sa.Table(
+    'schema_version', metadata,
+    sa.Column('version', sa.Integer, primary_key=True),
+    )
+
 
 users_groups_table = sa.Table(
     'users_groups', metadata,
@@ -25,6 +30,12 @@ def _u(s):
     return unicode(s, 'utf-8')
 
 
+class SchemaError(Exception):
+    """The database was created by a different version of
+    ClueReleaseManager.
+    """
+
+
 class NoSuchDistroError(Exception):
 
     def __init__(self, distro_id):
@@ -67,6 +78,8 @@ class SQLDistro(Base):
 
     distro_id = sa.Column(sa.String, primary_key=True)
     name = sa.Column(sa.String)
+    # utils.normalize_name(name), what lookups by name go through
+    normalized_name = sa.Column(sa.String, index=True)
     owner = sa.Column(sa.String)
     author = sa.Column(sa.String)
     author_email = sa.Column(sa.String)
@@ -80,7 +93,99 @@ class SQLDistro(Base):
     platform = sa.Column(sa.String)
     summary = sa.Column(sa.String)
     version = sa.Column(sa.String)
-    last_updated = sa.Column(sa.DateTime)
+    last_updated = sa.Column(sa.DateTime, index=True)
+
+
+class SQLRenderedDescription(Base):
+    """The rendered HTML of a distro's description, *content_hash*
+    identifies the source (and renderer) it was rendered from.
+
+      >>> r = SQLRenderedDescription()
+    """
+
+    __tablename__ = 'rendered_descriptions'
+
+    def __init__(self, distro_id=None, content_hash=None, html=None):
+        if distro_id is not None:
+            self.distro_id = distro_id
+        if content_hash is not None:
+            self.content_hash = content_hash
+        if html is not None:
+            self.html = html
+
+    distro_id = sa.Column(sa.String, sa.ForeignKey('distros.distro_id'),
+                          primary_key=True)
+    content_hash = sa.Column(sa.String)
+    html = sa.Column(sa.String)
+
+
+class SQLMirrorMiss(Base):
+    """Records that *distro_id* could not be found on the backup index
+    at *pypi_url*, until *expires*.
+
+      >>> m = SQLMirrorMiss()
+    """
+
+    __tablename__ = 'mirror_misses'
+
+    def __init__(self, pypi_url=None, distro_id=None, expires=None):
+        if pypi_url is not None:
+            self.pypi_url = pypi_url
+        if distro_id is not None:
+            self.distro_id = distro_id
+        if expires is not None:
+            self.expires = expires
+
+    pypi_url = sa.Column(sa.String, primary_key=True)
+    distro_id = sa.Column(sa.String, primary_key=True)
+    expires = sa.Column(sa.DateTime)
+
+
+class SQLRemoteFile(Base):
+    """A file of a mirrored distro that is still only available from
+    the backup index at *url*.
+
+      >>> f = SQLRemoteFile()
+    """
+
+    __tablename__ = 'remote_files'
+
+    def __init__(self, distro_id=None, filename=None):
+        if distro_id is not None:
+            self.distro_id = distro_id
+        if filename is not None:
+            self.filename = filename
+
+    distro_id = sa.Column(sa.String, sa.ForeignKey('distros.distro_id'),
+                          primary_key=True)
+    filename = sa.Column(sa.String, primary_key=True)
+    url = sa.Column(sa.String)
+    size = sa.Column(sa.Integer)
+    md5_digest = sa.Column(sa.String)
+
+
+class SQLFileInfo(Base):
+    """The size, modification time and digests of a stored file, so the
+    file only gets hashed once.
+
+      >>> info = SQLFileInfo()
+    """
+
+    __tablename__ = 'file_info'
+
+    def __init__(self, distro_id=None, filename=None):
+        if distro_id is not None:
+            self.distro_id = distro_id
+        if filename is not None:
+            self.filename = filename
+
+    distro_id = sa.Column(sa.String, sa.ForeignKey('distros.distro_id'),
+                          primary_key=True)
+    filename = sa.Column(sa.String, primary_key=True)
+    size = sa.Column(sa.Integer)
+    mtime = sa.Column(sa.Float)
+    md5 = sa.Column(sa.String)
+    sha256 = sa.Column(sa.String)
 
 
 class SQLGroup(Base):
@@ -130,6 +235,15 @@ class SQLRoleMapping(Base):
     group = orm.relation(SQLGroup,
                          primaryjoin=groupname==SQLGroup.groupname)
 
+# the primary key leads with the role, roles are looked up by distro and
+# user or group
+sa.Index('ix_rolemappings_distro_id_username',
+         SQLRoleMapping.__table__.c.distro_id,
+         SQLRoleMapping.__table__.c.username)
+sa.Index('ix_rolemappings_distro_id_groupname',
+         SQLRoleMapping.__table__.c.distro_id,
+         SQLRoleMapping.__table__.c.groupname)
+
 
 OWNER_ROLE = 'owner'
 
@@ -202,53 +316,109 @@ class SecurityManager(object):
 
     def __init__(self, sessionmaker):
         self.sessionmaker = sessionmaker
+        self.password_listeners = []
 
-    def get_roles(self, username, distro_id=None, also_global=False):
-        ses = self.sessionmaker()
-        roles = set()
-        self._populate_roles(ses, roles, username, distro_id, also_global)
+    def add_password_listener(self, listener):
+        """Register *listener* to be called with the username of any
+        user whose password gets set.
+        """
 
-        if (not username) or username == 'anonymous':
-            roles.add(u'anonymous')
-        else:
-            roles.add(u'authenticated')
-            # add anonymous roles too
-            self._populate_roles(ses, roles, u'anonymous',
-                                 distro_id, also_global)
+        self.password_listeners.append(listener)
 
-        return roles
+    def get_roles(self, username, distro_id=None, also_global=False):
+        ses = self.sessionmaker()
+        usernames, roles, who = self._who(ses, username)
 
-    def _populate_roles(self, ses, roles, username, distro_id, also_global):
         distro = distro_id
-
-        rows = ses.execute(
-            'select groupname from users_groups where username=:username',
-            {'username': username})
-        checks = [{'groupname': x[0]} for x in rows]
-        checks.append({'username': username})
-
-        query = ses.query(SQLRoleMapping)
-        if distro_id is None or also_global:
-            for check in checks:
-                for x in query.filter_by(distro_id='', **check):
-                    roles.add(x.role)
-
-        if distro_id is None:
-            return
-
         if isinstance(distro, basestring):
             q = ses.query(SQLDistro)
             distro = q.filter_by(distro_id=distro_id).first()
             if distro is None:
                 raise NoSuchDistroError(distro_id)
 
-        if username == distro.owner:
-            roles.add(OWNER_ROLE)
+        distro_ids = []
+        if distro is None or also_global:
+            distro_ids.append('')
+        if distro is not None:
+            distro_ids.append(distro.distro_id)
+            if distro.owner in usernames:
+                roles.add(OWNER_ROLE)
+
+        q = ses.query(SQLRoleMapping.role)
+        q = q.filter(SQLRoleMapping.distro_id.in_(distro_ids))
+        roles.update([x[0] for x in q.filter(who)])
+        return roles
+
+    def _who(self, ses, username):
+        """The names whose roles *username* gets (its own and the
+        anonymous ones), the roles it has just by being logged in or not
+        and the condition matching the role mappings of those names and
+        of their groups.
+        """
+
+        if (not username) or username == 'anonymous':
+            usernames = [username]
+            base = set([u'anonymous'])
+        else:
+            usernames = [username, u'anonymous']
+            base = set([u'authenticated'])
+
+        s = sql.select([users_groups_table.c.groupname],
+                       users_groups_table.c.username.in_(usernames))
+        groups = [x[0] for x in ses.execute(s)]
+        who = SQLRoleMapping.username.in_(usernames)
+        if groups:
+            who = sa.or_(who, SQLRoleMapping.groupname.in_(groups))
+        return usernames, base, who
+
+    def get_distros_roles(self, username, distros, also_global=False):
+        """The roles *username* has for each of *distros* (``SQLDistro``
+        instances) by distro_id, the same as ``get_roles`` gives for each
+        of them but with a fixed number of queries.
+
+          >>> sm = SecurityManager(sessionmaker)
+          >>> ses = sessionmaker()
+          >>> ses.add(SQLUser('foo'))
+          >>> ses.add(SQLGroup('readers'))
+          >>> ses.commit()
+          >>> sm.update_users_groups('foo', ['readers'])
+          >>> distros = [SQLDistro('a', 'A'), SQLDistro('b', 'B')]
+          >>> distros[1].owner = 'foo'
+          >>> ses.add_all(distros)
+          >>> ses.add(SQLRoleMapping('reader', 'a', '', 'readers'))
+          >>> ses.add(SQLRoleMapping('manager', '', 'foo', ''))
+          >>> ses.commit()
+          >>> roles = sm.get_distros_roles('foo', distros, True)
+          >>> sorted(roles['a']), sorted(roles['b'])
+          ([u'authenticated', u'manager', u'reader'], [u'authenticated', u'manager', 'owner'])
+          >>> roles['a'] == sm.get_roles('foo', 'a', True)
+          True
+          >>> sorted(sm.get_distros_roles('bar', distros)['b'])
+          [u'authenticated']
+        """
 
-        for check in checks:
-            for x in query.filter_by(distro_id=distro.distro_id,
-                                     **check):
-                roles.add(x.role)
+        ses = self.sessionmaker()
+        usernames, base, who = self._who(ses, username)
+        mapping = SQLRoleMapping
+
+        if also_global:
+            q = ses.query(mapping.role).filter(mapping.distro_id == '')
+            base.update([x[0] for x in q.filter(who)])
+
+        res = {}
+        for distro in distros:
+            roles = res[distro.distro_id] = set(base)
+            if distro.owner in usernames:
+                roles.add(OWNER_ROLE)
+
+        # in chunks to stay below the database's limit of bound parameters
+        distro_ids = list(res)
+        for x in range(0, len(distro_ids), 500):
+            q = ses.query(mapping.distro_id, mapping.role)
+            q = q.filter(mapping.distro_id.in_(distro_ids[x:x+500]))
+            for distro_id, role in q.filter(who):
+                res[distro_id].add(role)
+        return res
 
     def update_user(self, name, password, email, roles=[]):
         ses = self.sessionmaker()
@@ -265,6 +435,8 @@ class SecurityManager(object):
         self._update_roles(ses, groupname=name, roles=roles)
 
         ses.commit()
+        for listener in self.password_listeners:
+            listener(name)
         self.logger.info('User "%s" updated' % name)
 
     def update_group(self, name, roles=[]):
@@ -395,6 +567,40 @@ class SecurityManager(object):
                 ses.add(r)
 
 
+class SQLJob(Base):
+    """A post-processing task waiting to be run, *payload* holds its
+    keyword arguments as JSON and *created* the time it was queued.
+    *owner* identifies the queue running the job since *claimed*, a
+    failed job is not retried before *not_before*.
+
+      >>> job = SQLJob()
+    """
+
+    __tablename__ = 'jobs'
+
+    def __init__(self, task=None, distro_id=None, payload=None,
+                 created=None):
+        if task is not None:
+            self.task = task
+        if distro_id is not None:
+            self.distro_id = distro_id
+        if payload is not None:
+            self.payload = payload
+        if created is not None:
+            self.created = created
+        self.attempts = 0
+
+    job_id = sa.Column(sa.Integer, primary_key=True)
+    task = sa.Column(sa.String)
+    distro_id = sa.Column(sa.String)
+    payload = sa.Column(sa.String)
+    created = sa.Column(sa.Float)
+    attempts = sa.Column(sa.Integer)
+    owner = sa.Column(sa.String)
+    claimed = sa.Column(sa.Float)
+    not_before = sa.Column(sa.Float)
+
+
 class SQLIndexItem(Base):
     __tablename__ = 'index_items'
 
@@ -406,6 +612,10 @@ class SQLIndexItem(Base):
                           primary_key=True)
     target_version = sa.Column(sa.String)
 
+sa.Index('ix_index_items_distro_id_indexname',
+         SQLIndexItem.__table__.c.distro_id,
+         SQLIndexItem.__table__.c.indexname)
+
 
 class IndexManager(object):
     """A manager for indexes.
@@ -438,25 +648,41 @@ class IndexManager(object):
       >>> im.del_index_item('distro1', 'foobar', 'distro1')
       >>> im.get_indexes('distro1')
       {}
+
+    Interested parties can be told about changed indexes.
+
+      >>> changed = []
+      >>> im = IndexManager(sessionmaker, on_change=changed.append)
+      >>> im.add_index_item('distro1', 'foobar', 'distro1', 'v1')
+      >>> im.remove_index('distro1', 'foobar')
+      >>> changed
+      ['distro1', 'distro1']
     """
 
-    def __init__(self, sessionmaker):
+    def __init__(self, sessionmaker, on_change=None):
         self.sessionmaker = sessionmaker
+        self.on_change = on_change
+
+    def _changed(self, distro_id):
+        if self.on_change is not None:
+            self.on_change(distro_id)
 
     def get_indexes(self, distro_id):
         ses = self.sessionmaker()
-        indexq = ses.query(SQLIndexItem)
-        distroq = ses.query(SQLDistro)
+        # the names of the targets are joined in rather than looked up
+        # one item at a time
+        q = ses.query(SQLIndexItem, SQLDistro.name)
+        q = q.outerjoin((SQLDistro,
+                         SQLDistro.distro_id == SQLIndexItem.target_distro_id))
         indexes = {}
-        for x in indexq.filter_by(distro_id=distro_id):
+        for x, name in q.filter(SQLIndexItem.distro_id == distro_id):
             index = indexes.get(x.indexname)
             if index is None:
                 index = indexes[x.indexname] = []
-            d = distroq.filter_by(distro_id=x.target_distro_id).first()
-            if d is None:
+            if name is None:
                 index.append('!'+x.target_distro_id)
             else:
-                index.append(d.name+'=='+x.target_version)
+                index.append(name+'=='+x.target_version)
 
         return indexes
 
@@ -477,6 +703,7 @@ class IndexManager(object):
             ses.delete(x)
 
         ses.commit()
+        self._changed(distro_id)
 
     def add_index_item(self, distro_id, indexname,
                        target_distro_id, target_version):
@@ -488,6 +715,7 @@ class IndexManager(object):
         entry.target_version = target_version
         ses.add(entry)
         ses.commit()
+        self._changed(distro_id)
 
     def del_index_item(self, distro_id, indexname,
                        target_distro_id):
@@ -497,3 +725,168 @@ class IndexManager(object):
                                 target_distro_id=target_distro_id):
             ses.delete(item)
         ses.commit()
+        self._changed(distro_id)
+
+
+def get_schema_version(engine):
+    """The schema version stamped in the database *engine* connects to,
+    None for an empty database and 0 for one which predates schema
+    versions.
+
+      >>> engine = sa.create_engine('sqlite:///:memory:')
+      >>> get_schema_version(engine) is None
+      True
+      >>> migrate(engine)
+      []
+      >>> get_schema_version(engine) == SCHEMA_VERSION
+      True
+      >>> check_schema(engine)
+
+      >>> res = engine.execute(schema_version_table.delete())
+      >>> get_schema_version(engine)
+      0
+      >>> check_schema(engine)
+      Traceback (most recent call last):
+      SchemaError: Database schema is at version 0, expected 6; please run "cluerelmgr-admin migrate"
+    """
+
+    tables = engine.table_names()
+    if not tables:
+        return None
+    if schema_version_table.name not in tables:
+        return 0
+    version = engine.execute(
+        sql.select([sql.func.max(schema_version_table.c.version)])).scalar()
+    return version or 0
+
+
+def _stamp(engine, version):
+    engine.execute(schema_version_table.delete())
+    engine.execute(schema_version_table.insert(), version=version)
+
+
+def _create_indexes(engine, *names):
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in names:
+                continue
+            try:
+                index.create(engine)
+            except sa.exc.DBAPIError, err:
+                # tables create_all just made have their indexes already
+                utils.logger.debug('Not creating index %s: %s'
+                                   % (index.name, err))
+
+
+def _add_normalized_names(engine):
+    # create_all does not add columns to existing tables
+    table = SQLDistro.__table__
+    engine.execute('ALTER TABLE distros ADD COLUMN normalized_name VARCHAR')
+    _create_indexes(engine, 'ix_distros_normalized_name')
+    rows = engine.execute(sql.select([table.c.distro_id, table.c.name]))
+    for distro_id, name in rows.fetchall():
+        engine.execute(table.update(table.c.distro_id == distro_id),
+                       normalized_name=utils.normalize_name(name or distro_id))
+
+
+def _add_lookup_indexes(engine):
+    _create_indexes(engine,
+                    'ix_distros_last_updated',
+                    'ix_rolemappings_distro_id_username',
+                    'ix_rolemappings_distro_id_groupname',
+                    'ix_index_items_distro_id_indexname')
+
+
+def _add_jobs_table(engine):
+    SQLJob.__table__.create(engine, checkfirst=True)
+
+
+def _add_file_info_table(engine):
+    SQLFileInfo.__table__.create(engine, checkfirst=True)
+
+
+def _add_columns(engine, tablename, *columns):
+    # create_all does not add columns to existing tables, but the tables
+    # it creates have them already
+    existing = sa.Table(tablename, sa.MetaData(), autoload=True,
+                        autoload_with=engine).c
+    for name, type_ in columns:
+        if name not in existing:
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s'
+                           % (tablename, name, type_))
+
+
+def _add_job_claims(engine):
+    _add_columns(engine, 'jobs', ('owner', 'VARCHAR'), ('claimed', 'FLOAT'),
+                 ('not_before', 'FLOAT'))
+
+
+# the steps bringing a database from the previous version to the given
+# one; version 1 is the schema create_all made before versions were
+# recorded, append new steps whenever the tables change
+MIGRATIONS = [
+    (2, 'Add the distros.normalized_name column', _add_normalized_names),
+    (3, 'Index distros by last update, role mappings by distro and '
+        'user or group, and index items by distro and index name',
+     _add_lookup_indexes),
+    (4, 'Add the jobs table', _add_jobs_table),
+    (5, 'Add the file_info table', _add_file_info_table),
+    (6, 'Add the jobs.owner, jobs.claimed and jobs.not_before columns',
+     _add_job_claims),
+    ]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(engine):
+    """Creates any missing tables and runs the migrations the database
+    has not seen yet, each one is recorded as soon as it completes.  An
+    empty database is created at the current version right away.
+    Returns the version and description of the migrations run.
+
+      >>> engine = sa.create_engine('sqlite:///:memory:')
+      >>> res = engine.execute('CREATE TABLE distros '
+      ...                      '(distro_id VARCHAR PRIMARY KEY, name VARCHAR, '
+      ...                      'last_updated TIMESTAMP)')
+      >>> res = engine.execute("INSERT INTO distros (distro_id, name) "
+      ...                      "VALUES ('foo_bar', 'Foo_Bar')")
+      >>> get_schema_version(engine)
+      0
+      >>> [version for version, description in migrate(engine)]
+      [2, 3, 4, 5, 6]
+      >>> engine.execute('SELECT normalized_name FROM distros').fetchall()
+      [(u'foo-bar',)]
+      >>> migrate(engine)
+      []
+    """
+
+    version = get_schema_version(engine)
+    metadata.create_all(engine)
+    if version is None:
+        _stamp(engine, SCHEMA_VERSION)
+        return []
+
+    done = []
+    for target, description, func in MIGRATIONS:
+        if target <= version:
+            continue
+        func(engine)
+        _stamp(engine, target)
+        done.append((target, description))
+    return done
+
+
+def check_schema(engine):
+    """Makes sure the database is usable without touching every table:
+    an empty database gets initialized, one at a different schema
+    version raises SchemaError.
+    """
+
+    version = get_schema_version(engine)
+    if version is None:
+        utils.logger.info('Initializing empty database')
+        migrate(engine)
+    elif version != SCHEMA_VERSION:
+        raise SchemaError('Database schema is at version %s, expected %s; '
+                          'please run "cluerelmgr-admin migrate"'
+                          % (version, SCHEMA_VERSION))
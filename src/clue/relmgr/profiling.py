@@ -0,0 +1,178 @@
+from __future__ import with_statement
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+
+import simplejson
+
+from clue.relmgr import utils
+
+PROFILE_HEADER = 'HTTP_X_CLUE_PROFILE'
+
+
+def list_profiles(profile_dir, limit=None):
+    """The metadata of the profiles stored in *profile_dir*, slowest
+    first.
+    """
+
+    res = []
+    if not os.path.isdir(profile_dir):
+        return res
+    for fname in os.listdir(profile_dir):
+        if not fname.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(profile_dir, fname)) as f:
+                res.append(simplejson.load(f))
+        except (IOError, ValueError):
+            continue
+    res.sort(key=lambda x: x['duration'], reverse=True)
+    if limit is not None:
+        res = res[:limit]
+    return res
+
+
+def profile_path(profile_dir, name):
+    """The pstats file of the profile called *name*, or None if there is
+    no such profile.
+
+      >>> profile_path('/tmp', '../etc/passwd') is None
+      True
+    """
+
+    if not re.match(r'^[\w.-]+$', name) or name.startswith('.'):
+        return None
+    path = os.path.join(profile_dir, name + '.prof')
+    if not os.path.exists(path):
+        return None
+    return path
+
+
+class ProfilingMiddleware(object):
+    """Runs a *sample_rate* fraction of requests, and those carrying an
+    ``X-Clue-Profile`` header which *authorize* accepts, under cProfile.
+    The pstats output and the request's metadata are stored in
+    *profile_dir*, keeping the *max_profiles* most recent ones.  The
+    pstats files can be read with the ``pstats`` module and tools like
+    snakeviz, gprof2dot or flameprof.
+
+      >>> import tempfile, shutil
+      >>> profile_dir = tempfile.mkdtemp()
+      >>> def app(environ, start_response):
+      ...     start_response('200 OK', [])
+      ...     return ['a', 'b']
+      >>> def start(status, headers, exc_info=None):
+      ...     pass
+      >>> mw = ProfilingMiddleware(app, profile_dir,
+      ...                          authorize=lambda environ: True)
+      >>> environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/foo'}
+      >>> mw(environ, start)
+      ['a', 'b']
+      >>> list_profiles(profile_dir)
+      []
+
+      >>> environ['HTTP_X_CLUE_PROFILE'] = '1'
+      >>> mw(environ, start)
+      ['a', 'b']
+      >>> [(x['method'], x['path']) for x in list_profiles(profile_dir)]
+      [('GET', '/foo')]
+      >>> name = list_profiles(profile_dir)[0]['name']
+      >>> import pstats
+      >>> stats = pstats.Stats(profile_path(profile_dir, name))
+
+      >>> shutil.rmtree(profile_dir)
+    """
+
+    logger = utils.logger
+
+    def __init__(self, app, profile_dir, sample_rate=0.0, authorize=None,
+                 endpoint_for=None, max_profiles=200):
+        self.app = app
+        self.profile_dir = profile_dir
+        self.sample_rate = sample_rate
+        self.authorize = authorize
+        self.endpoint_for = endpoint_for
+        self.max_profiles = max_profiles
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def should_profile(self, environ):
+        if environ.get(PROFILE_HEADER):
+            if self.authorize is not None and self.authorize(environ):
+                return True
+        return self.sample_rate > 0 and \
+               self._random.random() < self.sample_rate
+
+    def __call__(self, environ, start_response):
+        if not self.should_profile(environ):
+            return self.app(environ, start_response)
+
+        state = {}
+
+        def start(status, headers, exc_info=None):
+            state['status'] = status
+            return start_response(status, headers, exc_info)
+
+        profiler = cProfile.Profile()
+        started = time.time()
+        profiler.enable()
+        try:
+            app_iter = self.app(environ, start)
+            try:
+                body = list(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+        finally:
+            profiler.disable()
+            duration = time.time() - started
+            try:
+                self.save(profiler, environ, state.get('status'), started,
+                          duration)
+            except (IOError, OSError), err:
+                self.logger.warn('Could not store profile: %s' % err)
+        return body
+
+    def save(self, profiler, environ, status, started, duration):
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+
+        name = '%s-%06i-%s' % (time.strftime('%Y%m%d-%H%M%S',
+                                             time.localtime(started)),
+                               (started % 1) * 1000000,
+                               threading.currentThread().getName())
+        name = re.sub(r'[^\w.-]', '_', name)
+        profiler.dump_stats(os.path.join(self.profile_dir, name + '.prof'))
+
+        endpoint = None
+        if self.endpoint_for is not None:
+            endpoint = self.endpoint_for(environ)
+        info = {'name': name,
+                'time': started,
+                'duration': duration,
+                'method': environ.get('REQUEST_METHOD'),
+                'path': environ.get('SCRIPT_NAME', '') +
+                        environ.get('PATH_INFO', ''),
+                'query': environ.get('QUERY_STRING', ''),
+                'endpoint': endpoint,
+                'status': status,
+                'user': environ.get('REMOTE_USER')}
+        with open(os.path.join(self.profile_dir, name + '.json'), 'w') as f:
+            f.write(simplejson.dumps(info))
+        self.logger.info('Profiled %s %s in %.3fs as %s'
+                         % (info['method'], info['path'], duration, name))
+        self.prune()
+
+    def prune(self):
+        with self._lock:
+            names = sorted([x[:-5] for x in os.listdir(self.profile_dir)
+                            if x.endswith('.json')])
+            for name in names[:-self.max_profiles]:
+                for ext in ('.json', '.prof'):
+                    try:
+                        os.remove(os.path.join(self.profile_dir, name + ext))
+                    except OSError:
+                        pass
@@ -1,15 +1,17 @@
 from __future__ import with_statement
+import hashlib
 import os
 import datetime
-from clue.relmgr import model, utils
+from clue.relmgr import cache, jobs, model, storage, utils
 import sqlalchemy as sa
 from sqlalchemy import orm
 import threading
-import pkg_resources
-from setuptools import package_index
 
 active_info = threading.local()
 
+pkg_resources = utils.LazyModule('pkg_resources')
+package_index = utils.LazyModule('setuptools.package_index')
+
 
 class PyPiError(Exception):
     pass
@@ -50,6 +52,16 @@ class SimplePyPi(object):
         return self.distros.values()
 
 
+def _distro_id(distro):
+    """The id of *distro*, which is either an id or a ``model.SQLDistro``
+    whose roles can then be looked up without loading it again.
+    """
+
+    if isinstance(distro, model.SQLDistro):
+        return distro.distro_id
+    return distro
+
+
 def version_info(s):
     return pkg_resources.parse_version(os.path.basename(s))
 
@@ -98,17 +110,37 @@ class PyPi(object):
     _sessionmaker = None
     _security_manager = None
     _index_manager = None
+    _storage = None
+    file_info_ttl = 60
+    sql_stats = None
+    job_queue = None
 
-    def __init__(self, basefiledir, sqluri, self_register=False):
+    def __init__(self, basefiledir, sqluri, self_register=False,
+                 storage_layout=None, storage_url=None):
         self.basefiledir = basefiledir
         self.sqluri = sqluri
         self.self_register = self_register
+        self.storage_layout = storage_layout
+        self.storage_url = storage_url
+        self.change_listeners = []
+        self.file_info_cache = cache.TTLCache(5000, self.file_info_ttl)
+        self.add_change_listener(self.discard_file_info)
+
+    def create_engine(self):
+        options = {}
+        if self.sql_stats is not None:
+            options = self.sql_stats.engine_options()
+        engine = sa.create_engine(self.sqluri, **options)
+        if self.sql_stats is not None:
+            self.sql_stats.attach(engine)
+        return engine
 
     @property
     def engine(self):
         if self._engine is None:
-            self._engine = sa.create_engine(self.sqluri)
-            model.metadata.create_all(self.engine)
+            engine = self.create_engine()
+            model.check_schema(engine)
+            self._engine = engine
         return self._engine
 
     def setup_model(self):
@@ -121,6 +153,14 @@ class PyPi(object):
             self._sessionmaker = orm.sessionmaker(bind=self.engine)
         return self._sessionmaker
 
+    @property
+    def storage(self):
+        if self._storage is None:
+            self._storage = storage.get_storage(self.basefiledir,
+                                                self.storage_url,
+                                                self.storage_layout)
+        return self._storage
+
     @property
     def security_manager(self):
         if self._security_manager is None:
@@ -130,9 +170,31 @@ class PyPi(object):
     @property
     def index_manager(self):
         if self._index_manager is None:
-            self._index_manager = model.IndexManager(self.sessionmaker)
+            self._index_manager = model.IndexManager(
+                self.sessionmaker, on_change=self.notify_changed)
         return self._index_manager
 
+    def add_change_listener(self, listener):
+        """Register *listener* to be called with the distro_id of any
+        distro whose metadata, files or indexes change.
+        """
+
+        self.change_listeners.append(listener)
+
+    def notify_changed(self, distro_id):
+        for listener in self.change_listeners:
+            listener(distro_id)
+
+    def defer(self, task, distro_id, **kwargs):
+        """Have the post-processing *task* (see ``clue.relmgr.jobs``) run
+        for *distro_id* by the job queue, or right away without one.
+        """
+
+        if self.job_queue is not None:
+            self.job_queue.enqueue(task, distro_id, **kwargs)
+        else:
+            jobs.run_task(self, task, distro_id, **kwargs)
+
     def register_user(self, name, password, confirm, email):
         if not self.self_register:
             raise SecurityError('Server does not permit self-registration')
@@ -167,17 +229,52 @@ class PyPi(object):
     def get_active_user(self):
         return get_active_user()
 
+    def get_roles(self, distro_id):
+        """All roles the active user has for *distro_id*, including
+        the global ones.  A loaded ``model.SQLDistro`` can be passed
+        instead of its id.
+        """
+
+        return self.security_manager.get_roles(self.get_active_user(),
+                                               distro_id, True)
+
     def has_role(self, distro_id, *roles):
         # any user that has authenticated gets magical AUTHENTICATED_ROLE
         if AUTHENTICATED_ROLE in roles and self.get_active_user() != ANONYMOUS:
             return True
-        derived = self.security_manager.get_roles(self.get_active_user(),
-                                                  distro_id, True)
+        derived = self.get_roles(distro_id)
         for x in roles:
             if x in derived:
                 return True
         return False
 
+    def filter_readable(self, distros):
+        """The *distros* the active user may see, with their roles looked
+        up together rather than one distro at a time.
+        """
+
+        distros = list(distros)
+        roles = self.security_manager.get_distros_roles(
+            self.get_active_user(), distros, True)
+        readable = set([READER_ROLE, MANAGER_ROLE, model.OWNER_ROLE])
+        return [x for x in distros if roles[x.distro_id] & readable]
+
+    def iter_readable(self, query, chunk=500):
+        """Iterates the readable distros of *query*, loading and checking
+        them *chunk* rows at a time so the full result is never held in
+        memory.
+        """
+
+        rows = []
+        for distro in query.yield_per(chunk):
+            rows.append(distro)
+            if len(rows) == chunk:
+                for x in self.filter_readable(rows):
+                    yield x
+                rows = []
+        for x in self.filter_readable(rows):
+            yield x
+
     def update_metadata(self, name, **kwargs):
         distro_id = utils.make_distro_id(name)
 
@@ -203,9 +300,14 @@ class PyPi(object):
             self.logger.debug('Updating distro "%s"' % distro_id)
             utils.update_obj(distro, **kwargs)
         distro.name = name
+        distro.normalized_name = utils.normalize_name(name)
         distro.last_updated = datetime.datetime.now()
         ses.commit()
 
+        if 'description' in kwargs:
+            self.defer('render_description', distro_id)
+        self.notify_changed(distro_id)
+
     def update_updated(self, distro_id, last_updated=None):
         ses = self.sessionmaker()
         q = ses.query(model.SQLDistro)
@@ -214,6 +316,7 @@ class PyPi(object):
             last_updated = datetime.datetime.now()
         distro.last_updated = last_updated
         ses.commit()
+        self.notify_changed(distro_id)
 
     def upload_files(self, name, content, **kwargs):
         distro_id = utils.make_distro_id(name)
@@ -222,20 +325,71 @@ class PyPi(object):
             raise SecurityError('"%s" is not the owner of "%s" distro' %
                                 (self.get_active_user(), distro_id))
 
-        targetdir = os.path.join(self.basefiledir, distro_id[0],
-                                 distro_id)
-        if not os.path.exists(targetdir):
-            os.makedirs(targetdir)
         if not isinstance(content, (list, tuple)):
             content = [content]
 
+        files = []
         for content_item in content:
-            target = os.path.join(targetdir, content_item.filename)
-            content_item.save(target)
+            # the digests are taken while storing, saving a second read,
+            # recording them is left to the job queue
+            digesting = utils.DigestingContent(content_item)
+            self.storage.store(distro_id, digesting)
+            files.append({'filename': os.path.basename(content_item.filename),
+                          'size': digesting.size,
+                          'md5': digesting.md5.hexdigest(),
+                          'sha256': digesting.sha256.hexdigest()})
             self.logger.debug('Added file "%s" to "%s"' %
                               (content_item.filename, distro_id))
 
         self.update_updated(distro_id)
+        self.defer('file_info', distro_id, files=files)
+
+    def add_remote_files(self, name, urldicts):
+        """Record files of the *name* distro that are available from a
+        backup index, *urldicts* are as returned by its ``release_urls``.
+        """
+
+        distro_id = utils.make_distro_id(name)
+        if not self.has_role(distro_id, model.OWNER_ROLE, MANAGER_ROLE):
+            raise SecurityError('"%s" is not the owner of "%s" distro' %
+                                (self.get_active_user(), distro_id))
+
+        ses = self.sessionmaker()
+        q = ses.query(model.SQLRemoteFile)
+        for urldict in urldicts:
+            filename = urldict['filename']
+            remote = q.filter_by(distro_id=distro_id,
+                                 filename=filename).first()
+            if remote is None:
+                remote = model.SQLRemoteFile(distro_id, filename)
+                ses.add(remote)
+            remote.url = urldict['url']
+            remote.size = urldict.get('size')
+            remote.md5_digest = urldict.get('md5_digest')
+        ses.commit()
+
+        self.update_updated(distro_id)
+
+    def get_remote_files(self, distro_id):
+        """The recorded remote files of *distro_id* that haven't been
+        fetched yet.
+        """
+
+        local = set([os.path.basename(x) for x in self.get_files(distro_id)])
+        ses = self.sessionmaker()
+        q = ses.query(model.SQLRemoteFile)
+        q = q.filter_by(distro_id=_distro_id(distro_id))
+        return [x for x in q.order_by(model.SQLRemoteFile.filename)
+                if x.filename not in local]
+
+    def get_remote_file(self, distro_id, fname):
+        if not self.has_role(distro_id,
+                             READER_ROLE, MANAGER_ROLE, model.OWNER_ROLE):
+            raise SecurityError('Permission denied')
+
+        ses = self.sessionmaker()
+        q = ses.query(model.SQLRemoteFile)
+        return q.filter_by(distro_id=distro_id, filename=fname).first()
 
     def get_indexes(self, distro_id):
         return [x for x in self.index_manager.get_indexes(distro_id)]
@@ -245,41 +399,66 @@ class PyPi(object):
                              READER_ROLE, MANAGER_ROLE, model.OWNER_ROLE):
             raise SecurityError('Permission denied')
 
+        distro_id = _distro_id(distro_id)
         indexes = self.index_manager.get_indexes(distro_id)
         index = indexes[indexname]
+        reqs = [pkg_resources.Requirement.parse(x)
+                for x in index if not x.startswith('!')]
+        targets = self._find_readable(
+            set([x.project_name for x in reqs]))
+
         res = []
         for reqstr in index:
             if reqstr.startswith('!'):
                 res.append((reqstr[1:], None, None))
                 continue
             req = pkg_resources.Requirement.parse(reqstr)
-            try:
-                targetdistro = self.get_distro(distro_name=req.project_name)
-            except SecurityError, exc:
+            targetdistro = targets.get(utils.normalize_name(req.project_name))
+            if targetdistro is None:
                 res.append((reqstr, None, None))
                 continue
 
-            targetdir = os.path.join(self.basefiledir,
-                                     targetdistro.distro_id[0],
-                                     targetdistro.distro_id)
-            if not os.path.exists(targetdir):
-                continue
-            for fname in os.listdir(targetdir):
-                for d in package_index.distros_for_filename(
-                    os.path.join(targetdir, fname)):
+            for path in self.storage.list(targetdistro.distro_id):
+                for d in package_index.distros_for_filename(path):
                     if d.version == req.specs[0][1]:
-                        res.append((targetdistro, d, fname))
+                        res.append((targetdistro, d, os.path.basename(path)))
         return res
 
+    def _find_readable(self, names):
+        """The readable distros called any of *names* by normalized name,
+        with the same pick between equivalent spellings as
+        ``find_distro_id``.
+        """
+
+        found = {}
+        normalized = [utils.normalize_name(x) for x in names]
+        preferred = set([utils.make_distro_id(x) for x in names])
+        ses = self.sessionmaker()
+        q = ses.query(model.SQLDistro)
+        q = q.filter(model.SQLDistro.normalized_name.in_(normalized))
+        for distro in q.order_by(model.SQLDistro.distro_id):
+            key = distro.normalized_name
+            if key not in found or (distro.distro_id in preferred and
+                                    found[key].distro_id not in preferred):
+                found[key] = distro
+        readable = self.filter_readable(found.values())
+        return dict([(x.normalized_name, x) for x in readable])
+
     def find_req(self, reqstr, order_by='distro_id'):
+        return list(self.iter_req(reqstr, order_by))
+
+    def iter_req(self, reqstr, order_by='distro_id'):
+        """Iterates (distro, entries) for the readable distros with files
+        matching *reqstr*, where entries are the (filename, version)
+        pairs of those files.
+        """
+
         ses = self.sessionmaker()
         query = ses.query(model.SQLDistro)
 
         pkgreqs = [x for x in pkg_resources.parse_requirements(reqstr)]
-        reqs = [model.SQLDistro.distro_id == \
-                  utils.make_distro_id(x.project_name)
-                for x in pkgreqs]
-        query = query.filter(sa.or_(*reqs))
+        names = [utils.normalize_name(x.project_name) for x in pkgreqs]
+        query = query.filter(model.SQLDistro.normalized_name.in_(names))
 
         if order_by is not None:
             vals = []
@@ -287,15 +466,9 @@ class PyPi(object):
                 vals.append('distros_'+x.strip())
             query = query.order_by(','.join(vals))
 
-        distros = [x for x in query
-                   if self.has_role(x.distro_id,
-                                    READER_ROLE, MANAGER_ROLE,
-                                    model.OWNER_ROLE)]
-
-        res = []
-        for distro in distros:
+        for distro in self.iter_readable(query):
             entries = []
-            for f in self.get_files(distro.distro_id):
+            for f in self.list_files(distro.distro_id):
                 version = utils.parse_version(f)
                 if version:
                     for r in pkgreqs:
@@ -303,11 +476,12 @@ class PyPi(object):
                             entries.append((f, version))
                             break
             if entries:
-                res.append((distro, entries))
-
-        return res
+                yield distro, entries
 
     def search(self, s, order_by='distro_id'):
+        return list(self.iter_search(s, order_by))
+
+    def iter_search(self, s, order_by='distro_id'):
         ses = self.sessionmaker()
         query = ses.query(model.SQLDistro)
 
@@ -322,13 +496,12 @@ class PyPi(object):
                 vals.append('distros_'+x.strip())
             query = query.order_by(','.join(vals))
 
-        distros = [x for x in query
-                   if self.has_role(x.distro_id,
-                                    READER_ROLE, MANAGER_ROLE,
-                                    model.OWNER_ROLE)]
-        return distros
+        return self.iter_readable(query)
 
     def get_distros(self, order_by=None):
+        return list(self.iter_distros(order_by))
+
+    def iter_distros(self, order_by=None):
         ses = self.sessionmaker()
         query = ses.query(model.SQLDistro)
         if order_by is not None:
@@ -337,55 +510,277 @@ class PyPi(object):
                 vals.append('distros_'+x.strip())
             query = query.order_by(','.join(vals))
 
-        distros = [x for x in query
-                   if self.has_role(x.distro_id,
-                                    READER_ROLE, MANAGER_ROLE,
-                                    model.OWNER_ROLE)]
-        return distros
+        return self.iter_readable(query)
 
-    def get_distro(self, distro_id=None, distro_name=None):
-        if not distro_id:
-            distro_id = utils.make_distro_id(distro_name)
+    def find_distro_id(self, name):
+        """The id of the distro called *name* (or an equivalent spelling
+        of it, see ``utils.normalize_name``), or None if there is no such
+        distro.  A distro whose id matches *name* exactly wins.
+        """
 
-        try:
-            if not self.has_role(distro_id,
-                                 READER_ROLE, MANAGER_ROLE, model.OWNER_ROLE):
-                raise SecurityError('Permission denied')
-        except ValueError, err:
+        ses = self.sessionmaker()
+        q = ses.query(model.SQLDistro.distro_id)
+        ids = [x[0] for x in
+               q.filter_by(normalized_name=utils.normalize_name(name))]
+        if not ids:
             return None
+        distro_id = utils.make_distro_id(name)
+        if distro_id in ids:
+            return distro_id
+        return min(ids)
+
+    def get_distro(self, distro_id=None, distro_name=None):
+        if distro_name:
+            distro_id = self.find_distro_id(distro_name)
+            if distro_id is None:
+                return None
 
         ses = self.sessionmaker()
         q = ses.query(model.SQLDistro)
-        if distro_name:
-            distro_id = utils.make_distro_id(distro_name)
-        return q.filter_by(distro_id=distro_id).first()
+        distro = q.filter_by(distro_id=distro_id).first()
+        if distro is None:
+            return None
+        if not self.has_role(distro,
+                             READER_ROLE, MANAGER_ROLE, model.OWNER_ROLE):
+            raise SecurityError('Permission denied')
+        return distro
+
+    def get_description_html(self, distro):
+        """Return the rendered description of *distro*, it is only
+        rendered if no up to date copy has been stored yet.
+        """
+
+        ses = self.sessionmaker()
+        q = ses.query(model.SQLRenderedDescription)
+        rendered = q.filter_by(distro_id=distro.distro_id).first()
+        if rendered is not None and \
+               rendered.content_hash == utils.rst_hash(distro.description or u''):
+            return rendered.html
+        return self.render_description(distro)
+
+    def render_description(self, distro):
+        description = distro.description or u''
+        html = utils.format_rst(description)
+
+        content_hash = utils.rst_hash(description)
+        ses = self.sessionmaker()
+        q = ses.query(model.SQLRenderedDescription)
+        rendered = q.filter_by(distro_id=distro.distro_id).first()
+        if rendered is None:
+            rendered = model.SQLRenderedDescription(distro.distro_id)
+            ses.add(rendered)
+        rendered.content_hash = content_hash
+        rendered.html = html
+        try:
+            ses.commit()
+        except sa.exc.IntegrityError:
+            # stored by a concurrent job or page view meanwhile, keep it
+            # unless it was rendered from another description
+            ses.rollback()
+            rendered = q.filter_by(distro_id=distro.distro_id).first()
+            if rendered.content_hash != content_hash:
+                rendered.content_hash = content_hash
+                rendered.html = html
+                ses.commit()
+        self.logger.debug('Rendered description for "%s"' % distro.distro_id)
+        return html
+
+    def render_all_descriptions(self):
+        count = 0
+        for distro in self.get_distros():
+            self.render_description(distro)
+            count += 1
+        return count
+
+    def has_distro(self, distro_id):
+        """Whether *distro_id* exists, regardless of who may see it."""
+
+        ses = self.sessionmaker()
+        q = ses.query(model.SQLDistro.distro_id)
+        return q.filter_by(distro_id=distro_id).first() is not None
 
     def get_files(self, distro_id):
         if not self.has_role(distro_id,
                              READER_ROLE, MANAGER_ROLE, model.OWNER_ROLE):
             raise SecurityError('Permission denied')
 
-        if isinstance(distro_id, model.SQLDistro):
-            distro_id = distro_id.distro_id
-        distrodir = os.path.join(self.basefiledir, distro_id[0], distro_id)
+        return self.list_files(_distro_id(distro_id))
 
-        res = []
-        if os.path.exists(distrodir):
-            for fname in os.listdir(distrodir):
-                res.append(os.path.join(distrodir, fname))
+    def list_files(self, distro_id):
+        """Like ``get_files`` without checking permissions."""
+
+        res = self.storage.list(distro_id)
         # sort so that latest versions come first
         res.sort(lambda x, y: cmp(version_info(x),
                                   version_info(y)),
                  reverse=True)
         return res
 
-    def get_file(self, distro_id, fname):
+    def stat_file(self, distro_id, fname):
+        """A ``storage.FileStat`` for the file or None if there is no
+        such file.
+        """
+
+        if not self.has_role(distro_id,
+                             READER_ROLE, MANAGER_ROLE, model.OWNER_ROLE):
+            raise SecurityError('Permission denied')
+
+        return self.storage.stat(_distro_id(distro_id), fname)
+
+    def open_file(self, distro_id, fname):
         if not self.has_role(distro_id,
                              READER_ROLE, MANAGER_ROLE, model.OWNER_ROLE):
             raise SecurityError('Permission denied')
 
-        distrodir = os.path.join(self.basefiledir, distro_id[0], distro_id)
-        return os.path.join(distrodir, fname)
+        return self.storage.open(distro_id, fname)
+
+    def get_file_info(self, distro_id, fname):
+        """A dict with the filename, size, mtime, md5 and sha256 of the
+        file or None if there is no such file.  The digests are stored
+        in the database when the file is, the info is cached until the
+        distro changes or *file_info_ttl* seconds have passed.
+        """
+
+        if not self.has_role(distro_id,
+                             READER_ROLE, MANAGER_ROLE, model.OWNER_ROLE):
+            raise SecurityError('Permission denied')
+
+        return self.load_file_info(_distro_id(distro_id), fname)
+
+    def load_file_info(self, distro_id, fname):
+        """Like ``get_file_info`` without checking permissions.  Files
+        without stored digests, e.g. stored before they were recorded or
+        changed since, are hashed once and their digests saved.
+
+          >>> import shutil, tempfile
+          >>> tmpdir = tempfile.mkdtemp()
+          >>> pypi = PyPi(tmpdir, 'sqlite:///%s/pypi.db' % tmpdir,
+          ...             storage_url='memory:')
+          >>> pypi.storage.store('foo', utils.StringContent('foo-1.0.zip',
+          ...                                               'abc'))
+          >>> info = pypi.load_file_info('foo', 'foo-1.0.zip')
+          >>> print info['size'], info['md5']
+          3 900150983cd24fb0d6963f7d28e17f72
+
+        Later lookups use the stored digests.
+
+          >>> def fail(*args):
+          ...     raise AssertionError('file read again')
+          >>> pypi.storage.open = fail
+          >>> pypi.file_info_cache.clear()
+          >>> print pypi.load_file_info('foo', 'foo-1.0.zip')['md5']
+          900150983cd24fb0d6963f7d28e17f72
+          >>> shutil.rmtree(tmpdir)
+        """
+
+        info = self.file_info_cache.get((distro_id, fname))
+        if info is None:
+            ses = self.sessionmaker()
+            q = ses.query(model.SQLFileInfo)
+            row = q.filter_by(distro_id=distro_id, filename=fname).first()
+            info = self._file_info(distro_id, fname, row)
+        return info
+
+    def get_files_info(self, distro_id):
+        """The info as given by ``get_file_info`` of all files of the
+        distro, with the stored digests of the files loaded at once.
+
+          >>> import shutil, tempfile
+          >>> tmpdir = tempfile.mkdtemp()
+          >>> pypi = PyPi(tmpdir, 'sqlite:///%s/pypi.db' % tmpdir,
+          ...             storage_url='memory:')
+          >>> pypi.has_role = lambda distro_id, *roles: True
+          >>> for x in ('foo-1.0.zip', 'foo-1.1.zip'):
+          ...     pypi.storage.store('foo', utils.StringContent(x, x))
+          >>> [x['filename'] for x in pypi.get_files_info('foo')]
+          ['foo-1.1.zip', 'foo-1.0.zip']
+          >>> shutil.rmtree(tmpdir)
+        """
+
+        rows = None
+        res = []
+        files = self.get_files(distro_id)
+        distro_id = _distro_id(distro_id)
+        for path in files:
+            fname = os.path.basename(path)
+            info = self.file_info_cache.get((distro_id, fname))
+            if info is None:
+                if rows is None:
+                    ses = self.sessionmaker()
+                    q = ses.query(model.SQLFileInfo)
+                    rows = dict([(x.filename, x)
+                                 for x in q.filter_by(distro_id=distro_id)])
+                info = self._file_info(distro_id, fname, rows.get(fname))
+            if info is not None:
+                res.append(info)
+        return res
+
+    def _file_info(self, distro_id, fname, row):
+        """The info of the file from its stored *row*, which is hashed
+        again when missing or out of date, and cached.
+        """
+
+        stat = self.storage.stat(distro_id, fname)
+        if stat is None:
+            return None
+        if row is None or row.size != stat.size or row.mtime != stat.mtime:
+            row = self._hash_file(distro_id, fname)
+        info = {'filename': fname,
+                'size': row.size,
+                'mtime': row.mtime,
+                'md5': row.md5,
+                'sha256': row.sha256}
+        self.file_info_cache.set((distro_id, fname), info)
+        return info
+
+    def _hash_file(self, distro_id, fname):
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        f = self.storage.open(distro_id, fname)
+        try:
+            while True:
+                data = f.read(65536)
+                if not data:
+                    break
+                md5.update(data)
+                sha256.update(data)
+        finally:
+            f.close()
+        self.logger.debug('Hashed "%s" of "%s"' % (fname, distro_id))
+        return self.save_file_info(distro_id, fname, md5.hexdigest(),
+                                   sha256.hexdigest())
+
+    def save_file_info(self, distro_id, fname, md5, sha256):
+        """Record the digests of a stored file along with its current
+        size and mtime, returns the ``model.SQLFileInfo``.
+        """
+
+        stat = self.storage.stat(distro_id, fname)
+        ses = self.sessionmaker()
+        q = ses.query(model.SQLFileInfo)
+        row = q.filter_by(distro_id=distro_id, filename=fname).first()
+        if row is None:
+            row = model.SQLFileInfo(distro_id, fname)
+            ses.add(row)
+        row.size = stat.size
+        row.mtime = stat.mtime
+        row.md5 = md5
+        row.sha256 = sha256
+        try:
+            ses.commit()
+        except sa.exc.IntegrityError:
+            # recorded by a concurrent request meanwhile, for the same
+            # content
+            ses.rollback()
+        self.file_info_cache.pop((distro_id, fname), None)
+        return row
+
+    def discard_file_info(self, distro_id):
+        if distro_id is None:
+            self.file_info_cache.clear()
+        else:
+            self.file_info_cache.discard_matching(
+                lambda key: key[0] == distro_id)
 
 
     actions = {
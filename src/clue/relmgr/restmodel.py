@@ -1,8 +1,27 @@
 import os
 from restish import app, http, resource
 import simplejson
-from clue.relmgr import utils
+from clue.relmgr import model, utils
 import datetime
+import sqlalchemy as sa
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+JSON_HEADERS = [('Content-Type', 'application/json')]
+
+# the most SQL statements a GET of each resource may execute, none of
+# them may grow with the number of distros, files or index entries:
+# loading a distro takes 1, each permission check 2 (the user's groups
+# and their role mappings), a listing 1 plus 2 per 500 rows checked
+QUERY_BUDGETS = {'distros': 4,
+                 'distro': 3,
+                 'files': 6,
+                 'file': 8,
+                 'indexes': 4,
+                 'index': 11}
 
 
 def simple_ser(ob):
@@ -13,26 +32,125 @@ def simple_ser(ob):
     raise TypeError(str(type(ob)))
 
 
-def to_jsons(ob):
-    '''Dump the given object as a JSON string.
+_encoder = simplejson.JSONEncoder()
+
+
+def dumps(ob):
+    '''Dump *ob*, which may only consist of dicts, lists, strings, numbers
+    and None, as a JSON string using the fastest available library.
+
+      >>> simplejson.loads(dumps({'foo': [1, None, u'bar']}))
+      {'foo': [1, None, 'bar']}
+    '''
+
+    if ujson is not None:
+        return ujson.dumps(ob)
+    return _encoder.encode(ob)
+
+
+class Serializer(object):
+    '''Turns objects into dicts holding a fixed set of fields, each
+    given as a name or a (name, attribute[, converter]) tuple.
 
       >>> class Mock(object):
       ...     def __init__(self, **kw):
       ...         self.__dict__.update(kw)
+      >>> ser = Serializer(('id', 'distro_id'), 'name',
+      ...                  ('last_updated', 'last_updated', simple_ser))
+      >>> sorted(ser(Mock(distro_id='foo', name='Foo', summary='abc',
+      ...                 last_updated=datetime.datetime(2010, 1, 2))).items())
+      [('id', 'foo'), ('last_updated', '2010-01-02T00:00:00'), ('name', 'Foo')]
+    '''
+
+    def __init__(self, *fields):
+        self.fields = []
+        for field in fields:
+            if isinstance(field, basestring):
+                field = (field, field)
+            if len(field) == 2:
+                field = field + (None, )
+            self.fields.append(field)
+
+    def __call__(self, ob):
+        d = {}
+        for name, attr, convert in self.fields:
+            value = getattr(ob, attr)
+            if convert is not None:
+                value = convert(value)
+            d[name] = value
+        return d
 
-      >>> m = Mock(foo=1)
-      >>> m._bar = 2
-      >>> m.grr = 3
 
-      >>> to_jsons(m)
-      '{"foo": 1, "grr": 3}'
+def column_fields(cls, exclude=()):
+    '''The fields for serializing all mapped columns of *cls*.
+
+      >>> [x[0] for x in column_fields(model.SQLRemoteFile)]
+      ['distro_id', 'filename', 'url', 'size', 'md5_digest']
+
+    Internal lookup columns are not part of the API.
+
+      >>> 'normalized_name' in [x[0] for x in serialize_distro.fields]
+      False
     '''
 
-    d = dict(ob.__dict__)
-    for x in d.keys():
-        if x.startswith('_'):
-            del d[x]
-    return simplejson.dumps(d, default=simple_ser)
+    fields = []
+    for column in cls.__table__.columns:
+        if column.key in exclude:
+            continue
+        if isinstance(column.type, sa.DateTime):
+            fields.append((column.key, column.key, simple_ser))
+        else:
+            fields.append((column.key, column.key))
+    return fields
+
+
+serialize_distro = Serializer(*column_fields(model.SQLDistro,
+                                             exclude=('normalized_name', )))
+serialize_distro_summary = Serializer(('id', 'distro_id'), 'name',
+                                      ('last_updated', 'last_updated',
+                                       simple_ser),
+                                      'summary')
+
+
+def serialize_file_info(info):
+    '''The JSON-ready version of a ``PyPi.get_file_info`` dict.
+
+      >>> import time
+      >>> mtime = time.mktime((2010, 1, 2, 3, 4, 5, 0, 0, -1))
+      >>> sorted(serialize_file_info({'filename': 'foo-1.0.zip',
+      ...                             'mtime': mtime}).items())
+      [('filename', 'foo-1.0.zip'), ('mtime', '2010-01-02T03:04:05')]
+    '''
+
+    info = dict(info)
+    if info.get('mtime') is not None:
+        info['mtime'] = simple_ser(
+            datetime.datetime.fromtimestamp(int(info['mtime'])))
+    return info
+
+
+def stream_json(head, key, items, serializer=None):
+    '''Yields the JSON for the *head* dict with *key* holding the list of
+    *items*, one item at a time.
+
+      >>> ''.join(stream_json({}, 'files', ['a', 'b']))
+      '{"files": ["a", "b"]}'
+      >>> sorted(simplejson.loads(''.join(stream_json(
+      ...     {'page_num': 1}, 'distros', [1, 2], lambda x: {'id': x}))).items())
+      [('distros', [{'id': 1}, {'id': 2}]), ('page_num', 1)]
+    '''
+
+    head = dumps(head)[:-1]
+    if head != '{':
+        head += ', '
+    yield '%s%s: [' % (head, dumps(key))
+    sep = ''
+    for item in items:
+        if serializer is not None:
+            item = serializer(item)
+        yield sep + dumps(item)
+        sep = ', '
+    yield ']}'
 
 
 class DistrosRoot(resource.Resource):
@@ -41,7 +159,7 @@ class DistrosRoot(resource.Resource):
       >>> class Mock(object):
       ...     def __init__(self, **kw):
       ...         self.__dict__.update(kw)
-      >>> root = DistrosRoot(Mock(get_distros=lambda x: []))
+      >>> root = DistrosRoot(Mock(iter_distros=lambda x: iter([])))
       >>> root.child_distro(None, [], None)
       (<clue.relmgr.restmodel.Distro object at ...>, [])
       >>> root.json(Mock(params={},
@@ -63,38 +181,34 @@ class DistrosRoot(resource.Resource):
         distreq = req.params.get('req', None)
         base_url = req.url
         if distreq:
-            reqs = self.pypi.find_req(distreq)
-            distros = []
-            for d, files in reqs:
-                distros.append({'id': d.distro_id,
-                                'name': d.name,
-                                'last_updated': simple_ser(d.last_updated),
-                                'summary': d.summary,
-                                'files': [{'filename': os.path.basename(f),
-                                           'url': req.relative_url(d.distro_id + '/f/'+os.path.basename(f), True),
-                                           'version': v} for f, v in files]})
+            distros = self.pypi.iter_req(distreq)
+
+            def serializer(entry):
+                d, files = entry
+                res = serialize_distro_summary(d)
+                res['files'] = [{'filename': os.path.basename(f),
+                                 'url': req.relative_url(d.distro_id + '/f/'+os.path.basename(f), True),
+                                 'version': v} for f, v in files]
+                return res
             total_pages = -1
             page_num = -1
         else:
             if search:
-                results = self.pypi.search(search)
+                results = self.pypi.iter_search(search)
             else:
-                results = self.pypi.get_distros('last_updated desc')
-            page = utils.Page(results, page_num, 20)
-            distros = [{'id': x.distro_id,
-                        'name': x.name,
-                        'last_updated': simple_ser(x.last_updated),
-                        'summary': x.summary}
-                       for x in page.results]
+                results = self.pypi.iter_distros('last_updated desc')
+            page = utils.IterPage(results, page_num, 20)
+            distros = page.results
+            serializer = serialize_distro_summary
             total_pages = page.total_pages
             page_num = page.page_num
 
-        jsonres = {'distros': distros,
-                   'total_pages': total_pages,
-                   'page_num': page_num}
+        head = {'total_pages': total_pages,
+                'page_num': page_num}
         if search:
-            jsonres['search'] = search
-        return http.ok([], simplejson.dumps(jsonres))
+            head['search'] = search
+        return http.ok(JSON_HEADERS,
+                       stream_json(head, 'distros', distros, serializer))
 
 
 class Distro(resource.Resource):
@@ -139,7 +253,8 @@ class Distro(resource.Resource):
 
     @resource.GET(accept='application/json')
     def json(self, req):
-        return http.ok([], to_jsons(self.distro))
+        return http.ok(JSON_HEADERS,
+                       dumps(serialize_distro(self.distro)))
 
 
 class FilesRoot(resource.Resource):
@@ -150,16 +265,24 @@ class FilesRoot(resource.Resource):
 
     @resource.child('{filename}')
     def child_file(self, req, segments, filename):
-        for full in self.pypi.get_files(self.distro.distro_id):
-            if os.path.basename(full) == filename:
-                return File(self.pypi, self.distro, filename), segments
-        raise http.NotFoundError()
+        if self.pypi.stat_file(self.distro, filename) is None:
+            raise http.NotFoundError()
+        return File(self.pypi, self.distro, filename), segments
 
     @resource.GET(accept='application/json')
     def json(self, req):
-        files = [os.path.basename(x)
-                 for x in self.pypi.get_files(self.distro.distro_id)]
-        return http.ok([], simplejson.dumps({'files': files}))
+        """The names of all files of the distro, or with ``info=1`` the
+        info of all files as given by ``File``.
+        """
+
+        if req.params.get('info'):
+            files = self.pypi.get_files_info(self.distro)
+            serializer = serialize_file_info
+        else:
+            files = self.pypi.get_files(self.distro)
+            serializer = os.path.basename
+        return http.ok(JSON_HEADERS,
+                       stream_json({}, 'files', files, serializer))
 
 
 class File(resource.Resource):
@@ -171,17 +294,15 @@ class File(resource.Resource):
 
     @resource.GET(accept='application/json')
     def json(self, req):
-        for full in self.pypi.get_files(self.distro.distro_id):
-            if os.path.basename(full) == self.filename:
-                return http.ok([],
-                               self.get_file_info(full))
-        raise http.NotFoundError()
+        info = self.get_file_info()
+        if info is None:
+            raise http.NotFoundError()
+        return http.ok(JSON_HEADERS, dumps(info))
 
-    def get_file_info(self, filename):
-        base = os.path.basename(filename)
-        st = os.stat(filename)
-        return simplejson.dumps({'filename': base,
-                                 'size': st.st_size})
+    def get_file_info(self):
+        info = self.pypi.get_file_info(self.distro, self.filename)
+        if info is not None:
+            return serialize_file_info(info)
 
 
 class IndexesRoot(resource.Resource):
@@ -221,12 +342,13 @@ class IndexesRoot(resource.Resource):
                 if opt not in ('==', '='):
                     raise ValueError('Bad req option "%s" for "%s"' %
                                      (str(opt), x))
-                target_distro_id = utils.make_distro_id(target_name)
+                target_distro_id = self.pypi.find_distro_id(target_name) or \
+                                   utils.make_distro_id(target_name)
                 self.pypi.index_manager.add_index_item(distro_id,
                                                        indexname,
                                                        target_distro_id,
                                                        target_version)
-        return http.ok([], simplejson.dumps({'indexes': altered}))
+        return http.ok(JSON_HEADERS, dumps({'indexes': altered}))
 
     @resource.GET(accept='application/json')
     def json(self, req):
@@ -240,7 +362,7 @@ class IndexesRoot(resource.Resource):
             if filter_indexname == x:
                 index = Index(self.pypi, self.distro, x)
                 indexes.append(index.get_index_dict(base_url))
-        return http.ok([], simplejson.dumps({'indexes': indexes}))
+        return http.ok(JSON_HEADERS, dumps({'indexes': indexes}))
 
 
 class Index(resource.Resource):
@@ -251,7 +373,7 @@ class Index(resource.Resource):
         self.indexname = indexname
 
     def get_index_dict(self, base_url):
-        index = self.pypi.get_index(self.distro.distro_id, self.indexname)
+        index = self.pypi.get_index(self.distro, self.indexname)
         entries = []
         for target_distro, distro, filename in index:
             target_distro_id = get_distro_id(target_distro)
@@ -291,23 +413,24 @@ class Index(resource.Resource):
             if opt not in ('==', '='):
                 raise ValueError('Bad req option "%s" for "%s"' %
                                  (str(opt), x))
-            target_distro_id = utils.make_distro_id(target_name)
+            target_distro_id = self.pypi.find_distro_id(target_name) or \
+                               utils.make_distro_id(target_name)
             self.pypi.index_manager.add_index_item(distro_id,
                                                    indexname,
                                                    target_distro_id,
                                                    target_version)
-        return http.ok([], simplejson.dumps({'entries': entries}))
+        return http.ok(JSON_HEADERS, dumps({'entries': entries}))
 
     @resource.DELETE(accept='application/json')
     def delete(self, req):
         self.pypi.index_manager.remove_index(self.distro.distro_id,
                                              self.indexname)
-        return http.ok([], simplejson.dumps({'indexname': self.indexname}))
+        return http.ok(JSON_HEADERS, dumps({'indexname': self.indexname}))
 
     @resource.GET(accept='application/json')
     def json(self, req):
         base_url = '/'.join(req.url.split('/')[:-3])
-        return http.ok([], simplejson.dumps(self.get_index_dict(base_url)))
+        return http.ok(JSON_HEADERS, dumps(self.get_index_dict(base_url)))
 
 
 def get_distro_id(distro):
@@ -0,0 +1,231 @@
+from __future__ import with_statement
+import threading
+import time
+
+try:
+    from sqlalchemy import event
+except ImportError:
+    event = None
+try:
+    from sqlalchemy.interfaces import ConnectionProxy
+except ImportError:
+    ConnectionProxy = object
+from werkzeug import ClosingIterator
+
+from clue.relmgr import utils
+
+
+class QueryBudgetExceeded(AssertionError):
+
+    def __init__(self, label, limit, statements):
+        self.label = label
+        self.limit = limit
+        self.statements = statements
+        AssertionError.__init__(
+            self, '%s executed %i SQL statement(s), the budget is %i:\n%s'
+            % (label, len(statements), limit,
+               '\n'.join(['  ' + ' '.join(x.split()) for x in statements])))
+
+
+class QueryStats(object):
+    """Counts the SQL statements executed on the engines it is attached
+    to, in total and for the current thread.
+
+      >>> import sqlalchemy as sa
+      >>> stats = QueryStats()
+      >>> engine = sa.create_engine('sqlite://', **stats.engine_options())
+      >>> stats.attach(engine)
+      >>> ignored = engine.execute('SELECT 1')
+      >>> ignored = engine.execute('SELECT 2')
+      >>> stats.count, stats.local_count()
+      (2, 2)
+
+    The count for the current thread can be reset, e.g. per request.
+
+      >>> stats.reset_local()
+      >>> ignored = engine.execute('SELECT 3')
+      >>> stats.count, stats.local_count()
+      (3, 1)
+
+    A budget limits the statements a block of code may execute, the
+    statements are listed when it is exceeded.
+
+      >>> with stats.budget(2, 'two selects'):
+      ...     ignored = engine.execute('SELECT 4')
+      ...     ignored = engine.execute('SELECT 5')
+      >>> with stats.budget(1, 'one select'):
+      ...     ignored = engine.execute('SELECT 6')
+      ...     ignored = engine.execute('SELECT 7')
+      Traceback (most recent call last):
+      QueryBudgetExceeded: one select executed 2 SQL statement(s), the budget is 1:
+        SELECT 6
+        SELECT 7
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def engine_options(self):
+        """Keyword arguments for ``sqlalchemy.create_engine``, only needed
+        for SQLAlchemy versions without the event API.
+        """
+
+        if event is not None:
+            return {}
+        return {'proxy': _StatsProxy(self)}
+
+    def attach(self, engine):
+        if event is None:
+            return
+
+        def before(conn, cursor, statement, parameters, context, many):
+            conn.info.setdefault('clue.relmgr.sqlstats', []).append(
+                time.time())
+
+        def after(conn, cursor, statement, parameters, context, many):
+            started = conn.info['clue.relmgr.sqlstats'].pop()
+            self.record(time.time() - started, statement)
+
+        event.listen(engine, 'before_cursor_execute', before)
+        event.listen(engine, 'after_cursor_execute', after)
+
+    def record(self, duration, statement=None):
+        with self._lock:
+            self.count += 1
+            self.time += duration
+        local = self._local
+        local.count = getattr(local, 'count', 0) + 1
+        local.time = getattr(local, 'time', 0.0) + duration
+        statements = getattr(local, 'statements', None)
+        if statements is not None:
+            statements.append(statement)
+
+    def start_recording(self):
+        """Keep the statements executed by the current thread until
+        ``stop_recording`` is called.
+        """
+
+        self._local.statements = []
+
+    def stop_recording(self):
+        statements = getattr(self._local, 'statements', None) or []
+        self._local.statements = None
+        return statements
+
+    def budget(self, limit, label='block'):
+        """A context manager raising ``QueryBudgetExceeded`` if the
+        current thread executes more than *limit* statements in it.
+        """
+
+        return _Budget(self, limit, label)
+
+    def local_count(self):
+        return getattr(self._local, 'count', 0)
+
+    def local_time(self):
+        return getattr(self._local, 'time', 0.0)
+
+    def reset_local(self):
+        self._local.count = 0
+        self._local.time = 0.0
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.time = 0.0
+        self.reset_local()
+
+
+class _StatsProxy(ConnectionProxy):
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def cursor_execute(self, execute, cursor, statement, parameters,
+                       context, executemany):
+        started = time.time()
+        try:
+            return execute(cursor, statement, parameters, context)
+        finally:
+            self.stats.record(time.time() - started, statement)
+
+
+class _Budget(object):
+
+    def __init__(self, stats, limit, label):
+        self.stats = stats
+        self.limit = limit
+        self.label = label
+        self.statements = None
+
+    def __enter__(self):
+        self.stats.start_recording()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.statements = self.stats.stop_recording()
+        if exc_type is None and len(self.statements) > self.limit:
+            raise QueryBudgetExceeded(self.label, self.limit,
+                                      self.statements)
+
+
+class QueryBudgetMiddleware(object):
+    """Logs the statements of requests executing more SQL statements
+    than the budget in *budgets* for the name *endpoint_for* returns for
+    their environ, meant for debug mode.
+
+      >>> import sqlalchemy as sa
+      >>> stats = QueryStats()
+      >>> engine = sa.create_engine('sqlite://', **stats.engine_options())
+      >>> stats.attach(engine)
+      >>> def app(environ, start_response):
+      ...     for x in range(3):
+      ...         ignored = engine.execute('SELECT %i' % x)
+      ...     start_response('200 OK', [])
+      ...     return ['']
+      >>> class Logger(object):
+      ...     def warn(self, msg):
+      ...         print msg
+      >>> mw = QueryBudgetMiddleware(app, stats, {'/a': 5, '/b': 2},
+      ...                            lambda environ: environ['PATH_INFO'],
+      ...                            Logger())
+      >>> def start(status, headers, exc_info=None):
+      ...     pass
+      >>> mw({'PATH_INFO': '/a'}, start).close()
+      >>> mw({'PATH_INFO': '/b'}, start).close()
+      /b executed 3 SQL statement(s), the budget is 2:
+        SELECT 0
+        SELECT 1
+        SELECT 2
+    """
+
+    def __init__(self, app, stats, budgets, endpoint_for,
+                 logger=utils.logger):
+        self.app = app
+        self.stats = stats
+        self.budgets = budgets
+        self.endpoint_for = endpoint_for
+        self.logger = logger
+
+    def __call__(self, environ, start_response):
+        endpoint = self.endpoint_for(environ)
+        limit = self.budgets.get(endpoint)
+        if limit is None:
+            return self.app(environ, start_response)
+
+        self.stats.start_recording()
+        try:
+            app_iter = self.app(environ, start_response)
+        except:
+            self.stats.stop_recording()
+            raise
+
+        def check():
+            statements = self.stats.stop_recording()
+            if len(statements) > limit:
+                self.logger.warn(str(QueryBudgetExceeded(endpoint, limit,
+                                                         statements)))
+        return ClosingIterator(app_iter, check)
@@ -0,0 +1,881 @@
+from __future__ import with_statement
+import datetime
+import email.utils
+import errno
+import hashlib
+import hmac
+import httplib
+import os
+import shutil
+import StringIO
+import tempfile
+import thread
+import threading
+import time
+import urllib
+import urlparse
+from xml.etree import ElementTree
+
+from clue.relmgr import utils
+
+LAYOUT_MARKER = '.layout'
+
+
+class NoSuchFileError(IOError):
+    pass
+
+
+class LayoutError(Exception):
+    pass
+
+
+class FileStat(object):
+
+    def __init__(self, size, mtime):
+        self.size = size
+        self.mtime = mtime
+
+    def __repr__(self):
+        return '<FileStat size=%r>' % self.size
+
+
+class StorageWriter(object):
+    """Returned by ``Storage.write``, the written file only becomes
+    visible once the writer is closed, ``abort`` discards it instead.
+    """
+
+    def __init__(self, f, commit, discard):
+        self._f = f
+        self._commit = commit
+        self._discard = discard
+        self.closed = False
+
+    def write(self, data):
+        self._f.write(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._commit(self._f)
+
+    def abort(self):
+        if not self.closed:
+            self.closed = True
+            self._discard(self._f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class Storage(object):
+    """Where the files of distros are kept.  Files are identified by
+    their distro_id and filename, ``path`` and ``list`` return locations
+    whose basename is the filename.
+    """
+
+    name = None
+
+    def path(self, distro_id, filename):
+        raise NotImplementedError()
+
+    def list(self, distro_id):
+        raise NotImplementedError()
+
+    def stat(self, distro_id, filename):
+        """A ``FileStat`` for the file or None if there is no such file."""
+
+        raise NotImplementedError()
+
+    def open(self, distro_id, filename):
+        """A file-like object to read the file from, raises
+        ``NoSuchFileError`` if there is no such file.
+        """
+
+        raise NotImplementedError()
+
+    def write(self, distro_id, filename):
+        """A ``StorageWriter`` to write the file to."""
+
+        raise NotImplementedError()
+
+    def delete(self, distro_id, filename):
+        raise NotImplementedError()
+
+    def store(self, distro_id, content):
+        opened = content.setup_stream()
+        try:
+            with self.write(distro_id, content.filename) as writer:
+                while True:
+                    data = opened.read(65536)
+                    if not data:
+                        break
+                    writer.write(data)
+        finally:
+            opened.close()
+
+
+class DirectoryLayout(Storage):
+    """Stores files as *basefiledir*/<first letter>/<distro_id>/<filename>.
+
+      >>> tmpdir = tempfile.mkdtemp()
+      >>> layout = DirectoryLayout(tmpdir)
+      >>> layout.path('foo', 'foo-1.0.tar.gz')[len(tmpdir):]
+      '/f/foo/foo-1.0.tar.gz'
+      >>> layout.list('foo')
+      []
+      >>> layout.store('foo', utils.StringContent('foo-1.0.zip', 'abc'))
+      >>> layout.stat('foo', 'foo-1.0.zip')
+      <FileStat size=3>
+      >>> layout.open('foo', 'foo-1.0.zip').read()
+      'abc'
+
+    Files only show up once they have been written completely.
+
+      >>> writer = layout.write('foo', 'foo-2.0.zip')
+      >>> writer.write('abc')
+      >>> layout.stat('foo', 'foo-2.0.zip') is None
+      True
+      >>> writer.abort()
+      >>> [os.path.basename(x) for x in layout.list('foo')]
+      ['foo-1.0.zip']
+
+      >>> layout.delete('foo', 'foo-1.0.zip')
+      >>> layout.open('foo', 'foo-1.0.zip')
+      Traceback (most recent call last):
+      NoSuchFileError: ...
+      >>> shutil.rmtree(tmpdir)
+    """
+
+    name = 'directory'
+
+    def __init__(self, basefiledir):
+        self.basefiledir = basefiledir
+
+    def distro_dir(self, distro_id):
+        return os.path.join(self.basefiledir, distro_id[0], distro_id)
+
+    def path(self, distro_id, filename):
+        return os.path.join(self.distro_dir(distro_id), filename)
+
+    def list(self, distro_id):
+        distrodir = self.distro_dir(distro_id)
+        res = []
+        if os.path.exists(distrodir):
+            for fname in os.listdir(distrodir):
+                if fname.startswith('.'):
+                    continue
+                res.append(os.path.join(distrodir, fname))
+        return res
+
+    def stat(self, distro_id, filename):
+        try:
+            st = os.stat(self.path(distro_id, filename))
+        except OSError:
+            return None
+        return FileStat(st.st_size, st.st_mtime)
+
+    def open(self, distro_id, filename):
+        try:
+            return open(self.path(distro_id, filename), 'rb')
+        except IOError, err:
+            raise NoSuchFileError(str(err))
+
+    def write(self, distro_id, filename):
+        target = self.path(distro_id, filename)
+        targetdir = os.path.dirname(target)
+        if not os.path.exists(targetdir):
+            os.makedirs(targetdir)
+        # write to a hidden file first so a partially written file is
+        # never listed under its real name
+        fd, tmp = tempfile.mkstemp(suffix='.part', prefix='.' + filename,
+                                   dir=targetdir)
+
+        def commit(f):
+            f.close()
+            os.chmod(tmp, 0644)
+            os.rename(tmp, target)
+
+        return StorageWriter(os.fdopen(fd, 'wb'), commit, _discard(tmp))
+
+    def delete(self, distro_id, filename):
+        path = self.path(distro_id, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def distro_ids(self):
+        for letter in os.listdir(self.basefiledir):
+            letterdir = os.path.join(self.basefiledir, letter)
+            if len(letter) != 1 or not os.path.isdir(letterdir):
+                continue
+            for distro_id in os.listdir(letterdir):
+                yield distro_id
+
+
+def _discard(tmp):
+    def discard(f):
+        f.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return discard
+
+
+def _shard(hexdigest, depth):
+    return [hexdigest[x*2:x*2+2] for x in range(depth)]
+
+
+class HashedLayout(DirectoryLayout):
+    """Stores each distinct file once as *basefiledir*/blobs/ab/cd/<sha256>
+    with the file names of each distro hard-linked to their blob from
+    *basefiledir*/distros/<shard>/<distro_id>/<filename>, the distro
+    directories being sharded by the sha1 of the distro_id.
+
+      >>> tmpdir = tempfile.mkdtemp()
+      >>> layout = HashedLayout(tmpdir)
+      >>> layout.store('foo', utils.StringContent('foo-1.0.zip', 'abc'))
+      >>> layout.store('bar', utils.StringContent('bar-1.0.zip', 'abc'))
+      >>> [os.path.basename(x) for x in layout.list('foo')]
+      ['foo-1.0.zip']
+      >>> layout.open('bar', 'bar-1.0.zip').read()
+      'abc'
+
+    Identical content is only stored once.
+
+      >>> layout.blob_path(layout.path('foo', 'foo-1.0.zip')) == \\
+      ...     layout.blob_path(layout.path('bar', 'bar-1.0.zip'))
+      True
+      >>> os.stat(layout.path('foo', 'foo-1.0.zip')).st_nlink
+      3
+      >>> shutil.rmtree(tmpdir)
+    """
+
+    name = 'hashed'
+    depth = 2
+
+    def distro_dir(self, distro_id):
+        digest = hashlib.sha1(distro_id).hexdigest()
+        return os.path.join(self.basefiledir, 'distros',
+                            *(_shard(digest, self.depth) + [distro_id]))
+
+    def blob_path(self, path):
+        """The blob holding the content of the file at *path*."""
+
+        return self._blob_path(_sha256(path))
+
+    def _blob_path(self, hexdigest):
+        return os.path.join(self.basefiledir, 'blobs',
+                            *(_shard(hexdigest, self.depth) + [hexdigest]))
+
+    def write(self, distro_id, filename):
+        tmpdir = os.path.join(self.basefiledir, 'blobs', 'tmp')
+        if not os.path.exists(tmpdir):
+            os.makedirs(tmpdir)
+        fd, tmp = tempfile.mkstemp(dir=tmpdir)
+
+        def commit(f):
+            f.close()
+            os.chmod(tmp, 0644)
+            try:
+                self._link(distro_id, filename, tmp)
+            finally:
+                os.remove(tmp)
+
+        return StorageWriter(os.fdopen(fd, 'wb'), commit, _discard(tmp))
+
+    def import_file(self, distro_id, path):
+        """Link the file at *path* in as one of *distro_id*'s files, the
+        file at *path* is removed.
+        """
+
+        self._link(distro_id, os.path.basename(path), path)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _link(self, distro_id, filename, source):
+        blob = self._blob_path(_sha256(source))
+        target = self.path(distro_id, filename)
+        if os.path.exists(target) and os.path.exists(blob) and \
+               os.path.samefile(target, blob):
+            return
+        targetdir = os.path.dirname(target)
+        if not os.path.exists(targetdir):
+            os.makedirs(targetdir)
+        # link under a hidden name first so the file appears atomically
+        tmp = os.path.join(targetdir, '.%s.%i-%i.link'
+                           % (filename, os.getpid(), thread.get_ident()))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        while True:
+            self._store_blob(source, blob)
+            try:
+                _link_or_copy(blob, tmp)
+            except (IOError, OSError), err:
+                if err.errno != errno.ENOENT:
+                    raise
+                # the blob got garbage collected in the meantime
+                continue
+            break
+        replaced = None
+        if os.path.exists(target):
+            replaced = self.blob_path(target)
+        os.rename(tmp, target)
+        if replaced is not None:
+            _remove_unlinked(replaced)
+
+    def _store_blob(self, source, blob):
+        if os.path.exists(blob):
+            return
+        blobdir = os.path.dirname(blob)
+        if not os.path.exists(blobdir):
+            os.makedirs(blobdir)
+        try:
+            _link_or_copy(source, blob)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+            # stored by a concurrent writer, the content is the same
+
+    def delete(self, distro_id, filename):
+        """Remove the file, and its blob once no other file links to it.
+
+          >>> tmpdir = tempfile.mkdtemp()
+          >>> layout = HashedLayout(tmpdir)
+          >>> layout.store('foo', utils.StringContent('foo-1.0.zip', 'abc'))
+          >>> layout.store('bar', utils.StringContent('bar-1.0.zip', 'abc'))
+          >>> blob = layout.blob_path(layout.path('foo', 'foo-1.0.zip'))
+          >>> layout.delete('foo', 'foo-1.0.zip')
+          >>> os.path.exists(blob)
+          True
+          >>> layout.delete('bar', 'bar-1.0.zip')
+          >>> os.path.exists(blob)
+          False
+
+        Replacing a file with other content releases the old blob too.
+
+          >>> layout.store('foo', utils.StringContent('foo-1.0.zip', 'abc'))
+          >>> blob = layout.blob_path(layout.path('foo', 'foo-1.0.zip'))
+          >>> layout.store('foo', utils.StringContent('foo-1.0.zip', 'xyz'))
+          >>> os.path.exists(blob)
+          False
+          >>> sorted(os.listdir(os.path.dirname(layout.path('foo', 'x'))))
+          ['foo-1.0.zip']
+          >>> shutil.rmtree(tmpdir)
+        """
+
+        path = self.path(distro_id, filename)
+        if not os.path.exists(path):
+            return
+        blob = self.blob_path(path)
+        os.remove(path)
+        _remove_unlinked(blob)
+
+    def distro_ids(self):
+        top = os.path.join(self.basefiledir, 'distros')
+        for dirpath, dirnames, filenames in os.walk(top):
+            if len(dirpath[len(top):].split(os.sep)) - 1 == self.depth:
+                for distro_id in dirnames:
+                    yield distro_id
+                del dirnames[:]
+
+    def migrate(self, progress_file=None, logger=utils.logger):
+        """Move all files stored using the ``DirectoryLayout`` in place.
+        Distros that have been migrated are recorded in *progress_file*
+        so an interrupted migration picks up where it left off.  Returns
+        the number of files migrated.
+
+          >>> tmpdir = tempfile.mkdtemp()
+          >>> old = DirectoryLayout(tmpdir)
+          >>> old.store('foo', utils.StringContent('foo-1.0.zip', 'abc'))
+          >>> old.store('bar', utils.StringContent('bar-1.0.zip', 'abc'))
+          >>> layout = HashedLayout(tmpdir)
+          >>> layout.migrate()
+          2
+          >>> sorted(os.listdir(tmpdir))
+          ['.layout', 'blobs', 'distros']
+          >>> sorted(layout.distro_ids())
+          ['bar', 'foo']
+          >>> open(layout.path('foo', 'foo-1.0.zip')).read()
+          'abc'
+
+        Running it again does nothing.
+
+          >>> layout.migrate()
+          0
+          >>> shutil.rmtree(tmpdir)
+        """
+
+        if progress_file is None:
+            progress_file = os.path.join(self.basefiledir,
+                                         '.migration-progress')
+        done = set()
+        if os.path.exists(progress_file):
+            with open(progress_file) as f:
+                done = set([x.strip() for x in f if x.strip()])
+
+        old = DirectoryLayout(self.basefiledir)
+        count = 0
+        with open(progress_file, 'a') as progress:
+            for distro_id in sorted(old.distro_ids()):
+                if distro_id in done:
+                    continue
+                for path in old.list(distro_id):
+                    self.import_file(distro_id, path)
+                    count += 1
+                distrodir = old.distro_dir(distro_id)
+                if os.path.exists(distrodir) and not os.listdir(distrodir):
+                    os.rmdir(distrodir)
+                progress.write(distro_id + '\n')
+                progress.flush()
+                logger.info('Migrated files of "%s"' % distro_id)
+
+        for letter in os.listdir(self.basefiledir):
+            letterdir = os.path.join(self.basefiledir, letter)
+            if len(letter) == 1 and os.path.isdir(letterdir) \
+                   and not os.listdir(letterdir):
+                os.rmdir(letterdir)
+        mark_layout(self.basefiledir, self.name)
+        os.remove(progress_file)
+        return count
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def _remove_unlinked(blob):
+    try:
+        if os.stat(blob).st_nlink == 1:
+            os.remove(blob)
+    except OSError:
+        pass
+
+
+def _link_or_copy(source, target):
+    """Hard link *source* as *target*, or copy it if that isn't possible.
+    Raises an OSError with errno EEXIST if *target* exists.  Copies are
+    written to a temporary file renamed to *target*, so a file linked
+    from elsewhere is never written through.
+    """
+
+    if hasattr(os, 'link'):
+        try:
+            os.link(source, target)
+            return
+        except OSError, err:
+            if err.errno in (errno.EEXIST, errno.ENOENT):
+                raise
+    if os.path.exists(target):
+        raise OSError(errno.EEXIST, 'File exists', target)
+    fd, tmp = tempfile.mkstemp(prefix='.', suffix='.part',
+                               dir=os.path.dirname(target))
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            with open(source, 'rb') as src:
+                shutil.copyfileobj(src, f)
+        finally:
+            f.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, target)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class MemoryStorage(Storage):
+    """Keeps all files in memory, meant for tests and benchmarks.
+
+      >>> storage = MemoryStorage()
+      >>> storage.store('foo', utils.StringContent('foo-1.0.zip', 'abc'))
+      >>> storage.list('foo')
+      ['memory:foo/foo-1.0.zip']
+      >>> storage.stat('foo', 'foo-1.0.zip')
+      <FileStat size=3>
+      >>> storage.open('foo', 'foo-1.0.zip').read()
+      'abc'
+      >>> storage.delete('foo', 'foo-1.0.zip')
+      >>> storage.stat('foo', 'foo-1.0.zip') is None
+      True
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def path(self, distro_id, filename):
+        return 'memory:%s/%s' % (distro_id, filename)
+
+    def list(self, distro_id):
+        with self._lock:
+            return [self.path(distro_id, x)
+                    for x in sorted(self._files.get(distro_id, {}))]
+
+    def stat(self, distro_id, filename):
+        with self._lock:
+            stored = self._files.get(distro_id, {}).get(filename)
+        if stored is None:
+            return None
+        data, mtime = stored
+        return FileStat(len(data), mtime)
+
+    def open(self, distro_id, filename):
+        with self._lock:
+            stored = self._files.get(distro_id, {}).get(filename)
+        if stored is None:
+            raise NoSuchFileError(self.path(distro_id, filename))
+        return StringIO.StringIO(stored[0])
+
+    def write(self, distro_id, filename):
+        def commit(f):
+            with self._lock:
+                files = self._files.setdefault(distro_id, {})
+                files[filename] = (f.getvalue(), time.time())
+            f.close()
+
+        return StorageWriter(StringIO.StringIO(), commit, lambda f: f.close())
+
+    def delete(self, distro_id, filename):
+        with self._lock:
+            self._files.get(distro_id, {}).pop(filename, None)
+
+
+EMPTY_SHA256 = hashlib.sha256('').hexdigest()
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg, hashlib.sha256).digest()
+
+
+def sign_v4(method, host, path, query, headers, payload_hash,
+            access_key, secret_key, region, now=None):
+    """Add the headers of an AWS signature version 4 signed S3 request
+    to *headers*.
+    """
+
+    if now is None:
+        now = datetime.datetime.utcnow()
+    amzdate = now.strftime('%Y%m%dT%H%M%SZ')
+    datestamp = now.strftime('%Y%m%d')
+    headers['x-amz-date'] = amzdate
+    headers['x-amz-content-sha256'] = payload_hash
+
+    signed = dict((k.lower(), str(v).strip()) for k, v in headers.items())
+    signed['host'] = host
+    names = sorted(signed)
+    canonical = '\n'.join([
+        method,
+        path,
+        '&'.join(['%s=%s' % (urllib.quote(k, safe='-_.~'),
+                             urllib.quote(v, safe='-_.~'))
+                  for k, v in sorted(query)]),
+        ''.join(['%s:%s\n' % (x, signed[x]) for x in names]),
+        ';'.join(names),
+        payload_hash])
+
+    scope = '%s/%s/s3/aws4_request' % (datestamp, region)
+    to_sign = '\n'.join(['AWS4-HMAC-SHA256', amzdate, scope,
+                         hashlib.sha256(canonical).hexdigest()])
+    key = _hmac('AWS4' + secret_key, datestamp)
+    for x in (region, 's3', 'aws4_request'):
+        key = _hmac(key, x)
+    signature = hmac.new(key, to_sign, hashlib.sha256).hexdigest()
+    headers['Authorization'] = (
+        'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s'
+        % (access_key, scope, ';'.join(names), signature))
+    return headers
+
+
+class _Response(object):
+
+    def __init__(self, conn, response):
+        self._conn = conn
+        self._response = response
+
+    def read(self, *args):
+        return self._response.read(*args)
+
+    def close(self):
+        self._response.close()
+        self._conn.close()
+
+
+class S3Storage(Storage):
+    """Stores files in an S3 compatible object store as
+    <prefix><distro_id>/<filename> in *bucket*, using path style requests
+    against *endpoint*.  Requests are only signed if credentials are
+    given.
+
+      >>> from clue.relmgr.tests import StandInS3
+      >>> s3 = StandInS3(page_size=2)
+      >>> storage = S3Storage(s3.url, 'pkgs', 'files/', 'key', 'secret')
+      >>> storage.path('foo', 'foo-1.0.zip')
+      's3://pkgs/files/foo/foo-1.0.zip'
+      >>> for x in ('1.0', '1.1', '1.2'):
+      ...     storage.store('foo', utils.StringContent('foo-%s.zip' % x,
+      ...                                              'abc' + x))
+      >>> for x in storage.list('foo'):
+      ...     print x
+      s3://pkgs/files/foo/foo-1.0.zip
+      s3://pkgs/files/foo/foo-1.1.zip
+      s3://pkgs/files/foo/foo-1.2.zip
+      >>> storage.stat('foo', 'foo-1.1.zip')
+      <FileStat size=6>
+      >>> storage.open('foo', 'foo-1.1.zip').read()
+      'abc1.1'
+      >>> storage.delete('foo', 'foo-1.1.zip')
+      >>> storage.stat('foo', 'foo-1.1.zip') is None
+      True
+      >>> storage.open('foo', 'foo-1.1.zip')
+      Traceback (most recent call last):
+      NoSuchFileError: s3://pkgs/files/foo/foo-1.1.zip
+
+    All requests are signed.
+
+      >>> set([x[2].split()[0] for x in s3.requests])
+      set(['AWS4-HMAC-SHA256'])
+      >>> s3.shutdown()
+    """
+
+    name = 's3'
+    timeout = 30
+
+    def __init__(self, endpoint, bucket, prefix='', access_key=None,
+                 secret_key=None, region='us-east-1'):
+        parsed = urlparse.urlsplit(endpoint)
+        self.secure = parsed[0] == 'https'
+        self.host = parsed[1]
+        self.bucket = bucket
+        self.prefix = prefix
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+
+    def key(self, distro_id, filename):
+        return '%s%s/%s' % (self.prefix, distro_id, filename)
+
+    def path(self, distro_id, filename):
+        return 's3://%s/%s' % (self.bucket, self.key(distro_id, filename))
+
+    def _request(self, method, key='', query=(), body=None,
+                 payload_hash=EMPTY_SHA256, headers=None):
+        path = urllib.quote('/%s/%s' % (self.bucket, key), safe='/-_.~')
+        headers = dict(headers or {})
+        if self.access_key:
+            sign_v4(method, self.host, path, query, headers, payload_hash,
+                    self.access_key, self.secret_key, self.region)
+        if query:
+            path += '?' + urllib.urlencode(sorted(query))
+
+        if self.secure:
+            conn = httplib.HTTPSConnection(self.host, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(self.host, timeout=self.timeout)
+        conn.request(method, path, body, headers)
+        return conn, conn.getresponse()
+
+    def _check(self, conn, response, *ok):
+        if response.status not in ok:
+            body = response.read()
+            conn.close()
+            raise IOError('S3 %s responded %i: %s'
+                          % (self.host, response.status, body[:200]))
+
+    def list(self, distro_id):
+        prefix = self.key(distro_id, '')
+        res = []
+        token = None
+        while True:
+            query = [('list-type', '2'), ('prefix', prefix)]
+            if token:
+                query.append(('continuation-token', token))
+            conn, response = self._request('GET', query=query)
+            self._check(conn, response, 200)
+            tree = ElementTree.fromstring(response.read())
+            conn.close()
+
+            token = None
+            truncated = False
+            for el in tree.getiterator():
+                tag = el.tag.split('}')[-1]
+                if tag == 'Key':
+                    filename = el.text[len(prefix):]
+                    if '/' not in filename:
+                        res.append(self.path(distro_id, filename))
+                elif tag == 'IsTruncated':
+                    truncated = el.text == 'true'
+                elif tag == 'NextContinuationToken':
+                    token = el.text
+            if not truncated or not token:
+                break
+        return res
+
+    def stat(self, distro_id, filename):
+        conn, response = self._request('HEAD', self.key(distro_id, filename))
+        response.read()
+        conn.close()
+        if response.status == 404:
+            return None
+        self._check(conn, response, 200)
+        mtime = None
+        modified = response.getheader('last-modified')
+        if modified:
+            mtime = email.utils.mktime_tz(email.utils.parsedate_tz(modified))
+        return FileStat(int(response.getheader('content-length')), mtime)
+
+    def open(self, distro_id, filename):
+        conn, response = self._request('GET', self.key(distro_id, filename))
+        if response.status == 404:
+            conn.close()
+            raise NoSuchFileError(self.path(distro_id, filename))
+        self._check(conn, response, 200)
+        return _Response(conn, response)
+
+    def write(self, distro_id, filename):
+        h = hashlib.sha256()
+        f = tempfile.TemporaryFile()
+
+        class HashingFile(object):
+            def write(self, data):
+                h.update(data)
+                f.write(data)
+
+            def close(self):
+                f.close()
+
+        def commit(hashing):
+            try:
+                size = f.tell()
+                f.seek(0)
+                conn, response = self._request(
+                    'PUT', self.key(distro_id, filename), body=f,
+                    payload_hash=h.hexdigest(),
+                    headers={'Content-Length': str(size)})
+                response.read()
+                conn.close()
+                self._check(conn, response, 200)
+            finally:
+                f.close()
+
+        return StorageWriter(HashingFile(), commit, lambda x: x.close())
+
+    def delete(self, distro_id, filename):
+        conn, response = self._request('DELETE',
+                                       self.key(distro_id, filename))
+        response.read()
+        conn.close()
+        self._check(conn, response, 200, 204, 404)
+
+
+LAYOUTS = {DirectoryLayout.name: DirectoryLayout,
+           HashedLayout.name: HashedLayout}
+
+
+def mark_layout(basefiledir, name):
+    if not os.path.exists(basefiledir):
+        os.makedirs(basefiledir)
+    with open(os.path.join(basefiledir, LAYOUT_MARKER), 'w') as f:
+        f.write(name + '\n')
+
+
+def get_layout(basefiledir, name=None):
+    """The layout used for *basefiledir*, a tree remembers its layout so
+    *name* is only used for new trees.
+
+      >>> tmpdir = tempfile.mkdtemp()
+      >>> get_layout(tmpdir).name
+      'directory'
+      >>> get_layout(tmpdir, 'hashed').name
+      'hashed'
+      >>> get_layout(tmpdir).name
+      'hashed'
+      >>> shutil.rmtree(tmpdir)
+
+    A tree already holding files in the directory layout has to be
+    migrated before it can use another layout.
+
+      >>> tmpdir = tempfile.mkdtemp()
+      >>> get_layout(tmpdir).store('foo', utils.StringContent('foo.zip', 'a'))
+      >>> get_layout(tmpdir, 'hashed')
+      Traceback (most recent call last):
+      LayoutError: "..." holds files in the directory layout; please run "cluerelmgr-admin migrate-storage"
+      >>> os.path.exists(os.path.join(tmpdir, LAYOUT_MARKER))
+      False
+      >>> get_layout(tmpdir).list('foo')
+      ['.../f/foo/foo.zip']
+      >>> shutil.rmtree(tmpdir)
+    """
+
+    marker = os.path.join(basefiledir, LAYOUT_MARKER)
+    if os.path.exists(marker):
+        with open(marker) as f:
+            existing = f.read().strip()
+        if name and name != existing:
+            utils.logger.warn('"%s" uses the %s layout, ignoring %s'
+                              % (basefiledir, existing, name))
+        return LAYOUTS[existing](basefiledir)
+
+    layout = LAYOUTS[name or DirectoryLayout.name](basefiledir)
+    if layout.name != DirectoryLayout.name:
+        # only new trees get marked, marking a tree with files in the
+        # directory layout would hide all of them
+        old = DirectoryLayout(basefiledir)
+        if os.path.isdir(basefiledir) and \
+               [x for x in old.distro_ids() if old.list(x)]:
+            raise LayoutError('"%s" holds files in the directory layout; '
+                              'please run "cluerelmgr-admin migrate-storage"'
+                              % basefiledir)
+        mark_layout(basefiledir, layout.name)
+    return layout
+
+
+def get_storage(basefiledir, url=None, layout=None):
+    """The storage to use for *url*, local storage in *basefiledir* if no
+    *url* is given.  Besides ``memory:`` S3 buckets can be given as
+    ``s3://bucket/prefix`` or, for other S3 compatible stores,
+    ``s3+http://host:port/bucket/prefix``, credentials are taken from the
+    AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY environment variables.
+
+      >>> get_storage('files', 'memory:')
+      <clue.relmgr.storage.MemoryStorage object ...>
+      >>> s3 = get_storage('files', 's3+http://localhost:9000/pkgs/files')
+      >>> s3.host, s3.bucket, s3.prefix
+      ('localhost:9000', 'pkgs', 'files/')
+    """
+
+    if not url:
+        return get_layout(basefiledir, layout)
+    if url == 'memory:':
+        return MemoryStorage()
+
+    scheme, rest = url.split(':', 1)
+    rest = rest.lstrip('/')
+    if scheme == 's3':
+        endpoint = 'https://s3.amazonaws.com'
+    elif scheme in ('s3+http', 's3+https'):
+        host, rest = rest.split('/', 1)
+        endpoint = '%s://%s' % (scheme[3:], host)
+    else:
+        raise ValueError('Unsupported storage "%s"' % url)
+    bucket, prefix = (rest.split('/', 1) + [''])[:2]
+    prefix = prefix.strip('/')
+    if prefix:
+        prefix += '/'
+    return S3Storage(endpoint, bucket, prefix,
+                     os.environ.get('AWS_ACCESS_KEY_ID'),
+                     os.environ.get('AWS_SECRET_ACCESS_KEY'),
+                     os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'))
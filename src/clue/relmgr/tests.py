@@ -1,7 +1,16 @@
+from __future__ import with_statement
 import os
+import shutil
 import unittest
 import doctest
 import logging
+import threading
+import time
+import urllib
+import urlparse
+import BaseHTTPServer
+import SimpleXMLRPCServer
+from xml.sax import saxutils
 from clue.relmgr import utils
 import sqlalchemy as sa
 from sqlalchemy import orm
@@ -23,6 +32,351 @@ def teardown_sql(test):
     os.remove(test.globs['dbfile'])
 
 
+class _CountingRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+
+    def do_POST(self):
+        self.server.index.round_trips += 1
+        SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.do_POST(self)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInIndex(object):
+    """A local stand-in for the XML-RPC interface of a package index,
+    serving the given {name: [version, ...]} distros and counting the
+    round trips made to it.
+    """
+
+    def __init__(self, distros, multicall=True):
+        self.distros = distros
+        self.round_trips = 0
+        self.server = SimpleXMLRPCServer.SimpleXMLRPCServer(
+            ('127.0.0.1', 0), requestHandler=_CountingRequestHandler,
+            logRequests=False, allow_none=True)
+        self.server.index = self
+        if multicall:
+            self.server.register_multicall_functions()
+        for x in ('search', 'package_releases',
+                  'release_data', 'release_urls'):
+            self.server.register_function(getattr(self, x), x)
+        self.url = 'http://127.0.0.1:%i/' % self.server.server_address[1]
+
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def search(self, spec):
+        return [{'name': x} for x in self.distros
+                if spec['name'].lower() in x.lower()]
+
+    def package_releases(self, name, show_hidden=False):
+        return list(self.distros.get(name, []))
+
+    def release_data(self, name, version):
+        return {'name': name, 'version': version,
+                'summary': '%s %s' % (name, version)}
+
+    def release_urls(self, name, version):
+        filename = '%s-%s.tar.gz' % (name, version)
+        return [{'filename': filename,
+                 'url': self.url + 'files/' + filename,
+                 'size': 0}]
+
+
+class _S3RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _parse(self):
+        s3 = self.server.s3
+        path, unused, query = self.path.partition('?')
+        s3.requests.append((self.command, path,
+                            self.headers.getheader('authorization')))
+        bucket, unused, key = urllib.unquote(path).lstrip('/').partition('/')
+        return bucket, key, dict(urlparse.parse_qsl(query))
+
+    def _send(self, status, body='', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if 'Content-Length' not in dict(headers):
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _object(self, send_body):
+        bucket, key, query = self._parse()
+        stored = self.server.s3.objects.get((bucket, key))
+        if stored is None:
+            self._send(404)
+            return
+        data, mtime = stored
+        headers = [('Content-Length', str(len(data))),
+                   ('Last-Modified', self.date_time_string(mtime))]
+        self._send(200, send_body and data or '', headers)
+
+    def do_HEAD(self):
+        self._object(False)
+
+    def do_GET(self):
+        if self.path.partition('?')[2]:
+            self._list()
+        else:
+            self._object(True)
+
+    def _list(self):
+        s3 = self.server.s3
+        bucket, key, query = self._parse()
+        keys = sorted([k for b, k in s3.objects
+                       if b == bucket and k.startswith(query['prefix'])
+                       and k > query.get('continuation-token', '')])
+        page = keys[:s3.page_size]
+        body = ['<ListBucketResult xmlns='
+                '"http://s3.amazonaws.com/doc/2006-03-01/">']
+        body += ['<Contents><Key>%s</Key></Contents>' % saxutils.escape(x)
+                 for x in page]
+        if len(keys) > len(page):
+            body.append('<IsTruncated>true</IsTruncated>'
+                        '<NextContinuationToken>%s</NextContinuationToken>'
+                        % saxutils.escape(page[-1]))
+        else:
+            body.append('<IsTruncated>false</IsTruncated>')
+        body.append('</ListBucketResult>')
+        self._send(200, ''.join(body))
+
+    def do_PUT(self):
+        bucket, key, query = self._parse()
+        data = self.rfile.read(int(self.headers.getheader('content-length')))
+        self.server.s3.objects[(bucket, key)] = (data, time.time())
+        self._send(200)
+
+    def do_DELETE(self):
+        bucket, key, query = self._parse()
+        self.server.s3.objects.pop((bucket, key), None)
+        self._send(204)
+
+
+class StandInS3(object):
+    """A local stand-in for an S3 compatible object store, recording the
+    requests made to it and listing at most *page_size* keys at a time.
+    """
+
+    def __init__(self, page_size=1000):
+        self.objects = {}
+        self.requests = []
+        self.page_size = page_size
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                _S3RequestHandler)
+        self.server.s3 = self
+        self.url = 'http://127.0.0.1:%i' % self.server.server_address[1]
+
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class QueryBudgetTest(unittest.TestCase):
+    """Requests for a synthetic catalog must not execute more SQL
+    statements than the budgets of their endpoints allow, and listings
+    must not take more statements for a larger catalog, so new N+1
+    query patterns are caught.
+    """
+
+    username = 'user001'
+
+    def setUp(self):
+        from clue.relmgr import pypi, sqlstats
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.stats = sqlstats.QueryStats()
+        self.pypi = self.make_pypi(10)
+        pypi.active_info.username = self.username
+
+    def tearDown(self):
+        from clue.relmgr import pypi
+
+        pypi.active_info.username = None
+        shutil.rmtree(self.tmpdir)
+
+    def make_pypi(self, distros):
+        from clue.relmgr import bench, pypi
+
+        basedir = os.path.join(self.tmpdir, str(distros))
+        os.mkdir(basedir)
+        repo = bench.SyntheticRepo(basedir, distros=distros, users=4,
+                                   groups=2, indexes=3)
+        level = utils.logger.level
+        utils.logger.setLevel(logging.ERROR)
+        try:
+            repo.build()
+        finally:
+            utils.logger.setLevel(level)
+        res = pypi.PyPi(repo.basefiledir, repo.sqluri)
+        res.sql_stats = self.stats
+        res.setup_model()
+        return res
+
+    def check(self, app, budget, path, accept='text/html'):
+        """Request *path* from *app*, returns the number of statements
+        executed.
+        """
+
+        from werkzeug import Client, BaseResponse
+
+        client = Client(app, BaseResponse)
+        with self.stats.budget(budget, 'GET ' + path) as checked:
+            res = client.get(path, headers=[('Accept', accept)],
+                             environ_overrides={'REMOTE_USER':
+                                                self.username})
+            # the body is streamed, most of the work happens reading it
+            res.data
+        self.assertEqual(res.status_code, 200, path)
+        return len(checked.statements)
+
+    def test_restmodel(self):
+        from clue.relmgr import restmodel
+
+        app = restmodel.app_factory(self.pypi)
+        budgets = restmodel.QUERY_BUDGETS
+        json = 'application/json'
+        self.check(app, budgets['distros'], '/', json)
+        self.check(app, budgets['distro'], '/package0001', json)
+        self.check(app, budgets['files'], '/package0001/f/?info=1', json)
+        self.check(app, budgets['file'],
+                   '/package0001/f/Package0001-1.0.tar.gz', json)
+        self.check(app, budgets['indexes'], '/package0001/i/', json)
+        self.check(app, budgets['index'], '/package0001/i/prod', json)
+
+    def test_pypiinnerapp(self):
+        from clue.relmgr import wsgiapp
+
+        app = wsgiapp.PyPiInnerApp(self.pypi)
+        budgets = app.query_budgets
+        json = 'application/json'
+        self.check(app, budgets['root'], '/')
+        self.check(app, budgets['simple'], '/simple/', '*/*')
+        self.check(app, budgets['simple'], '/simple/package0001/', '*/*')
+        self.check(app, budgets['distro'], '/d/package0001/')
+        self.check(app, budgets['file'],
+                   '/d/package0001/f/Package0001-1.0.tar.gz', '*/*')
+        self.check(app, budgets['customindex'], '/d/package0001/i/prod')
+        self.check(app, budgets['search'], '/search?s=package')
+        self.check(app, budgets['distro_json'], '/d/', json)
+        self.check(app, budgets['distro_json'], '/d/package0001/', json)
+        self.check(app, budgets['file_json'], '/d/package0001/f/', json)
+        self.check(app, budgets['customindex_json'],
+                   '/d/package0001/i/prod', json)
+
+    def test_listings(self):
+        from clue.relmgr import restmodel, wsgiapp
+
+        larger = self.make_pypi(30)
+        json = 'application/json'
+        listings = [(restmodel.QUERY_BUDGETS['distros'], '/', json),
+                    (restmodel.QUERY_BUDGETS['distros'], '/?search=pack',
+                     json),
+                    (restmodel.QUERY_BUDGETS['distros'],
+                     '/?req=package0001', json)]
+        small = restmodel.app_factory(self.pypi)
+        large = restmodel.app_factory(larger)
+        for budget, path, accept in listings:
+            self.assertEqual(self.check(small, budget, path, accept),
+                             self.check(large, budget, path, accept),
+                             path)
+
+        budgets = wsgiapp.PyPiInnerApp.query_budgets
+        listings = [(budgets['root'], '/', 'text/html'),
+                    (budgets['simple'], '/simple/', '*/*'),
+                    (budgets['search'], '/search?s=package', 'text/html'),
+                    (budgets['distro_json'], '/d/', json)]
+        small = wsgiapp.PyPiInnerApp(self.pypi)
+        large = wsgiapp.PyPiInnerApp(larger)
+        for budget, path, accept in listings:
+            self.assertEqual(self.check(small, budget, path, accept),
+                             self.check(large, budget, path, accept),
+                             path)
+
+
+class QueryPlanTest(unittest.TestCase):
+    """The hot queries are answered through indexes rather than by
+    scanning or sorting whole tables.
+    """
+
+    def setUp(self):
+        from clue.relmgr import model
+
+        self.engine = sa.create_engine('sqlite:///:memory:')
+        model.migrate(self.engine)
+        self.session = orm.sessionmaker(bind=self.engine)()
+
+    def query_plan(self, query):
+        if hasattr(query, 'with_labels'):
+            query = query.with_labels().statement
+        compiled = query.compile(bind=self.engine)
+        params = [compiled.params[x] for x in compiled.positiontup]
+        rows = self.engine.execute('EXPLAIN QUERY PLAN ' + str(compiled),
+                                   params)
+        return ' / '.join([tuple(x)[-1] for x in rows])
+
+    def check(self, query, index):
+        plan = self.query_plan(query)
+        self.failUnless(index in plan and 'TEMP B-TREE' not in plan, plan)
+
+    def test_front_page(self):
+        from clue.relmgr import model
+
+        q = self.session.query(model.SQLDistro)
+        self.check(q.order_by('distros_last_updated desc'),
+                   'ix_distros_last_updated')
+
+    def test_roles(self):
+        from clue.relmgr import model
+
+        q = self.session.query(model.SQLRoleMapping)
+        self.check(q.filter_by(distro_id='foo', username='bar'),
+                   'ix_rolemappings_distro_id_username')
+        self.check(q.filter_by(distro_id='', groupname='bar'),
+                   'ix_rolemappings_distro_id_groupname')
+
+    def test_users_groups(self):
+        from clue.relmgr import model
+
+        table = model.users_groups_table
+        # the primary key leads with the username
+        self.check(sa.sql.select([table.c.groupname],
+                                 table.c.username == 'foo'),
+                   'sqlite_autoindex_users_groups_1')
+
+    def test_index_items(self):
+        from clue.relmgr import model
+
+        q = self.session.query(model.SQLIndexItem)
+        self.check(q.filter_by(distro_id='foo'),
+                   'ix_index_items_distro_id_indexname')
+        self.check(q.filter_by(distro_id='foo', indexname='prod'),
+                   'ix_index_items_distro_id_indexname')
+
+    def test_distro_names(self):
+        from clue.relmgr import model
+
+        q = self.session.query(model.SQLDistro.distro_id)
+        self.check(q.filter_by(normalized_name='foo'),
+                   'ix_distros_normalized_name')
+
+
 def test_suite():
     logging.basicConfig()
     utils.logger.setLevel(logging.ERROR)
@@ -41,6 +395,42 @@ def test_suite():
                                        optionflags=flags))
     suite.addTest(doctest.DocTestSuite('clue.relmgr.wsgiapp',
                                        optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.utils',
+                                       optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.cache',
+                                       optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.workers',
+                                       optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.locking',
+                                       optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.compress',
+                                       optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.storage',
+                                       optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.sqlstats',
+                                       optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.metrics',
+                                       optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.profiling',
+                                       optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.authcache',
+                                       optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.htpasswd',
+                                       optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.memory',
+                                       optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.bench',
+                                       optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.jobs',
+                                       setUp=setup_sql,
+                                       tearDown=teardown_sql,
+                                       optionflags=flags))
+    suite.addTest(doctest.DocTestSuite('clue.relmgr.mirror',
+                                       setUp=setup_sql,
+                                       tearDown=teardown_sql,
+                                       optionflags=flags))
+    suite.addTest(unittest.makeSuite(QueryBudgetTest))
+    suite.addTest(unittest.makeSuite(QueryPlanTest))
 
     return suite
 
@@ -1,8 +1,11 @@
 from __future__ import with_statement
 
+import hashlib
 import logging
 import os
-import pkg_resources
+import re
+import StringIO
+import sys
 import werkzeug
 from werkzeug import routing
 import urllib2
@@ -20,6 +23,45 @@ accesslogger = logging.getLogger('clue.relmgr[access   ]')
 accesslogger.setLevel(level=logging.INFO)
 
 
+class LazyModule(object):
+    """Stands in for the module *name*, which is only imported once one
+    of its attributes is used, so rarely needed heavy dependencies do not
+    slow down starting up.
+
+      >>> minidom = LazyModule('xml.dom.minidom')
+      >>> minidom
+      <LazyModule 'xml.dom.minidom'>
+      >>> minidom.parseString('<a/>').documentElement.tagName
+      u'a'
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            name = self.__dict__['_name']
+            __import__(name)
+            module = self.__dict__['_module'] = sys.modules[name]
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        return '<LazyModule %r>' % self.__dict__['_name']
+
+
+pkg_resources = LazyModule('pkg_resources')
+docutils = LazyModule('docutils')
+docutilscore = LazyModule('docutils.core')
+
+
 class respond(object):
 
     def __init__(self, func, content_type='text/html; charset=UTF-8'):
@@ -77,43 +119,106 @@ def update_obj(obj, **kwargs):
         setattr(obj, k, v)
 
 
+def memoized(maxsize=10000):
+    """Caches the results of a function of one hashable argument, the
+    cache is simply emptied once it holds *maxsize* results.
+
+      >>> calls = []
+      >>> @memoized(maxsize=2)
+      ... def double(x):
+      ...     calls.append(x)
+      ...     return x * 2
+      >>> double(1), double(1), double(2), double(3), double(1)
+      (2, 2, 4, 6, 2)
+      >>> calls
+      [1, 2, 3, 1]
+    """
+
+    def decorator(func):
+        results = {}
+
+        def wrapper(arg):
+            try:
+                return results[arg]
+            except KeyError:
+                pass
+            res = func(arg)
+            if len(results) >= maxsize:
+                results.clear()
+            results[arg] = res
+            return res
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+_distro_id_re = re.compile(r'-?[ =]+')
+
+
+@memoized()
 def make_distro_id(name):
     """Deduce a distro_id from the given name.
 
       >>> make_distro_id('Foo Bar  Cool')
       'foo-bar-cool'
+      >>> make_distro_id('a- =b')
+      'a-b'
     """
 
-    distro_id = ''
-    for x in name.lower():
-        if x in ' =':
-            if not distro_id.endswith('-'):
-                distro_id += '-'
-            continue
+    return _distro_id_re.sub('-', name.lower())
 
-        distro_id += x
 
-    return distro_id
+_normalize_re = re.compile(r'[-_. =]+')
 
 
-class AbstractContent(object):
+@memoized()
+def normalize_name(name):
+    """The canonical form of a project name, runs of ``-``, ``_`` and
+    ``.`` (and the separators ``make_distro_id`` replaces) become a single
+    ``-``, as pip and the simple index expect.
+
+      >>> normalize_name('Foo_Bar.baz--Cool')
+      'foo-bar-baz-cool'
+      >>> normalize_name(make_distro_id('Zope Interface'))
+      'zope-interface'
+    """
+
+    return _normalize_re.sub('-', name).lower()
 
-    def setup_stream(self):
-        raise NotImplementedError()
 
-    def save(self, dest):
-        opened = self.setup_stream()
+def format_rst(s):
+    """Render the given reStructuredText as an html fragment.
 
-        with open(dest, 'wb') as f:
-            bufsize = 1024
-            data = opened.read(bufsize)
-            f.write(data)
-            while len(data) == bufsize:
-                data = opened.read(bufsize)
-                if len(data) > 0:
-                    f.write(data)
+      >>> format_rst(u'Some *text*')
+      u'<div class="rst"><div class="document">...<em>text</em>...</div>'
+    """
+
+    published = docutilscore.publish_parts(
+        s, settings_overrides={'halt_level': 10},
+        writer_name='html')
+    return '<div class="rst">'+published['html_body']+'</div>'
+
+
+def rst_hash(s):
+    """Hash identifying the output of ``format_rst`` for *s*, it
+    changes when either the source or the docutils version changes.
 
-        opened.close()
+      >>> len(rst_hash(u'foo'))
+      40
+      >>> rst_hash(u'foo') == rst_hash(u'bar')
+      False
+    """
+
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return hashlib.sha1(docutils.__version__ + '\0' + s).hexdigest()
+
+
+class AbstractContent(object):
+
+    def setup_stream(self):
+        raise NotImplementedError()
 
 
 def get_content(v):
@@ -143,6 +248,57 @@ class UrlContent(AbstractContent):
         return urllib2.urlopen(self.url)
 
 
+class StringContent(AbstractContent):
+
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.data = data
+
+    def setup_stream(self):
+        return StringIO.StringIO(self.data)
+
+
+class DigestingContent(AbstractContent):
+    """Wraps *content*, keeping the size and the md5 and sha256 digests
+    of what gets read from it.
+
+      >>> content = DigestingContent(StringContent('foo-1.0.zip', 'abc'))
+      >>> stream = content.setup_stream()
+      >>> stream.read()
+      'abc'
+      >>> stream.close()
+      >>> content.size, content.md5.hexdigest()
+      (3, '900150983cd24fb0d6963f7d28e17f72')
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.filename = content.filename
+        self.size = 0
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+
+    def setup_stream(self):
+        return _DigestingStream(self, self.content.setup_stream())
+
+
+class _DigestingStream(object):
+
+    def __init__(self, content, stream):
+        self.content = content
+        self.stream = stream
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.content.size += len(data)
+        self.content.md5.update(data)
+        self.content.sha256.update(data)
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
 class Subset(object):
 
     def __init__(self, all, first, max):
@@ -178,6 +334,35 @@ class Page(Subset):
         return (self.page_num-1) * self.max
 
 
+class IterPage(Page):
+    """A page of *items*, an iterable that may be too large to hold in
+    memory; only the items on the requested page are kept.
+
+      >>> page = IterPage(iter(range(45)), 2, 20)
+      >>> page.full_item_count, page.total_pages
+      (45, 3)
+      >>> page.results[0], len(page.results)
+      (20, 20)
+    """
+
+    def __init__(self, items, page_num, per_page):
+        Page.__init__(self, None, page_num, per_page)
+        self._results = []
+        self._count = 0
+        for item in items:
+            if self.first <= self._count < self.first + self.max:
+                self._results.append(item)
+            self._count += 1
+
+    @property
+    def full_item_count(self):
+        return self._count
+
+    @property
+    def results(self):
+        return self._results
+
+
 class QueryPage(Page):
 
     def __init__(self, query, page_num, per_page):
@@ -2,17 +2,20 @@ from __future__ import with_statement
 import email
 import logging
 import os
-import pkg_resources
 import tempfile
 import subprocess
 import sys
 
+from clue.relmgr import utils
+
 try:
     import virtualenv
     virtualenv.logger = virtualenv.Logger([(logging.ERROR, sys.stdout)])
 except ImportError, e:
     raise EnvironmentError('Please install "virtualenv"')
 
+pkg_resources = utils.LazyModule('pkg_resources')
+
 
 class Distro(object):
 
@@ -0,0 +1,74 @@
+from __future__ import with_statement
+import Queue
+import threading
+
+from clue.relmgr import utils
+
+
+class WorkerPool(object):
+    """A pool of daemon threads running queued callables.
+
+      >>> pool = WorkerPool(2)
+      >>> results = []
+      >>> for x in range(5):
+      ...     pool.submit(results.append, x)
+      >>> pool.join()
+      >>> sorted(results)
+      [0, 1, 2, 3, 4]
+
+    Errors are logged and do not stop the workers.
+
+      >>> def fail():
+      ...     raise ValueError('bad')
+      >>> pool.submit(fail)
+      >>> pool.submit(results.append, 5)
+      >>> pool.join()
+      >>> results[-1]
+      5
+      >>> pool.depth
+      0
+    """
+
+    logger = utils.logger
+
+    def __init__(self, size=4, name='clue.relmgr-worker'):
+        self.size = size
+        self.name = name
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.size:
+                t = threading.Thread(target=self._work,
+                                     name='%s-%i' % (self.name,
+                                                     len(self._threads)))
+                t.setDaemon(True)
+                t.start()
+                self._threads.append(t)
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self._queue.get()
+            try:
+                try:
+                    func(*args, **kwargs)
+                except Exception:
+                    self.logger.exception('Error while running %r' % func)
+            finally:
+                self._queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        if len(self._threads) < self.size:
+            self._start()
+        self._queue.put((func, args, kwargs))
+
+    def join(self):
+        """Block until all queued work has been done."""
+
+        self._queue.join()
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
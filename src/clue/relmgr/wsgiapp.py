@@ -1,30 +1,43 @@
 from __future__ import with_statement
 import os
 import re
-import xmlrpclib
-import ConfigParser
 import htpasswd
 
 import werkzeug
 from werkzeug import exceptions as werkexc
-from repoze.who import (middleware as whomiddleware,
-                        config as repozewhoconfig, classifiers)
-from repoze.who.plugins import (basicauth,
-                                htpasswd as repozehtpasswd,
-                                sql)
 from werkzeug import routing
-import jinja2
-from docutils import core as docutilscore
-
-from clue.relmgr import utils, pypi, restmodel, model
-import cluedojo.wsgiapp as dojowsgi
-from clue.secure import wsgiapp as securewsgi
-from clue.secure import htpasswd as securehtpasswd
-from clue.secure import groupfile
-
-import pkg_resources
+import simplejson
+
+from clue.relmgr import utils, pypi, restmodel, model, cache, compress
+from clue.relmgr import authcache, jobs
+from clue.relmgr import memory, metrics, profiling, sqlstats
+from clue.relmgr.mirror import Mirror, MissCache
+
+# imported on first use, most of these are only needed once the app
+# gets built or a page gets rendered
+jinja2 = utils.LazyModule('jinja2')
+whomiddleware = utils.LazyModule('repoze.who.middleware')
+repozewhoconfig = utils.LazyModule('repoze.who.config')
+classifiers = utils.LazyModule('repoze.who.classifiers')
+basicauth = utils.LazyModule('repoze.who.plugins.basicauth')
+repozehtpasswd = utils.LazyModule('repoze.who.plugins.htpasswd')
+sql = utils.LazyModule('repoze.who.plugins.sql')
+dojowsgi = utils.LazyModule('cluedojo.wsgiapp')
+securewsgi = utils.LazyModule('clue.secure.wsgiapp')
+groupfile = utils.LazyModule('clue.secure.groupfile')
+
+_version = None
+
+
+def get_version():
+    """The installed version of ClueReleaseManager, looked up once.
+    """
 
-__version__ = pkg_resources.get_distribution('ClueReleaseManager').version
+    global _version
+    if _version is None:
+        _version = utils.pkg_resources.get_distribution(
+            'ClueReleaseManager').version
+    return _version
 
 APP_JSON_MIME_TYPE = 'application/json'
 
@@ -47,34 +60,89 @@ def format_datetime(dt, show_time=True):
     return 'N/A'
 
 
+class BoundTemplate(object):
+    """A template paired with the per-request context it gets rendered
+    with, keyword arguments given to ``render`` take precedence.
+
+      >>> env = jinja2.Environment()
+      >>> tmpl = BoundTemplate(env.from_string(u'{{ a }} {{ b }}'),
+      ...                      {'a': 1, 'b': 2})
+      >>> tmpl.render(b=3)
+      u'1 3'
+    """
+
+    def __init__(self, template, context):
+        self.template = template
+        self.context = context
+
+    def render(self, *args, **kwargs):
+        context = dict(self.context)
+        context.update(*args, **kwargs)
+        return self.template.render(context)
+
+
 class TemplateLoader(object):
+    """Loads templates, compiled templates are cached as bytecode in
+    *cache_dir* (the system temp dir by default) so they survive process
+    restarts.
+
+      >>> import tempfile, shutil
+      >>> cache_dir = tempfile.mkdtemp()
+      >>> loader = TemplateLoader(True, cache_dir=cache_dir)
+      >>> environ = {'SERVER_NAME': 'foo.com', 'wsgi.url_scheme': 'http',
+      ...            'SERVER_PORT': '80', 'REQUEST_METHOD': 'GET'}
+      >>> tmpl = loader.get_template('404.html', environ)
+      >>> tmpl.context['url_root']
+      u'http://foo.com/'
+      >>> len(os.listdir(cache_dir))
+      1
+
+    The dojo block is only built once per url root.
+
+      >>> block = loader.get_dojo_block(environ, tmpl.context['url_root'])
+      >>> loader.get_dojo_block(environ, u'http://foo.com/') is block
+      True
+      >>> shutil.rmtree(cache_dir)
+    """
 
     can_manage_security = False
 
-    def __init__(self, use_dojo, debug=False):
+    def __init__(self, use_dojo, debug=False, cache_dir=None):
         self.template_loader = jinja2.Environment(
-            loader=jinja2.PackageLoader('clue.relmgr', 'templates'))
+            loader=jinja2.PackageLoader('clue.relmgr', 'templates'),
+            bytecode_cache=jinja2.FileSystemBytecodeCache(cache_dir))
         self.template_loader.globals.update(dict(
             use_dojo = use_dojo,
             format_datetime = format_datetime))
         self.debug = debug
+        self._dojo_blocks = cache.LRUCache(100)
 
     def get_template(self, name, environ):
         req = werkzeug.Request(environ)
         tmpl = self.template_loader.get_template(name)
-        tmpl.globals['url_root'] = url_root = req.url_root
-        tmpl.globals['debug'] = debug = self.debug
-        tmpl.globals['can_manage_security'] = self.can_manage_security
+        context = {'url_root': req.url_root,
+                   'debug': self.debug,
+                   'can_manage_security': self.can_manage_security,
+                   'dojo_block': self.get_dojo_block(environ, req.url_root)}
+        return BoundTemplate(tmpl, context)
+
+    def get_dojo_block(self, environ, url_root):
+        debug = self.debug
+        key = (url_root, debug, environ.get('wsgi.url_scheme'))
+        block = self._dojo_blocks.get(key)
+        if block is not None:
+            return block
 
         if debug:
-            root = req.url_root
+            req = werkzeug.Request(environ)
+            root = url_root
             if root.endswith('/d/'):
                 root = root[:-3]
             if root.endswith('/'):
                 root = root[:-1]
             root = root[len(req.host_url):]
             dojo_root = root + '/dojo'
-            tmpl.globals['dojo_block'] = '''
+            block = '''
 <script type="text/javascript">
     djConfig = {
         isDebug: %(debug)s,
@@ -93,7 +161,7 @@ class TemplateLoader(object):
 ''' % {'dojo_root': dojo_root, 'root': root, 'debug': str(debug).lower()}
 
         else:
-            tmpl.globals['dojo_block'] = '''
+            block = '''
 <script type="text/javascript">
     djConfig = {
         baseUrl: '%(url_root)s',
@@ -106,10 +174,10 @@ class TemplateLoader(object):
     };
 </script>
 ''' % {'debug': str(debug).lower(), 'url_root': url_root}
-            tmpl.globals['dojo_block'] += dojowsgi.get_google_block(environ)
-
+            block += dojowsgi.get_google_block(environ)
 
-        return tmpl
+        self._dojo_blocks.set(key, block)
+        return block
 
 
 class HTTPNoSuchDistroError(werkexc.NotFound, model.NoSuchDistroError):
@@ -161,11 +229,12 @@ class AbstractPyPiApp(object):
     logger = utils.logger
     urlmap = None
 
-    def __init__(self, pypi, debug=False):
+    def __init__(self, pypi, debug=False, templates=None):
         self.pypi = pypi
         self.debug = debug
-        self.templates = TemplateLoader(use_dojo=True,
-                                        debug=debug)
+        if templates is None:
+            templates = TemplateLoader(use_dojo=True, debug=debug)
+        self.templates = templates
 
     def __call__(self, environ, start_response):
         if self.urlmap is None:
@@ -194,7 +263,7 @@ class AbstractPyPiApp(object):
             tmpl = self.templates.get_template('404.html', environ)
             req = werkzeug.Request(environ)
             res = werkzeug.Response(tmpl.render(exc=exc,
-                                                version=__version__),
+                                                version=get_version()),
                                     content_type='text/html; charset=UTF-8',
                                     status=404)
             return res(environ, start_response)
@@ -227,9 +296,13 @@ class SimpleIndexApp(AbstractPyPiApp):
     urlmap.add(routing.Rule('/', endpoint='index'))
     urlmap.add(routing.Rule('/<distro_id>/', endpoint='distro'))
 
-    def __init__(self, pypi, backup_pypis=[], debug=False):
-        super(SimpleIndexApp, self).__init__(pypi, debug)
+    def __init__(self, pypi, backup_pypis=[], debug=False, templates=None,
+                 mirror=None):
+        super(SimpleIndexApp, self).__init__(pypi, debug, templates)
         self.backup_pypis = backup_pypis
+        if mirror is None and backup_pypis:
+            mirror = Mirror(pypi, backup_pypis)
+        self.mirror = mirror
 
     @utils.respond
     def respond_index(self, req):
@@ -244,63 +317,37 @@ class SimpleIndexApp(AbstractPyPiApp):
     def respond_distro(self, req, distro_id):
         yield u'<html><body><ul>\n'
 
-        distro_id = utils.make_distro_id(distro_id)
-
-        distro = self.pypi.get_distro(distro_id)
-        if distro is None and self.backup_pypis:
-            if not try_to_update(self.pypi, distro_id, self.backup_pypis):
+        distro = self.pypi.get_distro(distro_name=distro_id)
+        if distro is not None:
+            distro_id = distro.distro_id
+        else:
+            distro_id = utils.make_distro_id(distro_id)
+        if distro is None and self.mirror is not None:
+            if not self.mirror.update(distro_id):
                 raise HTTPNoSuchDistroError(distro_id)
 
-        for fname in self.pypi.get_files(distro_id):
+        # the loaded distro spares looking it up again for the checks
+        target = distro or distro_id
+        listed = set()
+        for fname in self.pypi.get_files(target):
             base = os.path.basename(fname)
+            listed.add(base)
             url = '../../d/'+distro_id+'/f/'+base
             yield u'<li><a href="%s">%s</a></li>\n' % (url, base)
 
-        yield u'</ul></body></html>'
-
-
-def _get_remote_info(pypi, distro_id, pypi_url):
-    server = xmlrpclib.Server(pypi_url)
-    res = server.search({'name': distro_id})
-    match = None
-    for x in res:
-        if utils.make_distro_id(x['name']) == utils.make_distro_id(distro_id):
-            match = x
-            break
-
-    if not match:
-        return None
-
-    data = {}
-    name = match['name']
-    urls = []
-    for rel in server.package_releases(name):
-        data = server.release_data(name, rel)
-        urls += [(rel, x) for x in server.release_urls(name, rel)]
-
-    kwargs = dict(data)
-    if kwargs.get('classifiers'):
-        kwargs['classifiers'] = \
-            u'\n'.join(kwargs['classifiers'])
-
-    return (name, kwargs, urls)
-
-
-def try_to_update(pypi, distro_id, backup_pypis):
-    for pypi_url in backup_pypis:
-        info = _get_remote_info(pypi, distro_id, pypi_url)
-        if info:
-            name, kwargs, urls = info
-
-            pypi.update_metadata(**kwargs)
-
-            for rel, urldict in urls:
-                content = utils.UrlContent(urldict['url'], urldict['filename'])
-                pypi.upload_files(name, content)
+        if self.mirror is not None:
+            # files still being mirrored are served from upstream meanwhile
+            for base, url in self.mirror.get_pending(distro_id):
+                if base not in listed:
+                    yield u'<li><a href="%s">%s</a></li>\n' % (url, base)
+            # while pull-through files are fetched when first requested
+            for remote in self.pypi.get_remote_files(target):
+                url = '../../d/'+distro_id+'/f/'+remote.filename
+                yield u'<li><a href="%s">%s</a></li>\n' % (url,
+                                                            remote.filename)
 
-            return True
+        yield u'</ul></body></html>'
 
-    return False
 
 def protect(function):
     def _protect(self,req):
@@ -314,6 +361,36 @@ class PyPiInnerApp(AbstractPyPiApp):
     """WSGI app for serving up pypi functionality.
     """
 
+    page_cache_size = 500
+    compressed_cache = None
+    metrics = None
+    profile_dir = None
+    memory_tracker = None
+    htpasswd_file = None
+    auth_cache = None
+
+    # the most SQL statements a request to each endpoint may execute,
+    # see restmodel.QUERY_BUDGETS
+    query_budgets = {
+        'root': 4,
+        'simple': 6,
+        'distro': 9,
+        'file': 6,
+        'customindex': 8,
+        'search': 4,
+        'stats': 15,
+        'metrics': 15,
+        'profiles': 15,
+        'memory': 15,
+        'redirect': 0,
+        'redirect_distro': 0,
+        'distro_json': max(restmodel.QUERY_BUDGETS['distros'],
+                           restmodel.QUERY_BUDGETS['distro']),
+        'file_json': max(restmodel.QUERY_BUDGETS['files'],
+                         restmodel.QUERY_BUDGETS['file']),
+        'customindex_json': max(restmodel.QUERY_BUDGETS['indexes'],
+                                restmodel.QUERY_BUDGETS['index'])}
+
     urlmap = routing.Map()
     urlmap.add(routing.Rule('/', methods=['POST'], endpoint='pypi_action'))
     urlmap.add(routing.Rule('/', methods=['GET'], endpoint='root'))
@@ -340,12 +417,34 @@ class PyPiInnerApp(AbstractPyPiApp):
     urlmap.add(routing.Rule('/<string:distro_id>/',
                             endpoint='redirect_distro'))
     urlmap.add(routing.Rule('/search', endpoint='search'))
-
-    def __init__(self, pypi, backup_pypis=[], debug=False):
-        super(PyPiInnerApp, self).__init__(pypi, debug)
-        self.subapp_simple = SimpleIndexApp(pypi, backup_pypis, debug)
+    urlmap.add(routing.Rule('/stats', endpoint='stats'))
+    urlmap.add(routing.Rule('/metrics', endpoint='metrics'))
+    urlmap.add(routing.Rule('/profiles', endpoint='profiles'))
+    urlmap.add(routing.Rule('/profiles/<name>', endpoint='profiles'))
+    urlmap.add(routing.Rule('/memory', endpoint='memory'))
+
+    def __init__(self, pypi, backup_pypis=[], debug=False,
+                 template_cache_dir=None, mirror_workers=4,
+                 mirror_miss_ttl=3600, persist_mirror_misses=False,
+                 mirror_max_releases=None, mirror_pull_through=False):
+        templates = TemplateLoader(use_dojo=True, debug=debug,
+                                   cache_dir=template_cache_dir)
+        super(PyPiInnerApp, self).__init__(pypi, debug, templates)
+        self.mirror = None
+        if backup_pypis:
+            sessionmaker = None
+            if persist_mirror_misses:
+                sessionmaker = pypi.sessionmaker
+            misses = MissCache(mirror_miss_ttl, sessionmaker)
+            self.mirror = Mirror(pypi, backup_pypis, mirror_workers, misses,
+                                 mirror_max_releases, mirror_pull_through,
+                                 os.path.join(pypi.basefiledir, '.locks'))
+        self.subapp_simple = SimpleIndexApp(pypi, backup_pypis, debug,
+                                            templates, self.mirror)
         self.backup_pypis = backup_pypis
         self.restishapp = restmodel.app_factory(self.pypi, debug)
+        self.page_cache = cache.LRUCache(self.page_cache_size)
+        pypi.add_change_listener(self.invalidate_distro_pages)
 
     def app_special_static(self, environ, start_response):
         env = dict(environ)
@@ -379,8 +478,25 @@ class PyPiInnerApp(AbstractPyPiApp):
 
         res = werkzeug.Response()
         res.content_type = 'application/octet-stream'
-        res.response = open(self.pypi.get_file(distro_id,
-                                               filename), 'rb')
+        stat = self.pypi.stat_file(distro_id, filename)
+        if stat is None and self.mirror is not None:
+            remote = self.pypi.get_remote_file(distro_id, filename)
+            if remote is not None:
+                fetching = self.mirror.fetch(distro_id, remote)
+                # None means a concurrent request just fetched it
+                if fetching is None:
+                    stat = self.pypi.stat_file(distro_id, filename)
+                else:
+                    if remote.size:
+                        res.headers['Content-Length'] = str(remote.size)
+                    res.response = fetching
+                    return res(environ, start_response)
+        if stat is None:
+            raise werkexc.NotFound()
+        res.headers['Content-Length'] = str(stat.size)
+        res.response = werkzeug.wrap_file(environ,
+                                          self.pypi.open_file(distro_id,
+                                                              filename))
         return res(environ, start_response)
 
     def subapp_customindex(self, environ, start_response):
@@ -421,7 +537,7 @@ class PyPiInnerApp(AbstractPyPiApp):
         page = utils.Page(latest, page_num, 20)
         yield tmpl.render(page=page,
                           title='Latest Updates',
-                          version=__version__,
+                          version=get_version(),
                           **self.globs(req.environ))
 
     @utils.respond
@@ -434,7 +550,7 @@ class PyPiInnerApp(AbstractPyPiApp):
         yield tmpl.render(s=s,
                           title='Search Results for "%s"' % s,
                           page=page,
-                          version=__version__,
+                          version=get_version(),
                           **self.globs(req.environ))
 
     def subapp_distro(self, environ, start_response):
@@ -460,19 +576,36 @@ class PyPiInnerApp(AbstractPyPiApp):
             res = werkzeug.Response(tmpl.render(exc=exc,
                                                 extra_message=extra_message,
                                                 url_root=url_root,
-                                                version=__version__),
+                                                version=get_version()),
                                     content_type='text/html; charset=UTF-8',
                                     status=403)
             return res(environ, start_response)
 
         if distro is None:
-            if self.backup_pypis:
-                if not try_to_update(self.pypi, distro_id, self.backup_pypis):
+            if self.mirror is not None:
+                if not self.mirror.update(distro_id):
                     raise HTTPNoSuchDistroError(distro_id)
             else:
                 raise HTTPNoSuchDistroError(distro_id)
+            distro = self.pypi.get_distro(distro_id)
 
-        tmpl = self.templates.get_template('distro.html', environ)
+        # everything on the page derives from the distro's state, what
+        # the viewer may see of it and the address it was served at; the
+        # query string is left out so it cannot be used to fill the cache
+        roles = self.pypi.get_roles(distro)
+        key = (distro_id, distro.last_updated, frozenset(roles),
+               req.environ.get('REMOTE_USER'), req.base_url)
+        body = self.page_cache.get(key)
+        if body is None:
+            body = self.render_distro(req, distro, roles)
+            self.page_cache.set(key, body)
+
+        res = werkzeug.Response(body, content_type='text/html; charset=UTF-8')
+        return res(environ, start_response)
+
+    def render_distro(self, req, distro, roles):
+        distro_id = distro.distro_id
+        tmpl = self.templates.get_template('distro.html', req.environ)
         url_root = '/'.join(req.url_root.split('/')[:-2]) + '/'
 
         indexes = []
@@ -480,9 +613,20 @@ class PyPiInnerApp(AbstractPyPiApp):
             indexes.append({'indexname': x,
                             'url': 'i/'+x})
 
-        files = self.pypi.get_files(distro_id)
+        files = [{'filename': os.path.basename(x),
+                  'url': '%sd/%s/f/%s' % (url_root, distro_id,
+                                          os.path.basename(x))}
+                 for x in self.pypi.get_files(distro)]
+        if self.mirror is not None:
+            listed = set([x['filename'] for x in files])
+            files += [{'filename': base, 'url': url}
+                      for base, url in self.mirror.get_pending(distro_id)
+                      if base not in listed]
+            files += [{'filename': x.filename,
+                       'url': '%sd/%s/f/%s' % (url_root, distro_id,
+                                               x.filename)}
+                      for x in self.pypi.get_remote_files(distro)]
 
-        distro = self.pypi.get_distro(distro_id)
         if distro.classifiers is not None:
             c = [x.strip().split('::')[-1].strip()
                  for x in distro.classifiers.split('\n')]
@@ -490,33 +634,114 @@ class PyPiInnerApp(AbstractPyPiApp):
             c = []
 
         extra_css_classes = []
-        if self.pypi.has_role(distro_id,
-                              pypi.MANAGER_ROLE,
-                              model.OWNER_ROLE):
+        if pypi.MANAGER_ROLE in roles or model.OWNER_ROLE in roles:
             extra_css_classes.append('can-modify')
         kwargs = self.globs(req.environ,
                             distro=distro,
                             distro_extra={'classifiers': c},
-                            distro_url=req.url,
+                            distro_url=req.base_url,
                             indexes=indexes,
                             extra_css_classes=' '.join(extra_css_classes),
-                            files=[
-                                {'filename': os.path.basename(x),
-                                 'url': '%sd/%s/f/%s' % (url_root,
-                                                         distro_id,
-                                                         os.path.basename(x))}
-                                   for x in files],
+                            files=files,
                             url_root=url_root,
-                            rst=self.rst_format)
-        res = werkzeug.Response(tmpl.render(version=__version__, **kwargs),
-                                content_type='text/html; charset=UTF-8')
-        return res(environ, start_response)
+                            description_html=
+                                self.pypi.get_description_html(distro))
+        return tmpl.render(version=get_version(), **kwargs)
 
-    def rst_format(self, s):
-        published = docutilscore.publish_parts(
-            s, settings_overrides={'halt_level': 10},
-            writer_name='html')
-        return '<div class="rst">'+published['html_body']+'</div>'
+    def invalidate_distro_pages(self, distro_id):
+        if distro_id is None:
+            self.page_cache.clear()
+        else:
+            self.page_cache.discard_matching(lambda key: key[0] == distro_id)
+
+    def cache_stats(self):
+        stats = {'distro_pages': self.page_cache.stats(),
+                 'file_info': self.pypi.file_info_cache.stats()}
+        if self.compressed_cache is not None:
+            stats['compressed_responses'] = self.compressed_cache.stats()
+        if self.auth_cache is not None:
+            stats['authentication'] = self.auth_cache.stats()
+        return stats
+
+    def respond_stats(self, req):
+        if not self.pypi.has_role(None, pypi.MANAGER_ROLE):
+            raise werkexc.Forbidden()
+        stats = self.cache_stats()
+        if self.pypi.job_queue is not None:
+            stats['jobs'] = self.pypi.job_queue.stats()
+        return werkzeug.Response(simplejson.dumps(stats),
+                                 content_type=APP_JSON_MIME_TYPE,
+                                 headers=utils.NO_CACHE_HEADERS)
+
+    def respond_metrics(self, req):
+        if self.metrics is None:
+            raise werkexc.NotFound()
+        if not self.pypi.has_role(None, pypi.MANAGER_ROLE):
+            raise werkexc.Forbidden()
+        return werkzeug.Response(self.metrics.render(self.cache_stats(),
+                                                    self.pypi.job_queue),
+                                 content_type=metrics.CONTENT_TYPE,
+                                 headers=utils.NO_CACHE_HEADERS)
+
+    def respond_profiles(self, req, name=None):
+        if self.profile_dir is None:
+            raise werkexc.NotFound()
+        if not self.pypi.has_role(None, pypi.MANAGER_ROLE):
+            raise werkexc.Forbidden()
+
+        if name is not None:
+            path = profiling.profile_path(self.profile_dir, name)
+            if path is None:
+                raise werkexc.NotFound()
+            res = werkzeug.Response(content_type='application/octet-stream',
+                                    headers=utils.NO_CACHE_HEADERS)
+            res.headers['Content-Disposition'] = \
+                'attachment; filename=%s.prof' % name
+            res.response = werkzeug.wrap_file(req.environ, open(path, 'rb'))
+            return res
+
+        limit = int(req.args.get('limit', 50))
+        profiles = profiling.list_profiles(self.profile_dir, limit)
+        for x in profiles:
+            x['url'] = req.url_root + 'profiles/' + x['name']
+        return werkzeug.Response(simplejson.dumps(profiles),
+                                 content_type=APP_JSON_MIME_TYPE,
+                                 headers=utils.NO_CACHE_HEADERS)
+
+    def respond_memory(self, req):
+        """Object counts by type and category, and what grew since the
+        last snapshot, a POST takes a new snapshot first.
+        """
+
+        if self.memory_tracker is None:
+            raise werkexc.NotFound()
+        if not self.pypi.has_role(None, pypi.MANAGER_ROLE):
+            raise werkexc.Forbidden()
+        if req.method == 'POST':
+            self.memory_tracker.snapshot()
+        limit = int(req.args.get('limit', 20))
+        return werkzeug.Response(
+            simplejson.dumps(self.memory_tracker.report(limit)),
+            content_type=APP_JSON_MIME_TYPE,
+            headers=utils.NO_CACHE_HEADERS)
+
+    def metrics_endpoint(self, environ):
+        """The name requests for *environ* are recorded under in the
+        metrics, JSON requests are kept apart from the HTML ones.
+        """
+
+        urls = self.urlmap.bind_to_environ(environ)
+        try:
+            endpoint, kwargs = urls.match()
+        except routing.RequestRedirect:
+            return 'redirect'
+        except werkexc.HTTPException:
+            return 'not_found'
+        if endpoint in ('distro', 'file', 'customindex'):
+            req = werkzeug.Request(environ)
+            if req.accept_mimetypes.best == APP_JSON_MIME_TYPE:
+                endpoint += '_json'
+        return endpoint
 
     def __call__(self, environ, start_response):
         pypi.active_info.username = environ.get('REMOTE_USER', None)
@@ -546,22 +771,17 @@ class PyPiInnerApp(AbstractPyPiApp):
         
     @protect
     def respond_users(self, req):
-        #if using config
-        config = ConfigParser.ConfigParser() 
-        try:
-           config.read(self.top.security_config)
-           f = open(config.get('plugin:htpasswd','filename'))
-           user_list = [user.split(':')[0] for user in f]
-           user_list.sort()
-        #fallback to local database 
-        except TypeError :
+        if self.htpasswd_file is not None:
+            user_list = self.htpasswd_file.usernames()
+        else:
+            # fallback to local database
             user_list = self.pypi.security_manager.get_users()
-            user_list = [user.username for user in user_list] 
+            user_list = [user.username for user in user_list]
         remote_user = req.environ.get('REMOTE_USER', None)
         tmpl = self.templates.get_template('users.html', req.environ)
         res = werkzeug.Response(tmpl.render(remote_user=remote_user,
                                             user_list=user_list,
-                                            version=__version__),
+                                            version=get_version()),
                                 content_type='text/html; charset=UTF-8',
                                 )
         return res
@@ -570,13 +790,9 @@ class PyPiInnerApp(AbstractPyPiApp):
     def respond_adduser(self, req):
         username = req.values.get('username', '')
         password = req.values.get('password', '')
-        #XXX repeating ourselves, 
-        config = ConfigParser.ConfigParser() 
-        config.read(self.top.security_config)
-        f = config.get('plugin:htpasswd','filename')
-        pfile = htpasswd.HtpasswdFile(f)
-        pfile.update(username,password)
-        pfile.save()
+        if self.htpasswd_file is None:
+            raise werkexc.NotFound()
+        self.htpasswd_file.update(username, password)
         raise routing.RequestRedirect('/users')
 
     def respond_pypi_action(self, req):
@@ -665,6 +881,7 @@ class PyPiApp(object):
     """
 
     pypi_factory = staticmethod(pypi.PyPi)
+    htpasswd_file = None
 
     def __init__(self,
                  basefiledir,
@@ -675,7 +892,23 @@ class PyPiApp(object):
                  backup_pypis=[],
                  logger=utils.logger,
                  securelogger=utils.securelogger,
-                 debug=False):
+                 debug=False,
+                 template_cache_dir=None,
+                 mirror_workers=4,
+                 mirror_miss_ttl=3600,
+                 persist_mirror_misses=False,
+                 mirror_max_releases=None,
+                 mirror_pull_through=False,
+                 storage_layout=None,
+                 storage_url=None,
+                 gzip_responses=True,
+                 sql_stats=None,
+                 collect_metrics=True,
+                 profile_dir=None,
+                 profile_sample_rate=0.0,
+                 trace_malloc=0,
+                 auth_cache_ttl=60,
+                 job_workers=2):
         self.logger = logger
         self.securelogger = securelogger
         self.basefiledir = basefiledir
@@ -685,6 +918,26 @@ class PyPiApp(object):
         self.self_register = self_register
         self.backup_pypis = backup_pypis
         self.debug = debug
+        self.template_cache_dir = template_cache_dir
+        self.mirror_workers = mirror_workers
+        self.mirror_miss_ttl = mirror_miss_ttl
+        self.persist_mirror_misses = persist_mirror_misses
+        self.mirror_max_releases = mirror_max_releases
+        self.mirror_pull_through = mirror_pull_through
+        self.storage_layout = storage_layout
+        self.storage_url = storage_url
+        self.gzip_responses = gzip_responses
+        self.collect_metrics = collect_metrics
+        self.profile_dir = profile_dir
+        self.profile_sample_rate = profile_sample_rate
+        self.trace_malloc = trace_malloc
+        if (collect_metrics or debug) and sql_stats is None:
+            sql_stats = sqlstats.QueryStats()
+        self.sql_stats = sql_stats
+        self.job_workers = job_workers
+        self.auth_cache = None
+        if auth_cache_ttl:
+            self.auth_cache = authcache.AuthCache(ttl=auth_cache_ttl)
 
         self.whoconfig, self.usermanager, self.groupmanager \
                         = self.build_secure_config()
@@ -712,9 +965,18 @@ class PyPiApp(object):
 
         usermanager = None
         groupmanager = None
-        for name, plugin in config.authenticators:
+        for pos, (name, plugin) in enumerate(config.authenticators):
             if isinstance(plugin, repozehtpasswd.HTPasswdPlugin):
-                usermanager = securehtpasswd.HtpasswdUserManager(plugin.filename)
+                # one in-memory copy of the users serves authentication
+                # and the user pages, it reloads when the file changes
+                self.htpasswd_file = htpasswd.HtpasswdFile(
+                    plugin.filename,
+                    create=not os.path.exists(plugin.filename))
+                config.authenticators[pos] = (
+                    name, htpasswd.HtpasswdAuthenticator(self.htpasswd_file,
+                                                         plugin.check))
+                usermanager = htpasswd.HtpasswdUserManager(
+                    self.htpasswd_file, plugin.check)
                 groupf = os.path.join(os.path.dirname(plugin.filename),
                                       'groups.info')
                 self.securelogger.info('Using "%s" for users' \
@@ -730,22 +992,74 @@ class PyPiApp(object):
             self.securelogger.warn('Web-based management only supported '
                                    'with htpasswd-style setup')
 
+        if self.auth_cache is not None:
+            # spares pip's authenticated download storms the password
+            # checks, changed passwords are forgotten right away
+            config.authenticators = [
+                (name, authcache.CachingAuthenticator(plugin,
+                                                      self.auth_cache))
+                for name, plugin in config.authenticators]
+            self.pypi.security_manager.add_password_listener(
+                self.auth_cache.invalidate)
+            if self.htpasswd_file is not None:
+                self.htpasswd_file.add_listener(self.auth_cache.invalidate)
+
         return config, usermanager, groupmanager
 
     @werkzeug.cached_property
     def pypi(self):
-        return self.pypi_factory(self.basefiledir,
-                                 self.sqluri,
-                                 self.self_register)
+        res = self.pypi_factory(self.basefiledir,
+                                self.sqluri,
+                                self.self_register,
+                                self.storage_layout,
+                                self.storage_url)
+        if self.sql_stats is not None:
+            res.sql_stats = self.sql_stats
+        if self.job_workers:
+            res.job_queue = jobs.JobQueue(res, self.job_workers)
+        return res
 
     @werkzeug.cached_property
     def app(self):
         innerapp = PyPiInnerApp(pypi=self.pypi, backup_pypis=self.backup_pypis,
-                                debug=self.debug)
+                                debug=self.debug,
+                                template_cache_dir=self.template_cache_dir,
+                                mirror_workers=self.mirror_workers,
+                                mirror_miss_ttl=self.mirror_miss_ttl,
+                                persist_mirror_misses=
+                                    self.persist_mirror_misses,
+                                mirror_max_releases=
+                                    self.mirror_max_releases,
+                                mirror_pull_through=
+                                    self.mirror_pull_through)
         innerapp.logger = self.logger
+        innerapp.memory_tracker = memory.MemoryTracker(self.trace_malloc)
+        innerapp.htpasswd_file = self.htpasswd_file
+        innerapp.auth_cache = self.auth_cache
+        if self.pypi.job_queue is not None:
+            # pick up the jobs left over when the server last stopped
+            self.pypi.job_queue.resume()
+
+        app = innerapp
+        if self.collect_metrics:
+            innerapp.metrics = metrics.Metrics()
+            app = metrics.MetricsMiddleware(app, innerapp.metrics,
+                                            innerapp.metrics_endpoint,
+                                            self.sql_stats)
+        if self.debug:
+            app = sqlstats.QueryBudgetMiddleware(app, self.sql_stats,
+                                                 innerapp.query_budgets,
+                                                 innerapp.metrics_endpoint,
+                                                 self.logger)
+        if self.profile_dir:
+            innerapp.profile_dir = self.profile_dir
+            app = profiling.ProfilingMiddleware(
+                app, self.profile_dir, self.profile_sample_rate,
+                authorize=self.is_manager,
+                endpoint_for=innerapp.metrics_endpoint)
 
         app = whomiddleware.PluggableAuthenticationMiddleware(
-            innerapp,
+            app,
             self.whoconfig.identifiers,
             self.whoconfig.authenticators,
             self.whoconfig.challengers,
@@ -767,6 +1081,9 @@ class PyPiApp(object):
                                          app=app,
                                          usermanager=self.usermanager,
                                          groupmanager=self.groupmanager)
+        if self.gzip_responses:
+            app = compress.GzipMiddleware(app)
+            innerapp.compressed_cache = app.compressed_cache
         innerapp.top = app
         #need this var exposed for user adding, should it be part of pypi constructor?
         app.security_config = self.security_config
@@ -776,6 +1093,13 @@ class PyPiApp(object):
 
         return app
 
+    def is_manager(self, environ):
+        username = environ.get('REMOTE_USER')
+        if not username:
+            return False
+        roles = self.pypi.security_manager.get_roles(username, None, True)
+        return pypi.MANAGER_ROLE in roles
+
     def __call__(self, environ, start_response):
         return self.app(environ, start_response)
 